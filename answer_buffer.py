@@ -0,0 +1,277 @@
+import io
+import logging
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+import psycopg2
+from psycopg2.extras import execute_values
+from answer_distribution import distributions
+from leaderboard import leaderboards
+from snapshots import written_answers
+import db_setup
+import final_score
+import schemas
+import session_events
+import exceptions
+"""
+Write-behind buffer for player answers, used when ANSWER_WRITE_MODE=buffered.
+
+POST /player-answers/ scores the answer, puts it in a bounded queue and answers right away.
+A background thread takes the queued answers in batches of up to ANSWER_BATCH_SIZE, or whatever
+arrived within ANSWER_FLUSH_INTERVAL seconds, and writes each batch in a single transaction:
+one COPY into player_answers and one UPDATE of participants.final_score with the points of
+every participant in the batch added up.
+
+When the queue is full a submission is refused right away with a 503 rather than waiting for room
+on a pooled connection (and in app_async on the event loop), so a database that can't keep up
+slows the players down instead of eating memory. No answer is accepted while the flusher isn't running.
+
+A batch that can't be written (no free connection, the database is down) stays with the flusher,
+which tries it again with a backoff of up to ANSWER_RETRY_MAX_DELAY seconds while the queue behind
+it fills up. Only a row the database refuses for good, e.g the answer of a participant that was
+deleted meanwhile, is dropped, GET /metrics counts them in kahoot_answer_buffer_dropped_total.
+
+Whatever is still queued is written when the api shuts down, what still can't be written
+ANSWER_DRAIN_TIMEOUT seconds later is dropped. Ending a session first waits up to
+ANSWER_DRAIN_TIMEOUT seconds for the queue to be written, so its final standings count every answer.
+The session is closed before that, under the same lock that queues an answer, so an answer for it
+that arrives while or after it ends is refused instead of being written after the final standings.
+
+With FINAL_SCORE_MODE=deferred (see final_score.py) a batch is only the COPY.
+"""
+
+ANSWER_WRITE_MODE = os.getenv("ANSWER_WRITE_MODE", "direct")  # "direct" or "buffered"
+ANSWER_BUFFER_SIZE = int(os.getenv("ANSWER_BUFFER_SIZE", "20000"))
+ANSWER_BATCH_SIZE = int(os.getenv("ANSWER_BATCH_SIZE", "1000"))
+ANSWER_FLUSH_INTERVAL = float(os.getenv("ANSWER_FLUSH_INTERVAL", "0.2"))
+ANSWER_DRAIN_TIMEOUT = float(os.getenv("ANSWER_DRAIN_TIMEOUT", "5"))
+ANSWER_RETRY_MAX_DELAY = float(os.getenv("ANSWER_RETRY_MAX_DELAY", "5"))
+
+logger = logging.getLogger(__name__)
+
+# the columns of a buffered answer, in the order COPY writes them after its id
+COLUMNS = ("session_id", "participant_id", "question_id", "answer_id", "time_taken", "points_earned")
+
+RESERVE_IDS_SQL = "SELECT nextval(pg_get_serial_sequence('player_answers', 'id')) FROM generate_series(1, %s);"
+
+# how many ended sessions stay closed, an answer for an older one is refused by db.score_answer
+CLOSED_SESSIONS_KEPT = 10000
+
+# errors caused by the rows themselves, writing them again would fail the same way
+PERMANENT_ERRORS = (psycopg2.IntegrityError, psycopg2.DataError)
+
+
+class AnswerWriteBuffer:
+    """bounded queue of scored answers plus the thread that flushes it to the database"""
+
+    def __init__(self, max_size: int, batch_size: int, flush_interval: float):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_size)
+        self._stopping = threading.Event()
+        self._give_up_at = None
+        self._thread = None
+        # answers the database refused for good, only the flusher writes it
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._closed_sessions = OrderedDict()  # session_id -> None, oldest first
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="answer-buffer-flusher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """stop taking answers and wait until everything queued has been written"""
+        if not self.running:
+            return
+        self._give_up_at = time.monotonic() + ANSWER_DRAIN_TIMEOUT
+        self._stopping.set()
+        self._thread.join()
+        self._thread = None
+
+    def submit(self, player_answer: schemas.PlayerAnswerCreate, points_earned: int):
+        """queue one scored answer, refused right away if the queue is full or nothing writes it"""
+        if not self.running or self._stopping.is_set():
+            raise exceptions.AnswerBufferStoppedException()
+        row = (
+            player_answer.session_id,
+            player_answer.participant_id,
+            player_answer.question_id,
+            player_answer.answer_id,
+            player_answer.time_taken,
+            points_earned,
+        )
+        with self._lock:
+            if player_answer.session_id in self._closed_sessions:
+                raise exceptions.GameSessionNotLiveException(player_answer.session_id)
+            try:
+                self._queue.put_nowait(row)
+            except queue.Full:
+                raise exceptions.AnswerBufferFullException(self._queue.maxsize)
+
+    def close_session(self, session_id: int):
+        """refuse the session's answers from now on, the ones queued so far are still written"""
+        with self._lock:
+            self._closed_sessions[session_id] = None
+            self._closed_sessions.move_to_end(session_id)
+            if len(self._closed_sessions) > CLOSED_SESSIONS_KEPT:
+                self._closed_sessions.popitem(last=False)
+
+    def reopen_session(self, session_id: int):
+        with self._lock:
+            self._closed_sessions.pop(session_id, None)
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def drain(self, timeout: float = None):
+        """wait up to `timeout` seconds until every answer queued so far is written, False if they weren't"""
+        timeout = ANSWER_DRAIN_TIMEOUT if timeout is None else timeout
+        if not self.running:
+            return self._queue.unfinished_tasks == 0
+        deadline = time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logger.warning("%d buffered answers were not written after %.1fs", self._queue.unfinished_tasks, timeout)
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    def _run(self):
+        batch, delay = [], 0.0
+        while True:
+            batch = batch or self._next_batch()
+            if not batch:
+                if self._stopping.is_set() and self._queue.empty():
+                    return
+                continue
+            unwritten = self._write(batch)
+            if unwritten and self._stopping.is_set() and time.monotonic() > self._give_up_at:
+                logger.error("the api is shutting down, dropping %d buffered answers that can't be written", len(unwritten))
+                self.dropped += len(unwritten)
+                unwritten = []
+            # written or dropped, either way drain() doesn't have to wait for them anymore
+            for _ in range(len(batch) - len(unwritten)):
+                self._queue.task_done()
+            batch = unwritten
+            if batch:
+                delay = min(max(2 * delay, 0.1), ANSWER_RETRY_MAX_DELAY)
+                time.sleep(delay)
+            else:
+                delay = 0.0
+
+    def _next_batch(self):
+        """wait for a first answer, then collect more until the batch is full or the interval is up"""
+        try:
+            batch = [self._queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        """write a batch, returns the rows that weren't written and have to be tried again"""
+        try:
+            with db_setup.pooled_connection() as con:
+                try:
+                    self._write_counted(con, batch)
+                    return []
+                except PERMANENT_ERRORS:
+                    # one bad row (e.g a participant that left) fails the COPY,
+                    # so fall back to writing the rows one at a time and drop the bad ones
+                    logger.exception("writing a batch of %d answers failed, retrying them one by one", len(batch))
+                for position, row in enumerate(batch):
+                    try:
+                        self._write_counted(con, [row])
+                    except PERMANENT_ERRORS:
+                        logger.exception("dropping buffered answer %r", row)
+                        self.dropped += 1
+                    except Exception:
+                        logger.exception("writing buffered answers failed, %d of them are tried again", len(batch) - position)
+                        return batch[position:]
+                return []
+        except Exception:
+            logger.exception("writing buffered answers failed, %d of them are tried again", len(batch))
+            return batch
+
+    def _write_counted(self, con, rows):
+        written = list(zip(write_answers(con, rows), rows))
+        # the live leaderboards and answer distributions count buffered answers once they are
+        # written, one being built catches up on them when it's installed, see snapshots.WrittenAnswers
+        with written_answers.lock:
+            written_answers.add(written)
+            distributions.record_written(written)
+            unknown = leaderboards.record_written(written)
+        if unknown:
+            # participants that joined through another worker, see db.record_live_score. The rows
+            # are written, so a failure here must not send them back to be written again
+            try:
+                usernames = participant_usernames(con, {participant_id for _, _, participant_id, _ in unknown})
+                leaderboards.record_unknown(unknown, usernames)
+            except Exception:
+                logger.exception("putting %d participants on their leaderboards failed", len(unknown))
+        for session_id in {row[0] for row in rows}:
+            session_events.leaderboard_changed(session_id)
+
+
+def write_answers(con, rows):
+    """
+    write scored answers with COPY and add their points to final_score, one UPDATE per batch,
+    returns the ids the rows were written with
+    """
+    scores = {}
+    for row in rows:
+        participant_id, points_earned = row[1], row[5]
+        scores[participant_id] = scores.get(participant_id, 0) + points_earned
+    with con:
+        with con.cursor() as cursor:
+            # COPY doesn't return the ids it wrote, so they are taken from the sequence first
+            cursor.execute(RESERVE_IDS_SQL, (len(rows),))
+            ids = [row[0] for row in cursor.fetchall()]
+            copy_data = io.StringIO()
+            for score_id, row in zip(ids, rows):
+                copy_data.write("\t".join(map(str, (score_id, *row))) + "\n")
+            copy_data.seek(0)
+            cursor.copy_expert(f"COPY player_answers (id, {', '.join(COLUMNS)}) FROM STDIN;", copy_data)
+            if not final_score.deferred():
+                execute_values(
+                    cursor,
+                    """UPDATE participants p
+                    SET final_score = p.final_score + v.points
+                    FROM (VALUES %s) AS v(id, points)
+                    WHERE p.id = v.id;""",
+                    list(scores.items()),
+                )
+    return ids
+
+
+def participant_usernames(con, participant_ids):
+    """participant id -> username"""
+    with con:
+        with con.cursor() as cursor:
+            cursor.execute("SELECT id, username FROM participants WHERE id = ANY(%s);", (list(participant_ids),))
+            return dict(cursor.fetchall())
+
+
+answers = AnswerWriteBuffer(ANSWER_BUFFER_SIZE, ANSWER_BATCH_SIZE, ANSWER_FLUSH_INTERVAL)
+
+
+def enabled():
+    return ANSWER_WRITE_MODE == "buffered"
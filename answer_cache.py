@@ -0,0 +1,148 @@
+import os
+import threading
+from collections import OrderedDict
+"""
+In-memory answer keys for the kahoots that are being played.
+
+An answer key maps answer_id -> (question_id, is_correct) and question_id -> (points, time_limit)
+for one kahoot, so db.submit_answer can score an answer without reading the answers table.
+Keys are loaded by db.py when a game session is created or on the first submission of a session,
+and dropped again by the db.py functions that change questions or answers.
+
+Keys of kahoots with a live session are never evicted. Once its last session has ended a key
+stays around until it becomes the least recently used one and the cache is over ANSWER_CACHE_SIZE.
+
+The cache lives in the api process, so every uvicorn worker has its own copy, and an edit made
+through one worker only invalidates that worker's copy. Run one worker, or don't edit quizzes mid-game.
+"""
+
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "256"))
+
+
+class AnswerKey:
+    """the answer key of a single kahoot"""
+
+    __slots__ = ("kahoot_id", "answers", "questions")
+
+    def __init__(self, kahoot_id: int, answers: dict, questions: dict):
+        self.kahoot_id = kahoot_id
+        self.answers = answers  # answer_id -> (question_id, is_correct)
+        self.questions = questions  # question_id -> (points, time_limit)
+
+    @classmethod
+    def from_rows(cls, kahoot_id: int, rows):
+        """build a key from (question_id, points, time_limit, answer_id, is_correct) rows"""
+        answers = {}
+        questions = {}
+        for question_id, points, time_limit, answer_id, is_correct in rows:
+            questions[question_id] = (points, time_limit)
+            if answer_id is not None:
+                answers[answer_id] = (question_id, is_correct)
+        return cls(kahoot_id, answers, questions)
+
+
+class AnswerKeyCache:
+    """thread safe LRU cache of answer keys, pinned while a session of the kahoot is live"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._keys = OrderedDict()  # kahoot_id -> AnswerKey, least recently used first
+        self._answer_index = {}  # answer_id -> kahoot_id
+        self._question_index = {}  # question_id -> kahoot_id
+        self._session_kahoots = {}  # session_id -> kahoot_id of every live session we know about
+        self._live_sessions = {}  # kahoot_id -> number of live sessions
+        # bumped on every invalidation, a key loaded before an invalidation is never stored
+        self.generation = 0
+
+    def get(self, kahoot_id: int):
+        with self._lock:
+            key = self._keys.get(kahoot_id)
+            if key is not None:
+                self._keys.move_to_end(kahoot_id)
+            return key
+
+    def put(self, key: AnswerKey, generation: int):
+        """store a freshly loaded key, unless something was invalidated while it was being loaded"""
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._drop(key.kahoot_id)
+            self._keys[key.kahoot_id] = key
+            for answer_id in key.answers:
+                self._answer_index[answer_id] = key.kahoot_id
+            for question_id in key.questions:
+                self._question_index[question_id] = key.kahoot_id
+            self._evict()
+
+    def kahoot_for_session(self, session_id: int):
+        with self._lock:
+            return self._session_kahoots.get(session_id)
+
+    def start_session(self, session_id: int, kahoot_id: int):
+        """remember which kahoot a live session plays and keep its key from being evicted"""
+        with self._lock:
+            if session_id in self._session_kahoots:
+                return
+            self._session_kahoots[session_id] = kahoot_id
+            self._live_sessions[kahoot_id] = self._live_sessions.get(kahoot_id, 0) + 1
+
+    def end_session(self, session_id: int):
+        """the session is over, its kahoot's key may be evicted once nothing else plays it"""
+        with self._lock:
+            kahoot_id = self._session_kahoots.pop(session_id, None)
+            if kahoot_id is None:
+                return
+            self._live_sessions[kahoot_id] -= 1
+            if not self._live_sessions[kahoot_id]:
+                del self._live_sessions[kahoot_id]
+            self._evict()
+
+    def invalidate_kahoot(self, kahoot_id: int):
+        with self._lock:
+            self.generation += 1
+            self._drop(kahoot_id)
+
+    def invalidate_question(self, question_id: int):
+        with self._lock:
+            self.generation += 1
+            kahoot_id = self._question_index.get(question_id)
+            if kahoot_id is not None:
+                self._drop(kahoot_id)
+
+    def invalidate_answer(self, answer_id: int):
+        with self._lock:
+            self.generation += 1
+            kahoot_id = self._answer_index.get(answer_id)
+            if kahoot_id is not None:
+                self._drop(kahoot_id)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._keys.clear()
+            self._answer_index.clear()
+            self._question_index.clear()
+            self._session_kahoots.clear()
+            self._live_sessions.clear()
+
+    def _drop(self, kahoot_id: int):
+        key = self._keys.pop(kahoot_id, None)
+        if key is None:
+            return
+        for answer_id in key.answers:
+            self._answer_index.pop(answer_id, None)
+        for question_id in key.questions:
+            self._question_index.pop(question_id, None)
+
+    def _evict(self):
+        if len(self._keys) <= self.max_size:
+            return
+        for kahoot_id in list(self._keys):
+            if len(self._keys) <= self.max_size:
+                break
+            if kahoot_id not in self._live_sessions:
+                self._drop(kahoot_id)
+
+
+answer_keys = AnswerKeyCache(ANSWER_CACHE_SIZE)
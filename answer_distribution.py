@@ -0,0 +1,147 @@
+import os
+import threading
+from snapshots import AnswerSnapshot, written_answers
+"""
+Live answer distributions of the questions being played, kept in memory.
+
+For every question of a live session a distribution counts how many players picked each answer and
+adds up the time they took, so GET /game-sessions/{id}/questions/{question_id}/distribution only
+walks the question's answers instead of reading player_answers. db.py builds one with a single
+GROUP BY when the host starts a question, or the first time it is answered or asked for after a
+restart, adds every submitted answer to it, and drops the distributions of a session when it ends.
+
+Answers committed while a distribution is being built are told apart the same way the live
+leaderboards do it, see snapshots.py. Buffered answers (ANSWER_WRITE_MODE=buffered) have no id
+until they are written, so the buffer's flusher counts them right after it writes them, and a
+distribution built meanwhile catches up on them when it's installed. Like the boards, distributions
+live in the api process, with several uvicorn workers each worker only counts the answers it handled itself.
+"""
+
+LIVE_DISTRIBUTION = os.getenv("LIVE_DISTRIBUTION", "1") == "1"
+
+
+def distribution(session_id: int, question_id: int, rows):
+    """
+    shape (answer_id, answer_text, is_correct, count, total_time_taken) rows like
+    schemas.AnswerDistribution
+    """
+    answers = [
+        {
+            "answer_id": row["answer_id"],
+            "answer_text": row["answer_text"],
+            "is_correct": row["is_correct"],
+            "count": row["count"],
+            "average_time_taken": row["total_time_taken"] / row["count"] if row["count"] else None,
+        }
+        for row in rows
+    ]
+    return {
+        "session_id": session_id,
+        "question_id": question_id,
+        "total": sum(answer["count"] for answer in answers),
+        "answers": answers,
+    }
+
+
+class QuestionDistribution:
+    """how often each answer of one question was picked in one session, and the time it took"""
+
+    def __init__(self, session_id: int, question_id: int, rows, snapshot: AnswerSnapshot):
+        self.session_id = session_id
+        self.question_id = question_id
+        self._lock = threading.Lock()
+        # answer_id -> [answer_text, is_correct, count, total_time_taken], in the order of the rows
+        self._answers = {
+            row["answer_id"]: [row["answer_text"], row["is_correct"], row["count"], float(row["total_time_taken"])]
+            for row in rows
+        }
+        self._snapshot = snapshot
+
+    def record(self, answer_id: int, time_taken: float, score_id: int = None):
+        if score_id is not None and score_id in self._snapshot:
+            return
+        with self._lock:
+            answer = self._answers.get(answer_id)
+            if answer is not None:
+                # an answer of another question isn't counted, by the GROUP BY either
+                answer[2] += 1
+                answer[3] += time_taken
+
+    def has_answer(self, answer_id: int):
+        return answer_id in self._answers
+
+    def entries(self):
+        """the distribution, shaped like schemas.AnswerDistribution"""
+        with self._lock:
+            rows = [
+                {
+                    "answer_id": answer_id,
+                    "answer_text": answer_text,
+                    "is_correct": is_correct,
+                    "count": count,
+                    "total_time_taken": total_time_taken,
+                }
+                for answer_id, (answer_text, is_correct, count, total_time_taken) in self._answers.items()
+            ]
+        return distribution(self.session_id, self.question_id, rows)
+
+
+class DistributionRegistry:
+    """the distributions of every live session in this process"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions = {}  # session_id -> {question_id: QuestionDistribution}
+
+    def get(self, session_id: int, question_id: int):
+        questions = self._sessions.get(session_id)
+        return questions.get(question_id) if questions else None
+
+    def install(self, distribution: QuestionDistribution, position: int):
+        """
+        keep a freshly built distribution, unless another request built one first, and count the
+        buffered answers written since its build started at `position`
+        """
+        with written_answers.lock:
+            with self._lock:
+                questions = self._sessions.setdefault(distribution.session_id, {})
+                installed = questions.setdefault(distribution.question_id, distribution)
+            if installed is distribution:
+                for score_id, (session_id, _, question_id, answer_id, time_taken, _) in written_answers.since(position):
+                    if session_id == distribution.session_id and question_id == distribution.question_id:
+                        distribution.record(answer_id, time_taken, score_id)
+        return installed
+
+    def record_written(self, answers):
+        """
+        count (score_id, row) pairs the answer buffer just wrote in the distributions that are live,
+        only with written_answers.lock held
+        """
+        for score_id, (session_id, _, question_id, answer_id, time_taken, _) in answers:
+            live = self.get(session_id, question_id)
+            if live is not None:
+                live.record(answer_id, time_taken, score_id)
+
+    def drop(self, session_id: int):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def invalidate_question(self, question_id: int):
+        """a question or its answers changed, its distributions are built again on next use"""
+        with self._lock:
+            for questions in self._sessions.values():
+                questions.pop(question_id, None)
+
+    def invalidate_answer(self, answer_id: int):
+        with self._lock:
+            for questions in self._sessions.values():
+                for question_id, distribution in list(questions.items()):
+                    if distribution.has_answer(answer_id):
+                        del questions[question_id]
+
+    def clear(self):
+        with self._lock:
+            self._sessions.clear()
+
+
+distributions = DistributionRegistry()
@@ -1,11 +1,27 @@
+import asyncio
+import itertools
 import os
-from typing import List
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import List, Optional
+import anyio
 import psycopg2
-from db_setup import get_connection
-from fastapi import FastAPI, HTTPException, status, Body
+import db_setup
+from fastapi import FastAPI, HTTPException, status, Body, Depends, Header, Query, Request, Response, WebSocket
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 import schemas
 import exceptions
 import db
+import answer_buffer
+import participant_joins
+import exports
+import fast_json
+import http_cache
+import metrics
+import pagination
+import session_events
+import slow_queries
 
 """
 ADD ENDPOINTS FOR FASTAPI HERE
@@ -18,59 +34,181 @@ Read more: https://www.geeksforgeeks.org/10-most-common-http-status-codes/
 - Use correct URL paths the resource, e.g some endpoints should be located at the exact same URL, 
 but will have different HTTP-verbs.
 """
-app = FastAPI(title="Kahoot-like Quiz API", version="1.0.0")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """open the connection pool on startup and close it again on shutdown"""
+    global connection_slots, putconn_limiter
+    db_setup.init_pool()
+    connection_slots = asyncio.Semaphore(db_setup.request_slots())
+    putconn_limiter = anyio.CapacityLimiter(db_setup.request_slots())
+    async with background_work():
+        yield
+    db_setup.close_pool()
+
+
+@asynccontextmanager
+async def background_work():
+    """start the answer flusher, the join coalescer and the websocket updates, app_async.py runs them too"""
+    if answer_buffer.enabled():
+        answer_buffer.answers.start()
+    if participant_joins.JOIN_COALESCING:
+        participant_joins.joins.start()
+    session_events.start(asyncio.get_running_loop())
+    yield
+    session_events.stop()
+    participant_joins.joins.stop()
+    # write out the buffered answers while the pool is still open
+    answer_buffer.answers.stop()
+
+
+app = FastAPI(title="Kahoot-like Quiz API", version="1.0.0", lifespan=lifespan)
+if metrics.enabled():
+    app.add_middleware(metrics.MetricsMiddleware)
+
+
+# one slot per pooled connection, a request waits for a slot on the event loop before it takes a
+# thread. Waiting inside the pool instead would block one of the threads the routes run in, and
+# once every thread waits for a connection, the requests holding the connections get no thread
+# to finish on and everything stalls until the pool timeout. The slots leave
+# db_setup.DB_POOL_BACKGROUND_RESERVE connections to the work that borrows one with
+# db_setup.pooled_connection() instead
+connection_slots = None
+# handing a connection back may roll back, which can't wait for a free thread of the default
+# limiter either. Every slot holder can hand back at once, so this one never makes anybody wait
+putconn_limiter = None
+
+
+@asynccontextmanager
+async def lend_connection():
+    """a pooled connection for the duration of one request"""
+    global connection_slots, putconn_limiter
+    if connection_slots is None:
+        connection_slots = asyncio.Semaphore(db_setup.request_slots())
+        putconn_limiter = anyio.CapacityLimiter(db_setup.request_slots())
+    slots = connection_slots
+    try:
+        await asyncio.wait_for(slots.acquire(), db_setup.DB_POOL_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise exceptions.ConnectionPoolExhaustedException(db_setup.DB_POOL_TIMEOUT)
+    try:
+        connection_pool = db_setup.init_pool()
+        con = await run_in_threadpool(connection_pool.getconn)
+        try:
+            yield con
+        finally:
+            await anyio.to_thread.run_sync(connection_pool.putconn, con, limiter=putconn_limiter)
+    finally:
+        slots.release()
+
+
+async def get_db():
+    """dependency that lends every route a pooled connection for the duration of the request"""
+    try:
+        async with lend_connection() as con:
+            yield con
+    except exceptions.ConnectionPoolExhaustedException as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e))
+
 
 #endpoints for the kahoots
 @app.get("/kahoots/", response_model=List[schemas.Kahoot], status_code=status.HTTP_200_OK)
-def get_kahoots():
-    """get all kahoots"""
-    con = None
+def get_kahoots(
+    request: Request,
+    response: Response,
+    limit: int = Query(pagination.DEFAULT_PAGE_SIZE, ge=1, le=pagination.MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    category: Optional[str] = None,
+    created_after: Optional[datetime] = None,
+    created_before: Optional[datetime] = None,
+    con=Depends(get_db),
+):
+    """get a page of kahoots, newest first, the Link header points at the next page,
+    answers 304 when If-None-Match still matches"""
     try:
-        con = get_connection()
-        kahoots = db.get_all_kahoots(con)
+        after = pagination.decode_cursor(cursor) if cursor else None
+        filters = (category, pagination.as_utc(created_after), pagination.as_utc(created_before))
+        # limit + 1, the row after the page decides the Link header, so it's part of the version as well
+        version = db.get_kahoots_page_version(con, after, limit + 1, *filters)
+        tag = http_cache.etag("kahoots", version[:20])
+        cached = http_cache.not_modified(request, tag)
+        if cached:
+            return cached
+        kahoots = db.get_all_kahoots(con, after, limit + 1, *filters)
+        kahoots, next_cursor = pagination.split_page(kahoots, limit, "creation_date")
+        headers = http_cache.headers(tag)
+        if next_cursor:
+            headers["Link"] = pagination.link_header(request, next_cursor)
+        if fast_json.enabled():
+            return fast_json.response(schemas.Kahoot, kahoots, headers=headers)
+        response.headers.update(headers)
         return kahoots
+    except exceptions.InvalidCursorException as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
-    finally:
-        if con:
-            con.close()
 
 @app.get("/kahoots/{kahoot_id}", response_model=schemas.Kahoot, status_code=status.HTTP_200_OK)
-def get_kahoot(kahoot_id: int):
-    """get a specific kahoot by id"""
-    con = None
+def get_kahoot(kahoot_id: int, request: Request, response: Response, con=Depends(get_db)):
+    """get a specific kahoot by id, answers 304 when If-None-Match still matches"""
     try:
-        con = get_connection()
+        version = db.get_kahoot_version(con, kahoot_id)
+        if version is None:
+            raise exceptions.KahootNotFoundException(kahoot_id)
+        tag = http_cache.etag("kahoot", kahoot_id, version)
+        cached = http_cache.not_modified(request, tag)
+        if cached:
+            return cached
         kahoot = db.get_kahoot(con, kahoot_id)
-        if not kahoot:
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Kahoot not found")
+        response.headers.update(http_cache.headers(tag))
         return kahoot
+    except exceptions.KahootNotFoundException as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
-    finally:
-        if con:
-            con.close()
     
+@app.get("/kahoots/{kahoot_id}/full", response_model=schemas.KahootFull, status_code=status.HTTP_200_OK)
+def get_kahoot_full(kahoot_id: int, request: Request, response: Response, con=Depends(get_db)):
+    """get a kahoot with all of its questions, their answers and media, for playing or editing it"""
+    try:
+        version = db.get_kahoot_version(con, kahoot_id)
+        if version is None:
+            raise exceptions.KahootNotFoundException(kahoot_id)
+        tag = http_cache.etag("kahoot-full", kahoot_id, version)
+        cached = http_cache.not_modified(request, tag)
+        if cached:
+            return cached
+        kahoot = db.get_kahoot_full(con, kahoot_id)
+        response.headers.update(http_cache.headers(tag))
+        return kahoot
+    except exceptions.KahootNotFoundException as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+
 @app.post("/kahoots/", status_code=status.HTTP_201_CREATED)
-def create_kahoot(kahoot: schemas.KahootCreate):
+def create_kahoot(kahoot: schemas.KahootCreate, con=Depends(get_db)):
     """create a new kahoot"""
-    con = None
     try:
-        con = get_connection()
         kahoot_id = db.create_kahoot(con, kahoot)
         return {"id": kahoot_id, "message": "Kahoot created successfully"}
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
-    finally:
-        if con:
-            con.close()
+
+
+@app.post("/kahoots:import", response_model=schemas.ImportedKahoot, status_code=status.HTTP_201_CREATED)
+def import_kahoot(kahoot: schemas.KahootImport, con=Depends(get_db)):
+    """create a kahoot with all of its questions and answers in one transaction, returns every generated id"""
+    try:
+        return db.import_kahoot(con, kahoot)
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
     
 @app.delete("/kahoots/{kahoot_id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_kahoot(kahoot_id: int):
+def delete_kahoot(kahoot_id: int, con=Depends(get_db)):
     """delete a kahoot by id"""
-    con = None
     try:
-        con = get_connection()
         db.delete_kahoot(con, kahoot_id)
         return {"message": "Kahoot deleted successfully"}
     except exceptions.ResourceNotFoundException as e:
@@ -81,16 +219,11 @@ def delete_kahoot(kahoot_id: int):
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
         )
-    finally:
-        if con:
-            con.close()
 
 @app.put("/kahoots/{kahoot_id}", status_code=status.HTTP_200_OK)
-def update_kahoot(kahoot_id: int, kahoot: schemas.KahootCreate = Body(...)):
+def update_kahoot(kahoot_id: int, kahoot: schemas.KahootCreate = Body(...), con=Depends(get_db)):
     """update a kahoot"""
-    con = None
     try:
-        con = get_connection()
         update_kahoot = db.update_kahoot(con, kahoot_id, kahoot)
         return {"id": update_kahoot, "message": "Kahoot updated successfully"}
 
@@ -100,63 +233,49 @@ def update_kahoot(kahoot_id: int, kahoot: schemas.KahootCreate = Body(...)):
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
-    finally:
-        if con:
-            con.close()
 
 
 #questions endpoints
 
 @app.get("/kahoots/{kahoot_id}/questions/", response_model=List[schemas.Question], status_code=status.HTTP_200_OK)
-def get_questions(kahoot_id: int):
-    """get all questions for a specific kahoot"""
-    con = None
+def get_questions(kahoot_id: int, request: Request, response: Response, con=Depends(get_db)):
+    """get all questions for a specific kahoot, answers 304 when If-None-Match still matches"""
     try:
-        con = get_connection()
+        version = db.get_kahoot_version(con, kahoot_id)
+        tag = http_cache.etag("questions", kahoot_id, version)
+        cached = http_cache.not_modified(request, tag)
+        if cached:
+            return cached
         questions = db.get_all_questions_quiz(con, kahoot_id)
+        response.headers.update(http_cache.headers(tag))
         return questions
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
-    finally:
-        if con:
-            con.close()
 
 @app.get("/kahoots/{kahoot_id}/questions/{question_id}", response_model=schemas.Question, status_code=status.HTTP_200_OK)
-def get_question(kahoot_id: int, question_id: int):
+def get_question(kahoot_id: int, question_id: int, con=Depends(get_db)):
     """get a specific question by id for a specific kahoot"""
-    con = None
     try:
-        con = get_connection()
         question = db.get_question(con, kahoot_id, question_id)
         if not question:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Question not found")
         return question
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
-    finally:
-        if con:
-            con.close()
 
 @app.post("/questions/", status_code=status.HTTP_201_CREATED)
-def create_question(question: schemas.QuestionCreate):
+def create_question(question: schemas.QuestionCreate, con=Depends(get_db)):
     """create a new question for a specific kahoot"""
-    con = None
     try:
-        con = get_connection()
         question_id = db.create_question(con, question)
         return {"id": question_id, "message": "Question created successfully"}
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
-    finally:
-        if con:
-            con.close()
 
 @app.put("/questions/{question_id}", status_code=status.HTTP_200_OK)
-def update_question(question_id: int, question: schemas.QuestionCreate):
+def update_question(question_id: int, question: schemas.QuestionCreate, con=Depends(get_db)):
     """update a question by id"""
-    con = None
     try:
-        con = get_connection()
         updated_question_id = db.update_question(
             con,
             question_id,
@@ -169,16 +288,11 @@ def update_question(question_id: int, question: schemas.QuestionCreate):
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
-    finally:
-        if con:
-            con.close()
 
 @app.delete("/questions/{question_id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_question(question_id: int):
+def delete_question(question_id: int, con=Depends(get_db)):
     """delete a question by id"""
-    con = None
     try:
-        con = get_connection()
         deleted_id = db.delete_question(con, question_id)
         return {"id": deleted_id, "message": "Question deleted successfully"}
     except exceptions.ResourceNotFoundException as e:
@@ -189,9 +303,6 @@ def delete_question(question_id: int):
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
         )
-    finally:
-        if con:
-            con.close()
     
 
 #answers endpoints
@@ -201,45 +312,33 @@ def delete_question(question_id: int):
     response_model=List[schemas.Answer],
     status_code=status.HTTP_200_OK,
 )
-def get_answers_by_question(question_id: int):
+def get_answers_by_question(question_id: int, con=Depends(get_db)):
     """Get all answers for a specific question"""
-    con = None
     try:
-        con = get_connection()
         answers = db.get_answers_by_question(con, question_id)
         return answers
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
         )
-    finally:
-        if con:
-            con.close()
 
 
 @app.post("/answers/", status_code=status.HTTP_201_CREATED)
-def create_answer(answer: schemas.AnswerCreate):
+def create_answer(answer: schemas.AnswerCreate, con=Depends(get_db)):
     """Create a new answer"""
-    con = None
     try:
-        con = get_connection()
         answer_id = db.create_answer(con, answer)
         return {"id": answer_id, "message": "Answer created successfully"}
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
         )
-    finally:
-        if con:
-            con.close()
 
 
 @app.put("/answers/{answer_id}", status_code=status.HTTP_200_OK)
-def update_answer(answer_id: int, answer: schemas.AnswerCreate):
+def update_answer(answer_id: int, answer: schemas.AnswerCreate, con=Depends(get_db)):
     """Update an answer"""
-    con = None
     try:
-        con = get_connection()
         updated_id = db.update_answer(
             con, answer_id, answer.answer_text, answer.is_correct
         )
@@ -250,17 +349,12 @@ def update_answer(answer_id: int, answer: schemas.AnswerCreate):
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
         )
-    finally:
-        if con:
-            con.close()
 
 
 @app.delete("/answers/{answer_id}", status_code=status.HTTP_200_OK)
-def delete_answer(answer_id: int):
+def delete_answer(answer_id: int, con=Depends(get_db)):
     """Delete an answer"""
-    con = None
     try:
-        con = get_connection()
         deleted_id = db.delete_answer(con, answer_id)
         return {"id": deleted_id, "message": "Answer deleted successfully"}
     except exceptions.AnswerNotFoundException as e:
@@ -269,99 +363,101 @@ def delete_answer(answer_id: int):
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
         )
-    finally:
-        if con:
-            con.close()
 
 
 # player/participant endpoints
 
 
 @app.get("/game-sessions/{game_session_id}/participants/", response_model=List[schemas.Participant], status_code=status.HTTP_200_OK)
-def get_participants(game_session_id: int):
+def get_participants(game_session_id: int, con=Depends(get_db)):
     """Get all participants for a game session"""
-    con = None
     try:
-        con = get_connection()
+        if fast_json.enabled():
+            columns, rows = db.get_participant_rows(con, game_session_id)
+            return fast_json.response(schemas.Participant, rows, columns)
         participants = db.get_participants(con, game_session_id)
         return participants
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
-    finally:
-        if con:
-            con.close()
 
 
 @app.get("/participants/{participant_id}", response_model=schemas.Participant, status_code=status.HTTP_200_OK)
-def get_participant(participant_id: int):
+def get_participant(participant_id: int, con=Depends(get_db)):
     """Get a single participant by ID"""
-    con = None
     try:
-        con = get_connection()
         participant = db.get_participant(con, participant_id)
         return participant
     except exceptions.PlayerNotFoundException as e:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
-    finally:
-        if con:
-            con.close()
+
+
+async def get_join_db():
+    """like get_db, but joins written by participant_joins don't need a connection of their own"""
+    if participant_joins.enabled():
+        yield None
+        return
+    try:
+        async with lend_connection() as con:
+            yield con
+    except exceptions.ConnectionPoolExhaustedException as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e))
 
 
 @app.post("/participants/", status_code=status.HTTP_201_CREATED)
-def create_participant(participant: schemas.ParticipantCreate):
+def create_participant(participant: schemas.ParticipantCreate, con=Depends(get_join_db)):
     """Create a new participant (join a game session)"""
-    con = None
     try:
-        con = get_connection()
-        participant_id = db.create_participant(con, participant)
+        if con is None:
+            participant_id = participant_joins.joins.join(participant)
+        else:
+            participant_id = db.create_participant(con, participant)
         return {"id": participant_id, "message": "Participant created successfully"}
+    except exceptions.GameSessionNotFoundException as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+    except (exceptions.ConnectionPoolExhaustedException, TimeoutError) as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e) or "Joining timed out")
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
-    finally:
-        if con:
-            con.close()
+
+
+@app.post("/game-sessions/{session_id}/participants:batch", status_code=status.HTTP_201_CREATED)
+def create_participants(session_id: int, batch: schemas.ParticipantBatchCreate, con=Depends(get_db)):
+    """Join many players to a game session at once, with a single insert"""
+    participants = [
+        schemas.ParticipantCreate(game_session_id=session_id, **join.model_dump()) for join in batch.participants
+    ]
+    try:
+        created = db.create_participants(con, participants)
+        return {"participants": created, "message": f"{len(created)} participants created successfully"}
+    except exceptions.GameSessionNotFoundException as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+
 
 @app.delete("/participants/{participant_id}", status_code=status.HTTP_200_OK)
-def delete_participant(participant_id: int):
+def delete_participant(participant_id: int, con=Depends(get_db)):
     """Delete a participant (when they leave the game session)"""
-    con = None
     try:
-        con = get_connection()
         deleted_id = db.delete_participant(con, participant_id)
         return {"id": deleted_id, "message": "Participant removed successfully"}
     except exceptions.PlayerNotFoundException as e:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
-    finally:
-        if con:
-            con.close()
 
 @app.put("/participants/{participant_id}/username", status_code=status.HTTP_200_OK)
-def update_participant_username(participant_id: int, new_username: str):
+def update_participant_username(participant_id: int, new_username: str, con=Depends(get_db)):
     """Update participant's username"""
-    con = None
     try:
-        con = get_connection()
-        cursor = con.cursor()
-        cursor.execute(
-            "UPDATE participants SET username = %s WHERE id = %s RETURNING id;",
-            (new_username, participant_id)
-        )
-        result = cursor.fetchone()
-        if not result:
-            raise exceptions.PlayerNotFoundException(participant_id)
-        con.commit()
-        return {"id": result[0], "message": "Username updated successfully"}
+        updated_id = db.update_participant_username(con, participant_id, new_username)
+        return {"id": updated_id, "message": "Username updated successfully"}
     except exceptions.PlayerNotFoundException as e:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
-    finally:
-        if con:
-            con.close()
 
 # game seession endpoints
 
@@ -371,20 +467,35 @@ def update_participant_username(participant_id: int, new_username: str):
     response_model=List[schemas.GameSession],
     status_code=status.HTTP_200_OK,
 )
-def get_all_game_sessions():
-    """Get all game sessions"""
-    con = None
+def get_all_game_sessions(
+    request: Request,
+    response: Response,
+    limit: int = Query(pagination.DEFAULT_PAGE_SIZE, ge=1, le=pagination.MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    kahoot_id: Optional[int] = None,
+    is_active: Optional[bool] = None,
+    started_after: Optional[datetime] = None,
+    started_before: Optional[datetime] = None,
+    con=Depends(get_db),
+):
+    """Get a page of game sessions, newest first, the Link header points at the next page"""
     try:
-        con = get_connection()
-        sessions = db.get_game_sessions(con)
+        after = pagination.decode_cursor(cursor) if cursor else None
+        sessions = db.get_game_sessions(
+            con, after, limit + 1, kahoot_id, is_active, pagination.as_utc(started_after), pagination.as_utc(started_before)
+        )
+        sessions, next_cursor = pagination.split_page(sessions, limit, "started_at")
+        headers = {"Link": pagination.link_header(request, next_cursor)} if next_cursor else {}
+        if fast_json.enabled():
+            return fast_json.response(schemas.GameSession, sessions, headers=headers)
+        response.headers.update(headers)
         return sessions
+    except exceptions.InvalidCursorException as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
         )
-    finally:
-        if con:
-            con.close()
 
 
 @app.get(
@@ -392,11 +503,9 @@ def get_all_game_sessions():
     response_model=schemas.GameSession,
     status_code=status.HTTP_200_OK,
 )
-def get_game_session(session_id: int):
+def get_game_session(session_id: int, con=Depends(get_db)):
     """Get a single game session by ID"""
-    con = None
     try:
-        con = get_connection()
         session = db.get_game_session(con, session_id)
         return session
     except exceptions.GameSessionNotFoundException as e:
@@ -405,9 +514,6 @@ def get_game_session(session_id: int):
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
         )
-    finally:
-        if con:
-            con.close()
 
 
 @app.get(
@@ -415,11 +521,9 @@ def get_game_session(session_id: int):
     response_model=schemas.GameSession,
     status_code=status.HTTP_200_OK,
 )
-def get_game_session_by_pin(pin: str):
+def get_game_session_by_pin(pin: str, con=Depends(get_db)):
     """Get a game session by PIN"""
-    con = None
     try:
-        con = get_connection()
         session = db.get_game_session_by_pin(con, pin)
         return session
     except exceptions.GameSessionNotFoundException as e:
@@ -428,113 +532,139 @@ def get_game_session_by_pin(pin: str):
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
         )
-    finally:
-        if con:
-            con.close()
 
 
 @app.post("/game-sessions/", status_code=status.HTTP_201_CREATED)
-def create_game_session(session: schemas.GameSessionCreate):
-    """Create a new game session"""
-    con = None
+def create_game_session(session: schemas.GameSessionCreate, con=Depends(get_db)):
+    """Create a new game session, the server picks a free PIN when none is given"""
     try:
-        con = get_connection()
-        session_id = db.create_game_session(con, session)
-        return {"id": session_id, "message": "Game session created successfully"}
+        created = db.create_game_session(con, session)
+        return {"id": created["id"], "session_pin": created["session_pin"], "message": "Game session created successfully"}
+    except exceptions.SessionPinInUseException as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    except exceptions.NoFreeSessionPinException as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e))
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
         )
-    finally:
-        if con:
-            con.close()
 
 
 @app.put("/game-sessions/{session_id}/end", status_code=status.HTTP_200_OK)
-def end_game_session(session_id: int):
+def end_game_session(session_id: int, con=Depends(get_db)):
     """End a game session"""
-    con = None
     try:
-        con = get_connection()
         ended_id = db.end_game_session(con, session_id)
         return {"id": ended_id, "message": "Game session ended successfully"}
     except exceptions.GameSessionNotFoundException as e:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+    except exceptions.AnswersNotWrittenException as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e), headers={"Retry-After": "1"})
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
         )
-    finally:
-        if con:
-            con.close()
     
 @app.delete("/game-sessions/{session_id}", status_code=status.HTTP_200_OK)
-def delete_game_session(session_id: int):
+def delete_game_session(session_id: int, con=Depends(get_db)):
     """Delete a game session"""
-    con = None
     try:
-        con = get_connection()
-        cursor = con.cursor()
-        cursor.execute(
-            "DELETE FROM game_sessions WHERE id = %s RETURNING id;",
-            (session_id,)
-        )
-        result = cursor.fetchone()
-        if not result:
-            raise exceptions.GameSessionNotFoundException(session_id)
-        con.commit()
-        return {"id": result[0], "message": "Game session deleted successfully"}
+        deleted_id = db.delete_game_session(con, session_id)
+        return {"id": deleted_id, "message": "Game session deleted successfully"}
     except exceptions.GameSessionNotFoundException as e:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
-    finally:
-        if con:
-            con.close()
 
 @app.patch("/game-sessions/{session_id}/active", status_code=status.HTTP_200_OK)
-def update_game_session_active(session_id: int, is_active: bool):
+def update_game_session_active(session_id: int, is_active: bool, con=Depends(get_db)):
     """Toggle game session active status (PATCH = partial update)"""
-    con = None
     try:
-        con = get_connection()
-        cursor = con.cursor()
-        cursor.execute(
-            "UPDATE game_sessions SET is_active = %s WHERE id = %s RETURNING id;",
-            (is_active, session_id)
-        )
-        result = cursor.fetchone()
-        if not result:
-            raise exceptions.GameSessionNotFoundException(session_id)
-        con.commit()
-        return {"id": result[0], "message": "Active status updated successfully"}
+        updated_id = db.set_game_session_active(con, session_id, is_active)
+        return {"id": updated_id, "message": "Active status updated successfully"}
     except exceptions.GameSessionNotFoundException as e:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+    except exceptions.SessionPinInUseException as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    except exceptions.AnswersNotWrittenException as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e), headers={"Retry-After": "1"})
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
-    finally:
-        if con:
-            con.close()
+
+
+@app.put("/game-sessions/{session_id}/questions/{question_id}", status_code=status.HTTP_200_OK)
+def start_question(session_id: int, question_id: int, con=Depends(get_db)):
+    """Move a live game session on to the next question, pushed to every connected player"""
+    try:
+        started_id = db.start_question(con, session_id, question_id)
+        return {"id": started_id, "message": "Question started"}
+    except exceptions.QuestionNotFoundException as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+
+
+@app.get(
+    "/game-sessions/{session_id}/questions/{question_id}/distribution",
+    response_model=schemas.AnswerDistribution,
+    status_code=status.HTTP_200_OK,
+)
+def get_answer_distribution(session_id: int, question_id: int, con=Depends(get_db)):
+    """How many players picked each answer of a question so far, and how long they took on average"""
+    try:
+        return db.get_answer_distribution(con, session_id, question_id)
+    except exceptions.QuestionNotFoundException as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+
+
+@app.websocket("/game-sessions/{session_id}/ws")
+async def session_updates(websocket: WebSocket, session_id: int):
+    """
+    Live updates of a game session: a snapshot of the leaderboard first, then the leaderboard
+    entries that changed, question transitions and the end of the session
+    """
+    try:
+        session = await run_in_threadpool(_find_game_session, session_id)
+    except exceptions.GameSessionNotFoundException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    await session_events.serve(websocket, session_id, session["is_active"])
+
+
+def _find_game_session(session_id: int):
+    # a connection only for the lookup, the socket itself doesn't hold one while it's open
+    with db_setup.pooled_connection() as con:
+        return db.get_game_session(con, session_id)
 
 #player score endpoint
 
 
 @app.post("/player-answers/", status_code=status.HTTP_201_CREATED)
-def submit_answer(player_answer: schemas.PlayerAnswerCreate):
-    con = None
+def submit_answer(player_answer: schemas.PlayerAnswerCreate, con=Depends(get_db)):
     try:
-        con = get_connection()
+        if answer_buffer.enabled():
+            # scored now, written to the database by the buffer's flusher a moment later
+            points_earned = db.score_answer(con, player_answer)
+            # the flusher puts it on the live leaderboard once it's written
+            answer_buffer.answers.submit(player_answer, points_earned)
+            return JSONResponse(
+                status_code=status.HTTP_202_ACCEPTED,
+                content={"id": None, "points_earned": points_earned, "message": "Answer accepted"},
+            )
         score_id = db.submit_answer(con, player_answer)
         return {"id": score_id, "message": "Answer submitted successfully"}
     except exceptions.AnswerNotFoundException as e:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+    except exceptions.GameSessionNotLiveException as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    except (exceptions.AnswerBufferFullException, exceptions.AnswerBufferStoppedException) as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e), headers={"Retry-After": "1"})
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
         )
-    finally:
-        if con:
-            con.close()
 
 
 @app.get(
@@ -542,20 +672,40 @@ def submit_answer(player_answer: schemas.PlayerAnswerCreate):
     response_model=List[schemas.LeaderboardEntry],
     status_code=status.HTTP_200_OK,
 )
-def get_leaderboard(session_id: int):
-    """Get the leaderboard for a game session"""
-    con = None
+def get_leaderboard(session_id: int, limit: Optional[int] = Query(None, ge=1), con=Depends(get_db)):
+    """Get the leaderboard for a game session, ?limit= returns only the top entries"""
     try:
-        con = get_connection()
-        leaderboard = db.get_leaderboard(con, session_id)
+        if fast_json.enabled():
+            columns, rows = db.get_leaderboard_rows(con, session_id, limit)
+            return fast_json.response(schemas.LeaderboardEntry, rows, columns)
+        leaderboard = db.get_leaderboard(con, session_id, limit)
         return leaderboard
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
         )
-    finally:
-        if con:
-            con.close()
+
+
+@app.get(
+    "/game-sessions/{session_id}/participants/{participant_id}/rank",
+    response_model=schemas.ParticipantRank,
+    status_code=status.HTTP_200_OK,
+)
+def get_participant_rank(
+    session_id: int,
+    participant_id: int,
+    neighbours: int = Query(2, ge=0, le=25),
+    con=Depends(get_db),
+):
+    """Get a participant's rank and score, plus the players right above and below them"""
+    try:
+        return db.get_participant_rank(con, session_id, participant_id, neighbours)
+    except exceptions.PlayerNotFoundException as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
+        )
 
 
 @app.get(
@@ -563,36 +713,89 @@ def get_leaderboard(session_id: int):
     response_model=List[schemas.PlayerAnswer],
     status_code=status.HTTP_200_OK,
 )
-def get_player_scores(session_id: int, participant_id: int):
+def get_player_scores(session_id: int, participant_id: int, con=Depends(get_db)):
     """Get all scores for a specific player in a game session"""
-    con = None
     try:
-        con = get_connection()
         scores = db.get_participant_answers(con, session_id, participant_id)
         return scores
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
         )
-    finally:
-        if con:
-            con.close()
+
+
+def _export(chunks, kind: str, resource_id: int, format: str):
+    """start an export and stream it, the first chunk is read here so a missing resource is still a 404"""
+    try:
+        first = next(chunks)
+    except exceptions.ResourceNotFoundException as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+    except exceptions.ConnectionPoolExhaustedException as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+    return StreamingResponse(
+        itertools.chain([first], chunks),
+        media_type=exports.MEDIA_TYPES[format],
+        headers=exports.filename(kind, resource_id, format),
+    )
+
+
+@app.get("/game-sessions/{session_id}/export", status_code=status.HTTP_200_OK)
+def export_session(session_id: int, format: str = Query("ndjson", pattern="^(ndjson|csv)$")):
+    """Stream every answer of a game session as NDJSON or CSV"""
+    return _export(exports.stream(db.export_session_answers, session_id, format), "session", session_id, format)
+
+
+@app.get("/kahoots/{kahoot_id}/export", status_code=status.HTTP_200_OK)
+def export_kahoot(kahoot_id: int, format: str = Query("ndjson", pattern="^(ndjson|csv)$")):
+    """Stream every answer of every session played with a kahoot as NDJSON or CSV"""
+    return _export(exports.stream(db.export_kahoot_answers, kahoot_id, format), "kahoot", kahoot_id, format)
 
 @app.patch("/participants/{participant_id}/score", status_code=status.HTTP_200_OK)
-def update_participant_score(participant_id: int, final_score: int):
+def update_participant_score(participant_id: int, final_score: int, con=Depends(get_db)):
     """Update only the participant's score (PATCH = partial update)"""
-    con = None
     try:
-        con = get_connection()
         updated_id = db.update_participant_score(con, participant_id, final_score)
         return {"id": updated_id, "message": "Score updated successfully"}
     except exceptions.PlayerNotFoundException as e:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
-    finally:
-        if con:
-            con.close()
+
+def require_admin_token(x_admin_token: Optional[str] = Header(None)):
+    if not slow_queries.authorized(x_admin_token):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="A valid X-Admin-Token header is required")
+
+
+# only there with SLOW_QUERY_MS and SLOW_QUERY_ADMIN_TOKEN set, the entries hold the parameters of real requests
+if slow_queries.admin_enabled():
+
+    @app.get(
+        "/admin/slow-queries",
+        status_code=status.HTTP_200_OK,
+        dependencies=[Depends(require_admin_token)],
+        include_in_schema=False,
+    )
+    def get_slow_queries(limit: Optional[int] = Query(None, ge=1)):
+        """The recent statements slower than SLOW_QUERY_MS, newest first, a sample of them with their plan"""
+        return slow_queries.slow_queries.entries(limit)
+
+    @app.delete(
+        "/admin/slow-queries",
+        status_code=status.HTTP_204_NO_CONTENT,
+        dependencies=[Depends(require_admin_token)],
+        include_in_schema=False,
+    )
+    def clear_slow_queries():
+        """Empty the slow query buffer, e.g before a load test"""
+        slow_queries.slow_queries.clear()
+
+
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+def get_metrics():
+    """Request and query metrics in Prometheus' text format"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 @app.get("/", status_code=status.HTTP_200_OK)
 def root():
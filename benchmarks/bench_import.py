@@ -0,0 +1,127 @@
+"""
+Benchmark for POST /kahoots:import against authoring the same quiz one item at a time.
+Creates a throwaway schema, then builds quizzes of --questions questions with --answers answers each
+through the api: once with POST /kahoots/, /questions/ and /answers/ (1 + q + q * a requests, each
+its own transaction) and once with a single POST /kahoots:import. The requests go through FastAPI's
+TestClient, so the numbers include the api but not the network. The schema is dropped afterwards
+unless --keep is given.
+
+    python benchmarks/bench_import.py --quizzes 20 --questions 50 --answers 4
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+SCHEMA = "bench_import"
+# every connection opened from here on, including the ones db_setup opens, works inside the benchmark schema
+os.environ["PGOPTIONS"] = f"-c search_path={SCHEMA}"
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi.testclient import TestClient
+import db_setup
+import migrate
+
+
+def reset_schema():
+    con = db_setup.get_connection()
+    con.autocommit = True
+    with con.cursor() as cursor:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE;")
+        cursor.execute(f"CREATE SCHEMA {SCHEMA};")
+    con.close()
+
+
+def drop_schema():
+    con = db_setup.get_connection()
+    con.autocommit = True
+    with con.cursor() as cursor:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE;")
+    con.close()
+
+
+def quiz(number: int, questions: int, answers: int):
+    """an import document, the per item path sends the same content"""
+    return {
+        "title": f"bench quiz {number}",
+        "category": "bench",
+        "questions": [
+            {
+                "question_text": f"question {q}",
+                "time_limit": 30,
+                "points": 1000,
+                "answers": [{"answer_text": f"answer {a}", "is_correct": a == 0} for a in range(answers)],
+            }
+            for q in range(questions)
+        ],
+    }
+
+
+def check(response):
+    if response.status_code != 201:
+        raise SystemExit(f"{response.request.method} {response.request.url} failed: {response.text}")
+    return response.json()
+
+
+def per_item(client, document):
+    kahoot_id = check(client.post("/kahoots/", json={"title": document["title"], "category": document["category"]}))["id"]
+    requests = 1
+    for question in document["questions"]:
+        fields = {key: value for key, value in question.items() if key != "answers"}
+        question_id = check(client.post("/questions/", json=dict(fields, kahoot_id=kahoot_id)))["id"]
+        requests += 1
+        for answer in question["answers"]:
+            check(client.post("/answers/", json=dict(answer, question_id=question_id)))
+            requests += 1
+    return requests
+
+
+def bulk(client, document):
+    check(client.post("/kahoots:import", json=document))
+    return 1
+
+
+def measure(client, run, quizzes: int, questions: int, answers: int):
+    timings = []
+    requests = 0
+    for number in range(quizzes):
+        document = quiz(number, questions, answers)
+        started = time.perf_counter()
+        requests = run(client, document)
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings), max(timings), requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--quizzes", type=int, default=20, help="quizzes built with each path")
+    parser.add_argument("--questions", type=int, default=50, help="questions per quiz")
+    parser.add_argument("--answers", type=int, default=4, help="answers per question")
+    parser.add_argument("--app", choices=("app", "app_async"), default="app")
+    parser.add_argument("--keep", action="store_true", help="keep the benchmark schema afterwards")
+    args = parser.parse_args()
+
+    reset_schema()
+    try:
+        migrate.migrate()
+        api = __import__(args.app)
+        with TestClient(api.app) as client:
+            bulk(client, quiz(-1, 1, 1))  # warm up the pool
+            results = {
+                "per item": measure(client, per_item, args.quizzes, args.questions, args.answers),
+                "import": measure(client, bulk, args.quizzes, args.questions, args.answers),
+            }
+        print(f"{args.quizzes} quizzes of {args.questions} questions with {args.answers} answers each ({args.app})\n")
+        print(f"{'path':<12}{'requests':>10}{'p50 per quiz':>16}{'max per quiz':>16}")
+        for name, (p50, worst, requests) in results.items():
+            print(f"{name:<12}{requests:>10}{p50:>14.1f}ms{worst:>14.1f}ms")
+        print(f"\nimport is {results['per item'][0] / results['import'][0]:.1f}x faster per quiz")
+    finally:
+        if not args.keep:
+            drop_schema()
+
+
+if __name__ == "__main__":
+    main()
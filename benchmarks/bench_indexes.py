@@ -0,0 +1,250 @@
+"""
+Benchmark for the secondary indexes of migrations/0003_secondary_indexes.sql.
+Seeds a throwaway schema with a few hundred finished games, then times the read functions of db.py
+and EXPLAINs every statement they send, first with the schema migrated up to just before the
+indexes and again after the index migration. The schema is dropped afterwards unless --keep is given.
+
+    python benchmarks/bench_indexes.py --kahoots 200 --players 20 --iterations 200
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+SCHEMA = "bench_indexes"
+# every connection opened from here on, including the ones db_setup opens, works inside the benchmark schema
+os.environ["PGOPTIONS"] = f"-c search_path={SCHEMA}"
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import psycopg2
+import psycopg2.extensions
+import db
+import db_setup
+import migrate
+from answer_cache import answer_keys
+from leaderboard import leaderboards
+
+# the leaderboard functions have to hit SQL, not the in-memory boards
+db.LIVE_LEADERBOARD = False
+
+INDEX_MIGRATION = 3
+
+SCAN_NODES = ("Seq Scan", "Index Scan", "Index Only Scan", "Bitmap Heap Scan", "Bitmap Index Scan")
+
+
+class RecordingConnection(psycopg2.extensions.connection):
+    """a connection that remembers every statement its cursors execute, so they can be EXPLAINed"""
+
+    statements = None
+
+    def cursor(self, *args, cursor_factory=None, **kwargs):
+        base = cursor_factory or psycopg2.extensions.cursor
+        connection = self
+
+        class RecordingCursor(base):
+            def execute(self, query, vars=None):
+                if connection.statements is not None:
+                    connection.statements.append(self.mogrify(query, vars).decode())
+                return super().execute(query, vars)
+
+        return super().cursor(*args, cursor_factory=RecordingCursor, **kwargs)
+
+
+def reset_schema():
+    con = db_setup.get_connection()
+    con.autocommit = True
+    with con.cursor() as cursor:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE;")
+        cursor.execute(f"CREATE SCHEMA {SCHEMA};")
+    con.close()
+
+
+def drop_schema():
+    con = db_setup.get_connection()
+    con.autocommit = True
+    with con.cursor() as cursor:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE;")
+    con.close()
+
+
+def seed(kahoots: int, questions: int, sessions: int, players: int):
+    """finished games: every player answered every question of their kahoot, in random order across sessions"""
+    con = db_setup.get_connection()
+    with con:
+        with con.cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO kahoots (title, category) SELECT 'bench ' || g, 'bench' FROM generate_series(1, %s) g;",
+                (kahoots,),
+            )
+            cursor.execute(
+                """INSERT INTO questions (kahoot_id, question_text, question_type, time_limit, points)
+                SELECT k.id, 'question ' || g, 'multiple_choice', 30, 1000
+                FROM kahoots k, generate_series(1, %s) g;""",
+                (questions,),
+            )
+            cursor.execute(
+                """INSERT INTO answers (question_id, answer_text, is_correct)
+                SELECT q.id, 'answer ' || g, g = 1 FROM questions q, generate_series(1, 4) g;"""
+            )
+            cursor.execute(
+                """INSERT INTO game_sessions (kahoot_id, session_pin, is_active)
+                SELECT k.id, (k.id * 100 + g)::text, TRUE FROM kahoots k, generate_series(1, %s) g;""",
+                (sessions,),
+            )
+            cursor.execute(
+                """INSERT INTO participants (game_session_id, username)
+                SELECT s.id, 'player ' || g FROM game_sessions s, generate_series(1, %s) g;""",
+                (players,),
+            )
+            cursor.execute(
+                """INSERT INTO player_answers (session_id, participant_id, question_id, answer_id, time_taken, points_earned)
+                SELECT p.game_session_id, p.id, q.id, a.id, 10, CASE WHEN a.is_correct THEN 900 ELSE 0 END
+                FROM participants p
+                JOIN game_sessions s ON s.id = p.game_session_id
+                JOIN questions q ON q.kahoot_id = s.kahoot_id
+                JOIN answers a ON a.question_id = q.id AND a.answer_text = 'answer ' || (1 + mod(p.id + q.id, 4))
+                ORDER BY random();"""
+            )
+            cursor.execute("SELECT COUNT(*) FROM player_answers;")
+            answers = cursor.fetchone()[0]
+    con.close()
+    return answers
+
+
+def vacuum_analyze():
+    # also sets the visibility map, which index only scans need
+    con = db_setup.get_connection()
+    con.autocommit = True
+    with con.cursor() as cursor:
+        cursor.execute("VACUUM ANALYZE;")
+    con.close()
+
+
+def pick_ids(con, samples: int):
+    with con:
+        with con.cursor() as cursor:
+            cursor.execute("SELECT id FROM kahoots ORDER BY random() LIMIT %s;", (samples,))
+            kahoot_ids = [row[0] for row in cursor.fetchall()]
+            cursor.execute("SELECT id FROM questions ORDER BY random() LIMIT %s;", (samples,))
+            question_ids = [row[0] for row in cursor.fetchall()]
+            cursor.execute("SELECT game_session_id, id FROM participants ORDER BY random() LIMIT %s;", (samples,))
+            players = cursor.fetchall()
+    return kahoot_ids, question_ids, players
+
+
+def cases(kahoot_ids, question_ids, players):
+    """db function name -> a call of it with randomly picked ids"""
+
+    def load_answer_key(con):
+        with con:
+            db.load_answer_key(con, random.choice(kahoot_ids))
+        answer_keys.clear()
+
+    def load_leaderboard(con):
+        db.load_leaderboard(con, random.choice(players)[0])
+        leaderboards.clear()
+
+    return {
+        "get_all_questions_quiz": lambda con: db.get_all_questions_quiz(con, random.choice(kahoot_ids)),
+        "get_answers_by_question": lambda con: db.get_answers_by_question(con, random.choice(question_ids)),
+        "load_answer_key": load_answer_key,
+        "get_participants": lambda con: db.get_participants(con, random.choice(players)[0]),
+        "get_leaderboard": lambda con: db.get_leaderboard(con, random.choice(players)[0]),
+        "get_participant_rank": lambda con: db.get_participant_rank(con, *random.choice(players)),
+        "get_participant_answers": lambda con: db.get_participant_answers(con, *random.choice(players)),
+        "load_leaderboard": load_leaderboard,
+    }
+
+
+def scans(plan):
+    """the scan nodes of an EXPLAIN (FORMAT JSON) plan, e.g 'Seq Scan on player_answers'"""
+    found = []
+    if plan["Node Type"] in SCAN_NODES:
+        target = plan.get("Index Name") or plan.get("Relation Name")
+        found.append(f"{plan['Node Type']} {'using' if 'Index Name' in plan else 'on'} {target}")
+    for child in plan.get("Plans", []):
+        found.extend(scans(child))
+    return found
+
+
+def explain(con, run):
+    """run one call of a db function and EXPLAIN the SELECTs it sent"""
+    con.statements = []
+    run(con)
+    statements, con.statements = con.statements, None
+    plans = []
+    with con:
+        with con.cursor() as cursor:
+            for statement in statements:
+                if not statement.lstrip().upper().startswith(("SELECT", "WITH")):
+                    continue
+                cursor.execute("EXPLAIN (FORMAT JSON) " + statement)
+                plan = cursor.fetchone()[0]
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+                plans.append(", ".join(dict.fromkeys(scans(plan[0]["Plan"]))))
+    return plans
+
+
+def measure(con, runs, iterations: int):
+    results = {}
+    for name, run in runs.items():
+        for _ in range(10):
+            run(con)  # warm up the cache and the connection
+        timings = []
+        for _ in range(iterations):
+            started = time.perf_counter()
+            run(con)
+            timings.append((time.perf_counter() - started) * 1000)
+        results[name] = (statistics.median(timings), statistics.quantiles(timings, n=20)[-1], explain(con, run))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--kahoots", type=int, default=200)
+    parser.add_argument("--questions", type=int, default=10, help="questions per kahoot")
+    parser.add_argument("--sessions", type=int, default=3, help="sessions per kahoot")
+    parser.add_argument("--players", type=int, default=20, help="players per session")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--keep", action="store_true", help="keep the benchmark schema afterwards")
+    args = parser.parse_args()
+
+    reset_schema()
+    try:
+        migrate.migrate(target=INDEX_MIGRATION - 1)
+        started = time.perf_counter()
+        answers = seed(args.kahoots, args.questions, args.sessions, args.players)
+        vacuum_analyze()
+        print(f"seeded {answers} player answers in {time.perf_counter() - started:.1f}s\n")
+
+        con = psycopg2.connect(connection_factory=RecordingConnection, **db_setup._connection_kwargs())
+        runs = cases(*pick_ids(con, 500))
+        before = measure(con, runs, args.iterations)
+        migrate.migrate(target=INDEX_MIGRATION)
+        vacuum_analyze()
+        after = measure(con, runs, args.iterations)
+        con.close()
+
+        print(f"{'function':<26}{'p50 before':>12}{'p50 after':>12}{'p95 before':>12}{'p95 after':>12}{'speedup':>10}")
+        for name in runs:
+            p50_before, p95_before, plans_before = before[name]
+            p50_after, p95_after, plans_after = after[name]
+            print(
+                f"{name:<26}{p50_before:>10.3f}ms{p50_after:>10.3f}ms{p95_before:>10.3f}ms{p95_after:>10.3f}ms"
+                f"{p50_before / p50_after:>9.1f}x"
+            )
+            for plan_before, plan_after in zip(plans_before, plans_after):
+                print(f"    before: {plan_before}")
+                print(f"    after:  {plan_after}")
+    finally:
+        if not args.keep:
+            drop_schema()
+
+
+if __name__ == "__main__":
+    main()
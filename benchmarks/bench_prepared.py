@@ -0,0 +1,158 @@
+"""
+Benchmark for the prepared statements of prepared_statements.py.
+Seeds a throwaway schema with one finished game, then runs every hot statement db.py prepares,
+once as plain SQL and once through PREPARE/EXECUTE, on the same connection, and compares the time
+per call and the planning time Postgres reports for each (EXPLAIN ANALYZE). The schema is dropped
+afterwards unless --keep is given.
+
+    python benchmarks/bench_prepared.py --players 200 --iterations 2000
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+SCHEMA = "bench_prepared"
+# every connection opened from here on, including the ones db_setup opens, works inside the benchmark schema
+os.environ["PGOPTIONS"] = f"-c search_path={SCHEMA}"
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+import db_setup
+import migrate
+import prepared_statements
+
+
+def reset_schema():
+    con = db_setup.get_connection()
+    con.autocommit = True
+    with con.cursor() as cursor:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE;")
+        cursor.execute(f"CREATE SCHEMA {SCHEMA};")
+    con.close()
+
+
+def drop_schema():
+    con = db_setup.get_connection()
+    con.autocommit = True
+    with con.cursor() as cursor:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE;")
+    con.close()
+
+
+def seed(con, questions: int, players: int):
+    """one session in which every player answered every question, returns the ids the statements need"""
+    with con:
+        with con.cursor() as cursor:
+            cursor.execute("INSERT INTO kahoots (title, category) VALUES ('bench', 'bench') RETURNING id;")
+            kahoot_id = cursor.fetchone()[0]
+            cursor.execute(
+                """INSERT INTO questions (kahoot_id, question_text, question_type, time_limit, points)
+                SELECT %s, 'question ' || g, 'multiple_choice', 30, 1000 FROM generate_series(1, %s) g;""",
+                (kahoot_id, questions),
+            )
+            cursor.execute(
+                """INSERT INTO answers (question_id, answer_text, is_correct)
+                SELECT q.id, 'answer ' || g, g = 1 FROM questions q, generate_series(1, 4) g;"""
+            )
+            cursor.execute(
+                "INSERT INTO game_sessions (kahoot_id, session_pin) VALUES (%s, '123456') RETURNING id;", (kahoot_id,)
+            )
+            session_id = cursor.fetchone()[0]
+            cursor.execute(
+                """INSERT INTO participants (game_session_id, username)
+                SELECT %s, 'player ' || g FROM generate_series(1, %s) g;""",
+                (session_id, players),
+            )
+            cursor.execute(
+                """INSERT INTO player_answers (session_id, participant_id, question_id, answer_id, time_taken, points_earned)
+                SELECT %s, p.id, q.id, a.id, 10, CASE WHEN a.is_correct THEN 900 ELSE 0 END
+                FROM participants p, questions q JOIN answers a ON a.question_id = q.id
+                WHERE a.answer_text = 'answer ' || (1 + mod(q.id, 4));""",
+                (session_id,),
+            )
+            cursor.execute("SELECT id FROM participants LIMIT 1;")
+            participant_id = cursor.fetchone()[0]
+            cursor.execute("SELECT q.id, a.id FROM questions q JOIN answers a ON a.question_id = q.id LIMIT 1;")
+            question_id, answer_id = cursor.fetchone()
+        with con.cursor() as cursor:
+            cursor.execute("ANALYZE;")
+    return session_id, participant_id, question_id, answer_id
+
+
+def cases(session_id, participant_id, question_id, answer_id):
+    """registered statement -> the parameters of a typical call"""
+    return {
+        db.GET_PARTICIPANT: (participant_id,),
+        db.GET_RUNNING_PARTICIPANT: (participant_id,),
+        db.GET_PARTICIPANT_USERNAME: (participant_id,),
+        db.GET_GAME_SESSION_BY_PIN: ("123456",),
+        db.GET_SESSION_KAHOOT: (session_id,),
+        db.GET_ANSWER_CORRECT: (answer_id,),
+        db.GET_LEADERBOARD: (session_id, 10, session_id, session_id, 10, session_id),
+        db.RECORD_PLAYER_ANSWER: (session_id, participant_id, question_id, answer_id, 5.0, 750, True),
+        db.SUBMIT_PLAYER_ANSWER: (session_id, participant_id, question_id, answer_id, 5.0, True),
+    }
+
+
+def timed(con, run, iterations: int):
+    """microseconds per call, every call in its own transaction like in the api"""
+    for _ in range(20):
+        with con:
+            with con.cursor() as cursor:
+                run(cursor)
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        with con:
+            with con.cursor() as cursor:
+                run(cursor)
+                cursor.fetchall()
+        timings.append((time.perf_counter() - started) * 1_000_000)
+    return statistics.median(timings)
+
+
+def planning_time(con, sql: str, params):
+    """the planning time Postgres reports for one execution, rolled back so writes don't stick"""
+    with con.cursor() as cursor:
+        cursor.execute("EXPLAIN (ANALYZE, FORMAT JSON) " + sql, params)
+        plan = cursor.fetchone()[0]
+    con.rollback()
+    return plan[0]["Planning Time"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--questions", type=int, default=10)
+    parser.add_argument("--players", type=int, default=200)
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--keep", action="store_true", help="keep the benchmark schema afterwards")
+    args = parser.parse_args()
+
+    reset_schema()
+    try:
+        migrate.migrate()
+        con = db_setup.get_connection()
+        runs = cases(*seed(con, args.questions, args.players))
+        prepared_statements.PREPARED_STATEMENTS = True
+
+        print(f"{'statement':<26}{'plain':>10}{'prepared':>12}{'speedup':>9}{'plan plain':>13}{'plan prepared':>15}")
+        for statement, params in runs.items():
+            plain = timed(con, lambda cursor: cursor.execute(statement.sql, params), args.iterations)
+            prepared = timed(con, lambda cursor: prepared_statements.execute(cursor, statement, params), args.iterations)
+            plan_plain = planning_time(con, statement.sql, params)
+            plan_prepared = planning_time(con, statement.execute_sql, params)
+            print(
+                f"{statement.name:<26}{plain:>8.0f}us{prepared:>10.0f}us{plain / prepared:>8.2f}x"
+                f"{plan_plain:>11.3f}ms{plan_prepared:>13.3f}ms"
+            )
+        con.close()
+    finally:
+        if not args.keep:
+            drop_schema()
+
+
+if __name__ == "__main__":
+    main()
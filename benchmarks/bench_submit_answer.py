@@ -0,0 +1,121 @@
+"""
+Micro-benchmark for db.submit_answer.
+Times the current version, one call to the submit_player_answer stored function, against the old three round trip version
+(SELECT is_correct, INSERT player_answers, UPDATE participants) kept below for comparison,
+and checks that both hand out the same points for the same submissions.
+
+    python benchmarks/bench_submit_answer.py --iterations 2000
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from psycopg2.extras import RealDictCursor
+import db
+import db_setup
+import exceptions
+import schemas
+
+
+def submit_answer_three_steps(con, player_answer: schemas.PlayerAnswerCreate):
+    """db.submit_answer as it was before it moved into a stored function"""
+    with con:
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute("SELECT is_correct FROM answers WHERE id = %s;", (player_answer.answer_id,))
+            answer = cursor.fetchone()
+            if not answer:
+                raise exceptions.AnswerNotFoundException(player_answer.answer_id)
+            points_earned = 0
+            if answer["is_correct"]:
+                time_bonus = max(0, 500 - int(player_answer.time_taken * 10))
+                points_earned = 500 + time_bonus
+            cursor.execute(
+                """INSERT INTO player_answers
+                (session_id, participant_id, question_id, answer_id, time_taken, points_earned)
+                VALUES (%s, %s, %s, %s, %s, %s) RETURNING id;""",
+                (
+                    player_answer.session_id,
+                    player_answer.participant_id,
+                    player_answer.question_id,
+                    player_answer.answer_id,
+                    player_answer.time_taken,
+                    points_earned,
+                ),
+            )
+            score_id = cursor.fetchone()["id"]
+            cursor.execute(
+                "UPDATE participants SET final_score = final_score + %s WHERE id = %s;",
+                (points_earned, player_answer.participant_id),
+            )
+    return score_id
+
+
+def seed(con):
+    kahoot_id = db.create_kahoot(con, schemas.KahootCreate(title="benchmark", category="bench"))
+    question_id = db.create_question(con, schemas.QuestionCreate(kahoot_id=kahoot_id, question_text="2 + 2?"))
+    right = db.create_answer(con, schemas.AnswerCreate(question_id=question_id, answer_text="4", is_correct=True))
+    wrong = db.create_answer(con, schemas.AnswerCreate(question_id=question_id, answer_text="5", is_correct=False))
+    with con:
+        with con.cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO game_sessions (kahoot_id, session_pin) VALUES (%s, %s) RETURNING id;",
+                (kahoot_id, f"b{time.time_ns() % 10**7}"),
+            )
+            session_id = cursor.fetchone()[0]
+    participant_id = db.create_participant(con, schemas.ParticipantCreate(game_session_id=session_id))["id"]
+    return kahoot_id, session_id, participant_id, question_id, (right, wrong)
+
+
+def points_of(con, score_id):
+    with con:
+        with con.cursor() as cursor:
+            cursor.execute("SELECT points_earned FROM player_answers WHERE id = %s;", (score_id,))
+            return cursor.fetchone()[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+
+    con = db_setup.get_connection()
+    kahoot_id, session_id, participant_id, question_id, answer_ids = seed(con)
+    submissions = [
+        schemas.PlayerAnswerCreate(
+            session_id=session_id,
+            participant_id=participant_id,
+            question_id=question_id,
+            answer_id=answer_ids[i % 2],
+            time_taken=(i % 613) / 10,
+        )
+        for i in range(args.iterations)
+    ]
+    try:
+        # same input, same points
+        for submission in submissions[:200]:
+            old = points_of(con, submit_answer_three_steps(con, submission))
+            new = points_of(con, db.submit_answer(con, submission))
+            assert old == new, (submission, old, new)
+
+        print(f"{args.iterations} submissions per version, latency in microseconds")
+        print(f"{'version':<16}{'mean':>8}{'p50':>8}{'p95':>8}{'p99':>8}")
+        for name, submit in (("three steps", submit_answer_three_steps), ("stored function", db.submit_answer)):
+            timings = []
+            for submission in submissions:
+                started = time.perf_counter()
+                submit(con, submission)
+                timings.append((time.perf_counter() - started) * 1_000_000)
+            timings.sort()
+            p = lambda q: timings[int(q * (len(timings) - 1))]
+            print(f"{name:<16}{statistics.mean(timings):>8.0f}{p(0.5):>8.0f}{p(0.95):>8.0f}{p(0.99):>8.0f}")
+    finally:
+        db.delete_kahoot(con, kahoot_id)
+        con.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Compares throughput of the sync api (app.py) and the async api (app_async.py)
+on the two hottest endpoints, POST /player-answers/ and GET /game-sessions/{id}/leaderboard.
+
+Both apps are driven in-process over ASGI with the same number of concurrent clients,
+so the sync routes run in anyio's thread pool exactly like they do under uvicorn.
+Needs a database created with db_setup.py, and the same .env-file as the api.
+
+    python benchmarks/bench_sync_vs_async.py --players 200 --requests 2000 --concurrency 100
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+import db
+import db_setup
+import schemas
+
+
+def seed(players: int):
+    """create a quiz with one question, a session and some players to hammer on"""
+    con = db_setup.get_connection()
+    try:
+        kahoot_id = db.create_kahoot(con, schemas.KahootCreate(title="benchmark", category="bench"))
+        question_id = db.create_question(
+            con, schemas.QuestionCreate(kahoot_id=kahoot_id, question_text="2 + 2?")
+        )
+        answer_ids = [
+            db.create_answer(con, schemas.AnswerCreate(question_id=question_id, answer_text=text, is_correct=ok))
+            for text, ok in (("4", True), ("5", False))
+        ]
+        with con:
+            with con.cursor() as cursor:
+                cursor.execute(
+                    "INSERT INTO game_sessions (kahoot_id, session_pin) VALUES (%s, %s) RETURNING id;",
+                    (kahoot_id, f"b{time.time_ns() % 10**7}"),
+                )
+                session_id = cursor.fetchone()[0]
+        participant_ids = [
+            db.create_participant(con, schemas.ParticipantCreate(game_session_id=session_id))["id"]
+            for _ in range(players)
+        ]
+    finally:
+        con.close()
+    return kahoot_id, session_id, question_id, answer_ids, participant_ids
+
+
+async def drive(app, make_request, total: int, concurrency: int):
+    """fire `total` requests from `concurrency` clients and return requests per second"""
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            counter = iter(range(total))
+
+            async def worker():
+                for i in counter:
+                    response = await make_request(client, i)
+                    response.raise_for_status()
+
+            started = time.perf_counter()
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+            elapsed = time.perf_counter() - started
+    return total / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--players", type=int, default=200)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    args = parser.parse_args()
+
+    import app as sync_api
+    import app_async
+
+    kahoot_id, session_id, question_id, answer_ids, participant_ids = seed(args.players)
+
+    async def submit(client, i):
+        return await client.post("/player-answers/", json={
+            "session_id": session_id,
+            "participant_id": participant_ids[i % len(participant_ids)],
+            "question_id": question_id,
+            "answer_id": answer_ids[i % 2],
+            "time_taken": (i % 300) / 10,
+        })
+
+    async def leaderboard(client, i):
+        return await client.get(f"/game-sessions/{session_id}/leaderboard")
+
+    print(f"{args.requests} requests, {args.concurrency} concurrent clients, {args.players} players")
+    print(f"{'endpoint':<28}{'sync req/s':>12}{'async req/s':>13}")
+    try:
+        for name, make_request in (("POST /player-answers/", submit), ("GET leaderboard", leaderboard)):
+            sync_rps = asyncio.run(drive(sync_api.app, make_request, args.requests, args.concurrency))
+            async_rps = asyncio.run(drive(app_async.app, make_request, args.requests, args.concurrency))
+            print(f"{name:<28}{sync_rps:>12.0f}{async_rps:>13.0f}")
+    finally:
+        con = db_setup.get_connection()
+        db.delete_kahoot(con, kahoot_id)
+        con.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,301 @@
+"""
+Load test that plays whole games through the api, in the order a real game happens: the host
+imports a quiz and opens a session, --players players arrive over --join-time seconds, look the
+session up by its PIN and join, then for every question the host starts it, each player answers
+after some think time while the host screen polls the leaderboard, and finally the host ends the
+session. --games games run at the same time.
+
+Every request is timed under its route (POST /player-answers/, GET /game-sessions/{id}/leaderboard,
+...) and the throughput, p50/p95/p99 and max latency and the error count per route are printed and
+written as JSON to --output, so runs can be compared by a script.
+
+By default the api (--app app or app_async) runs in-process over ASGI against a throwaway schema
+of the local database, which is dropped afterwards unless --keep is given; --threads sizes the
+thread pool the sync routes run in. With --url the requests go to a running api instead, started
+with as many workers as should be tested, e.g uvicorn app:app --workers 4, and what the games
+create stays in its database.
+
+    python benchmarks/load_game.py --games 4 --players 100 --questions 10 --think-time 0.5
+    python benchmarks/load_game.py --url http://localhost:8000 --games 8 --concurrency 200
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+
+SCHEMA = "load_game"
+# every connection opened from here on, including the ones db_setup opens, works inside the load test schema
+os.environ["PGOPTIONS"] = f"-c search_path={SCHEMA}"
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+
+
+def reset_schema():
+    import db_setup
+
+    con = db_setup.get_connection()
+    con.autocommit = True
+    with con.cursor() as cursor:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE;")
+        cursor.execute(f"CREATE SCHEMA {SCHEMA};")
+    con.close()
+
+
+def drop_schema():
+    import db_setup
+
+    con = db_setup.get_connection()
+    con.autocommit = True
+    with con.cursor() as cursor:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE;")
+    con.close()
+
+
+def quiz(number: int, questions: int, answers: int):
+    """the import document of the quiz a game is played with"""
+    return {
+        "title": f"load test {number}",
+        "category": "load test",
+        "questions": [
+            {
+                "question_text": f"question {q}",
+                "time_limit": 30,
+                "points": 1000,
+                "answers": [{"answer_text": f"answer {a}", "is_correct": a == 0} for a in range(answers)],
+            }
+            for q in range(questions)
+        ],
+    }
+
+
+class Recorder:
+    """latencies and errors per route, and the client every request of the load test goes through"""
+
+    def __init__(self, client, concurrency: int):
+        self.client = client
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        # the first failure of every route, to tell a slow api from a broken one
+        self.first_errors = {}
+        # 0 means no limit on the requests in flight
+        self.slots = asyncio.Semaphore(concurrency) if concurrency else None
+
+    async def request(self, route: str, method: str, url: str, **kwargs):
+        """send a request and time it under its route, returns the response or None when it failed"""
+        async with self.slots or contextlib.nullcontext():
+            started = time.perf_counter()
+            try:
+                response = await self.client.request(method, url, **kwargs)
+            except httpx.HTTPError:
+                response = None
+            elapsed = (time.perf_counter() - started) * 1000
+        self.latencies[route].append(elapsed)
+        if response is None or response.status_code >= 400:
+            self.errors[route] += 1
+            if route not in self.first_errors:
+                self.first_errors[route] = "no response" if response is None else f"{response.status_code} {response.text[:200]}"
+            return None
+        return response
+
+
+async def player(recorder, pin: str, number: int, join_time: float, joined: list):
+    """a player shows up some time during the lobby, looks the session up by its PIN and joins it"""
+    await asyncio.sleep(random.uniform(0, join_time))
+    response = await recorder.request("GET /game-sessions/pin/{pin}", "GET", f"/game-sessions/pin/{pin}")
+    if response is None:
+        return
+    session_id = response.json()["id"]
+    response = await recorder.request(
+        "POST /participants/",
+        "POST",
+        "/participants/",
+        json={"game_session_id": session_id, "username": f"player {number}"},
+    )
+    if response is not None:
+        # the api answers {"id": {"id": ..., "username": ...}, "message": ...}
+        joined.append(response.json()["id"]["id"])
+
+
+async def answer(recorder, session_id: int, participant_id: int, question: dict, think_time: float):
+    """a player thinks for a while and picks one of the answers"""
+    thought = random.uniform(0.5, 1.5) * think_time
+    await asyncio.sleep(thought)
+    await recorder.request(
+        "POST /player-answers/",
+        "POST",
+        "/player-answers/",
+        json={
+            "session_id": session_id,
+            "participant_id": participant_id,
+            "question_id": question["id"],
+            "answer_id": random.choice(question["answer_ids"]),
+            "time_taken": round(thought, 3),
+        },
+    )
+
+
+async def poll_leaderboard(recorder, session_id: int, interval: float, done: asyncio.Event):
+    """the host screen, shows the top 10 until the question is over and once more after it"""
+    url = f"/game-sessions/{session_id}/leaderboard"
+    while not done.is_set():
+        await recorder.request("GET /game-sessions/{id}/leaderboard", "GET", url, params={"limit": 10})
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(done.wait(), interval)
+    await recorder.request("GET /game-sessions/{id}/leaderboard", "GET", url, params={"limit": 10})
+
+
+async def game(recorder, number: int, args):
+    """one whole game, returns the number of players that joined it"""
+    response = await recorder.request(
+        "POST /kahoots:import", "POST", "/kahoots:import", json=quiz(number, args.questions, args.answers)
+    )
+    if response is None:
+        return 0
+    questions = response.json()["questions"]
+    response = await recorder.request(
+        "POST /game-sessions/", "POST", "/game-sessions/", json={"kahoot_id": response.json()["id"]}
+    )
+    if response is None:
+        return 0
+    session_id, pin = response.json()["id"], response.json()["session_pin"]
+
+    joined = []
+    await asyncio.gather(*(player(recorder, pin, n, args.join_time, joined) for n in range(args.players)))
+
+    for question in questions:
+        await recorder.request(
+            "PUT /game-sessions/{id}/questions/{question_id}",
+            "PUT",
+            f"/game-sessions/{session_id}/questions/{question['id']}",
+        )
+        done = asyncio.Event()
+        poller = asyncio.create_task(poll_leaderboard(recorder, session_id, args.poll_interval, done))
+        await asyncio.gather(
+            *(answer(recorder, session_id, participant_id, question, args.think_time) for participant_id in joined)
+        )
+        done.set()
+        await poller
+
+    await recorder.request("PUT /game-sessions/{id}/end", "PUT", f"/game-sessions/{session_id}/end")
+    return len(joined)
+
+
+def percentile(ordered: list, p: float):
+    """nearest rank percentile of a sorted list"""
+    index = max(0, min(len(ordered) - 1, round(p / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+def report(recorder, elapsed: float, players: int, args):
+    endpoints = {}
+    for route, timings in sorted(recorder.latencies.items()):
+        ordered = sorted(timings)
+        endpoints[route] = {
+            "requests": len(ordered),
+            "errors": recorder.errors[route],
+            "throughput": round(len(ordered) / elapsed, 1),
+            "p50_ms": round(percentile(ordered, 50), 2),
+            "p95_ms": round(percentile(ordered, 95), 2),
+            "p99_ms": round(percentile(ordered, 99), 2),
+            "max_ms": round(ordered[-1], 2),
+            "first_error": recorder.first_errors.get(route),
+        }
+    requests = sum(endpoint["requests"] for endpoint in endpoints.values())
+    return {
+        "config": {
+            "target": args.url or args.app,
+            "games": args.games,
+            "players": args.players,
+            "questions": args.questions,
+            "answers": args.answers,
+            "join_time": args.join_time,
+            "think_time": args.think_time,
+            "poll_interval": args.poll_interval,
+            "concurrency": args.concurrency,
+            "threads": None if args.url else args.threads,
+        },
+        "duration_s": round(elapsed, 3),
+        "players_joined": players,
+        "requests": requests,
+        "errors": sum(endpoint["errors"] for endpoint in endpoints.values()),
+        "throughput": round(requests / elapsed, 1),
+        "endpoints": endpoints,
+    }
+
+
+async def run(args):
+    """play the games against the target, returns the report"""
+    if args.url:
+        api = None
+        client = httpx.AsyncClient(base_url=args.url, timeout=60, limits=httpx.Limits(max_connections=args.concurrency or None))
+    else:
+        api = __import__(args.app).app
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=api), base_url="http://load-test", timeout=60)
+
+    async with contextlib.AsyncExitStack() as stack:
+        if api is not None:
+            import anyio.to_thread
+
+            anyio.to_thread.current_default_thread_limiter().total_tokens = args.threads
+            await stack.enter_async_context(api.router.lifespan_context(api))
+        await stack.enter_async_context(client)
+        recorder = Recorder(client, args.concurrency)
+        started = time.perf_counter()
+        players = await asyncio.gather(*(game(recorder, number, args) for number in range(args.games)))
+        elapsed = time.perf_counter() - started
+    return report(recorder, elapsed, sum(players), args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--games", type=int, default=2, help="games played at the same time")
+    parser.add_argument("--players", type=int, default=50, help="players per game")
+    parser.add_argument("--questions", type=int, default=5, help="questions per quiz")
+    parser.add_argument("--answers", type=int, default=4, help="answers per question")
+    parser.add_argument("--join-time", type=float, default=2, help="seconds over which the players of a game join")
+    parser.add_argument("--think-time", type=float, default=0.5, help="mean seconds a player thinks before answering")
+    parser.add_argument("--poll-interval", type=float, default=0.5, help="seconds between leaderboard polls of the host")
+    parser.add_argument("--concurrency", type=int, default=0, help="most requests in flight, 0 for no limit")
+    parser.add_argument("--threads", type=int, default=40, help="threads for the sync routes when running in-process")
+    parser.add_argument("--app", choices=("app", "app_async"), default="app")
+    parser.add_argument("--url", help="base url of a running api, instead of running --app in-process")
+    parser.add_argument("--output", default="load_game.json", help="file the results are written to as JSON")
+    parser.add_argument("--keep", action="store_true", help="keep the load test schema afterwards")
+    args = parser.parse_args()
+
+    if not args.url:
+        import migrate
+
+        reset_schema()
+    try:
+        if not args.url:
+            migrate.migrate()
+        results = asyncio.run(run(args))
+    finally:
+        if not args.url and not args.keep:
+            drop_schema()
+
+    print(
+        f"{args.games} games of {args.players} players and {args.questions} questions against {args.url or args.app}: "
+        f"{results['requests']} requests in {results['duration_s']:.1f}s, {results['throughput']:.0f} requests/s\n"
+    )
+    print(f"{'endpoint':<50}{'requests':>9}{'errors':>8}{'req/s':>9}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for route, endpoint in results["endpoints"].items():
+        print(
+            f"{route:<50}{endpoint['requests']:>9}{endpoint['errors']:>8}{endpoint['throughput']:>9.1f}"
+            f"{endpoint['p50_ms']:>8.1f}ms{endpoint['p95_ms']:>8.1f}ms{endpoint['p99_ms']:>8.1f}ms"
+        )
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"\nresults written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,18 @@
+from typing import List
 import psycopg2
 from psycopg2.extras import RealDictCursor
 import schemas
 import exceptions
+from answer_cache import AnswerKey, answer_keys
+import answer_buffer
+import final_score
+from answer_distribution import LIVE_DISTRIBUTION, QuestionDistribution, distributions
+from leaderboard import LIVE_LEADERBOARD, SessionLeaderboard, leaderboards
+import metrics
+import prepared_statements
+import session_events
+import snapshots
+from session_pins import PIN_ATTEMPTS, active_pins, pin_allocator
 """
 This file is responsible for making database queries, which your fastapi endpoints/routes can use.
 The reason we split them up is to avoid clutter in the endpoints, so that the endpoints might focus on other tasks 
@@ -20,15 +31,83 @@ start with a connection parameter.
 #quiz functions
 
 #fetching all kahoots
-def get_all_kahoots(con):
-    """get all kahoots from the database"""
+def keyset_query(table: str, order_column: str, conditions, after=None, limit: int = None, columns: str = "*"):
+    """SELECT the rows of a table newest first, only the conditions whose value isn't None apply,
+    `after` is the (order_column, id) of the last row of the previous page"""
+    where = [condition for condition, value in conditions if value is not None]
+    params = [value for condition, value in conditions if value is not None]
+    if after is not None:
+        where.append(f"({order_column}, id) < (%s, %s)")
+        params.extend(after)
+    sql = f"SELECT {columns} FROM {table}"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += f" ORDER BY {order_column} DESC, id DESC"
+    if limit is not None:
+        sql += " LIMIT %s"
+        params.append(limit)
+    return sql + ";", params
+
+
+def kahoots_query(
+    after=None, limit: int = None, category: str = None, created_after=None, created_before=None, columns: str = "*"
+):
+    return keyset_query(
+        "kahoots",
+        "creation_date",
+        [("category = %s", category), ("creation_date >= %s", created_after), ("creation_date < %s", created_before)],
+        after,
+        limit,
+        columns,
+    )
+
+
+# a hash of the ids and versions of the kahoots on a page, the page's ETag. it's computed by postgres,
+# so a 304 doesn't fetch the page's rows at all
+KAHOOTS_PAGE_VERSION_SQL = """
+SELECT md5(COALESCE(string_agg(id || '.' || version, ',' ORDER BY creation_date DESC, id DESC), ''))
+FROM ({page}) page;
+"""
+
+
+def kahoots_page_version_query(
+    after=None, limit: int = None, category: str = None, created_after=None, created_before=None
+):
+    sql, params = kahoots_query(after, limit, category, created_after, created_before, "id, version, creation_date")
+    return KAHOOTS_PAGE_VERSION_SQL.format(page=sql.rstrip(";")), params
+
+
+@metrics.timed
+def get_kahoots_page_version(
+    con, after=None, limit: int = None, category: str = None, created_after=None, created_before=None
+):
+    """the version of a page of kahoots, it changes when a kahoot on it does or the page holds other kahoots"""
+    with con:
+        with con.cursor() as cursor:
+            cursor.execute(*kahoots_page_version_query(after, limit, category, created_after, created_before))
+            return cursor.fetchone()[0]
+
+
+@metrics.timed
+def get_all_kahoots(con, after=None, limit: int = None, category: str = None, created_after=None, created_before=None):
+    """get the kahoots from the database, newest first, a page of them when given a limit"""
     with con:
         with con.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute("SELECT * FROM kahoots;")
+            cursor.execute(*kahoots_query(after, limit, category, created_after, created_before))
             kahoots = cursor.fetchall()
     return kahoots
 
+@metrics.timed
+def get_kahoot_version(con, kahoot_id: int):
+    """the version of a kahoot, bumped by triggers on every change to it, None if it doesn't exist"""
+    with con:
+        with con.cursor() as cursor:
+            cursor.execute("SELECT version FROM kahoots WHERE id = %s;", (kahoot_id,))
+            row = cursor.fetchone()
+    return row[0] if row else None
+
 #creating a kahoot
+@metrics.timed
 def create_kahoot(con, kahoot: schemas.KahootCreate):
     """create a new kahoot in the database"""
     with con:
@@ -41,6 +120,7 @@ def create_kahoot(con, kahoot: schemas.KahootCreate):
     return kahoot_id
 
 #get a singular kahoot
+@metrics.timed
 def get_kahoot(con, kahoot_id: int):
     """get a single kahoot by id from the database"""
     with con:
@@ -51,7 +131,59 @@ def get_kahoot(con, kahoot_id: int):
                 raise exceptions.KahootNotFoundException(kahoot_id)
             return kahoot
 
+# a kahoot with its questions, and their answers and media, built by postgres in one query
+KAHOOT_FULL_SQL = """
+WITH kahoot_questions AS (
+    SELECT * FROM questions WHERE kahoot_id = %s
+),
+answers_by_question AS (
+    SELECT a.question_id,
+        json_agg(json_build_object(
+            'id', a.id, 'question_id', a.question_id, 'answer_text', a.answer_text, 'is_correct', a.is_correct
+        ) ORDER BY a.id) AS answers
+    FROM answers a
+    JOIN kahoot_questions q ON q.id = a.question_id
+    GROUP BY a.question_id
+),
+media_by_question AS (
+    SELECT qm.question_id,
+        json_agg(json_build_object(
+            'id', m.id, 'media_type', m.media_type, 'file_path', m.file_path, 'display_order', qm.display_order
+        ) ORDER BY qm.display_order, m.id) AS media
+    FROM question_media qm
+    JOIN kahoot_questions q ON q.id = qm.question_id
+    JOIN media m ON m.id = qm.media_id
+    GROUP BY qm.question_id
+)
+SELECT k.*, COALESCE((
+    SELECT json_agg(json_build_object(
+        'id', q.id, 'kahoot_id', q.kahoot_id, 'media_id', q.media_id, 'question_text', q.question_text,
+        'question_type', q.question_type, 'time_limit', q.time_limit, 'points', q.points,
+        'answers', COALESCE(abq.answers, '[]'::json),
+        'media', COALESCE(mbq.media, '[]'::json)
+    ) ORDER BY q.id)
+    FROM kahoot_questions q
+    LEFT JOIN answers_by_question abq ON abq.question_id = q.id
+    LEFT JOIN media_by_question mbq ON mbq.question_id = q.id
+), '[]'::json) AS questions
+FROM kahoots k
+WHERE k.id = %s
+"""
+
+
+@metrics.timed
+def get_kahoot_full(con, kahoot_id: int):
+    """get a kahoot with all of its questions, answers and media in one round trip"""
+    with con:
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(KAHOOT_FULL_SQL + ";", (kahoot_id, kahoot_id))
+            kahoot = cursor.fetchone()
+            if not kahoot:
+                raise exceptions.KahootNotFoundException(kahoot_id)
+            return kahoot
+
 #update a kahoot      
+@metrics.timed
 def update_kahoot(con, kahoot_id: int, kahoot: schemas.KahootCreate):
     """update a kahoot in the database"""
     with con:
@@ -66,6 +198,7 @@ def update_kahoot(con, kahoot_id: int, kahoot: schemas.KahootCreate):
             return updated_kahoot["id"]
 
 #delete a kahoot
+@metrics.timed
 def delete_kahoot(con, kahoot_id: int):
     """delete a kahoot from the database"""
     with con:
@@ -77,12 +210,14 @@ def delete_kahoot(con, kahoot_id: int):
             deleted_kahoot = cursor.fetchone()
             if not deleted_kahoot:
                 raise exceptions.KahootNotFoundException(kahoot_id)
-            return deleted_kahoot["id"]
+    answer_keys.invalidate_kahoot(kahoot_id)
+    return deleted_kahoot["id"]
         
 
 #question functions
 
 #get all questions for a specific quiz
+@metrics.timed
 def get_all_questions_quiz(con, kahoot_id):
     """get all questions for a specific quiz"""
     with con:
@@ -95,6 +230,7 @@ def get_all_questions_quiz(con, kahoot_id):
     return questions
 
 #get a singular question
+@metrics.timed
 def get_question(con, kahoot_id, question_id: int):
     """get a single question by id"""
     with con:
@@ -105,6 +241,7 @@ def get_question(con, kahoot_id, question_id: int):
                 raise exceptions.QuestionNotFoundException(question_id)
             return question
 
+@metrics.timed
 def create_question(con, question: schemas.QuestionCreate):
     """Create a new question"""
     with con:
@@ -114,9 +251,82 @@ def create_question(con, question: schemas.QuestionCreate):
         (question.kahoot_id, question.question_text, question.question_type, question.time_limit, question.points),
             )
             question_id = cursor.fetchone()["id"]
+    answer_keys.invalidate_kahoot(question.kahoot_id)
     return question_id
 
 
+# the questions and answers of an imported kahoot, one statement each, the ids come out in input order
+IMPORT_QUESTIONS_SQL = """
+INSERT INTO questions (kahoot_id, question_text, question_type, time_limit, points)
+SELECT %s, q.question_text, q.question_type, q.time_limit, q.points
+FROM unnest(%s::text[], %s::text[], %s::int[], %s::int[]) WITH ORDINALITY AS q(question_text, question_type, time_limit, points, n)
+ORDER BY q.n
+RETURNING id;
+"""
+IMPORT_ANSWERS_SQL = """
+INSERT INTO answers (question_id, answer_text, is_correct)
+SELECT a.question_id, a.answer_text, a.is_correct
+FROM unnest(%s::bigint[], %s::text[], %s::boolean[]) WITH ORDINALITY AS a(question_id, answer_text, is_correct, n)
+ORDER BY a.n
+RETURNING id;
+"""
+
+
+def import_columns(kahoot: schemas.KahootImport):
+    """the questions of an import as one list per column, the order the unnest() of IMPORT_QUESTIONS_SQL takes"""
+    questions = kahoot.questions
+    return (
+        [question.question_text for question in questions],
+        [question.question_type for question in questions],
+        [question.time_limit for question in questions],
+        [question.points for question in questions],
+    )
+
+
+def answer_columns(kahoot: schemas.KahootImport, question_ids):
+    """the answers of every question as one list per column, for IMPORT_ANSWERS_SQL"""
+    answers = [
+        (question_id, answer) for question_id, question in zip(question_ids, kahoot.questions) for answer in question.answers
+    ]
+    return (
+        [question_id for question_id, _ in answers],
+        [answer.answer_text for _, answer in answers],
+        [answer.is_correct for _, answer in answers],
+    )
+
+
+def imported(kahoot_id: int, kahoot: schemas.KahootImport, question_ids, answer_ids):
+    """the generated ids, nested like the imported document"""
+    questions = []
+    answer_ids = iter(answer_ids)
+    for question_id, question in zip(question_ids, kahoot.questions):
+        questions.append({"id": question_id, "answer_ids": [next(answer_ids) for _ in question.answers]})
+    return {"id": kahoot_id, "questions": questions}
+
+
+@metrics.timed
+def import_kahoot(con, kahoot: schemas.KahootImport):
+    """Create a kahoot with all of its questions and answers in one transaction, three INSERTs in total"""
+    with con:
+        with con.cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO kahoots (title, category) VALUES (%s, %s) RETURNING id;",
+                (kahoot.title, kahoot.category),
+            )
+            kahoot_id = cursor.fetchone()[0]
+            question_ids, answer_ids = [], []
+            if kahoot.questions:
+                cursor.execute(IMPORT_QUESTIONS_SQL, (kahoot_id, *import_columns(kahoot)))
+                # ids are handed out in input order, so sorting on them restores it
+                question_ids = sorted(row[0] for row in cursor.fetchall())
+            columns = answer_columns(kahoot, question_ids)
+            if columns[0]:
+                cursor.execute(IMPORT_ANSWERS_SQL, columns)
+                answer_ids = sorted(row[0] for row in cursor.fetchall())
+    return imported(kahoot_id, kahoot, question_ids, answer_ids)
+
+
+@metrics.timed
 def update_question(con, question_id: int, question: schemas.QuestionCreate):
     """Update a question"""
     with con:
@@ -128,9 +338,12 @@ def update_question(con, question_id: int, question: schemas.QuestionCreate):
             result = cursor.fetchone()
             if not result:
                 raise exceptions.QuestionNotFoundException(question_id)
-            return result["id"]
+    # cached answer keys are dropped after the commit, so a key loaded in between can't be stale
+    answer_keys.invalidate_question(question_id)
+    return result["id"]
 
 
+@metrics.timed
 def delete_question(con, question_id):
     """Delete a question"""
     with con:
@@ -139,11 +352,14 @@ def delete_question(con, question_id):
             result = cursor.fetchone()
             if not result:
                 raise exceptions.QuestionNotFoundException(question_id)
-            return result["id"]
+    answer_keys.invalidate_question(question_id)
+    distributions.invalidate_question(question_id)
+    return result["id"]
 
 
 # answer functions
 
+@metrics.timed
 def get_answers_by_question(con, question_id):
     """Get all answers for a specific question"""
     with con:
@@ -156,6 +372,7 @@ def get_answers_by_question(con, question_id):
     return answers
 
 
+@metrics.timed
 def create_answer(con, answer: schemas.AnswerCreate):
     """Create a new answer"""
     with con:
@@ -165,9 +382,12 @@ def create_answer(con, answer: schemas.AnswerCreate):
                 (answer.question_id, answer.answer_text, answer.is_correct),
             )
             answer_id = cursor.fetchone()["id"]
+    answer_keys.invalidate_question(answer.question_id)
+    distributions.invalidate_question(answer.question_id)
     return answer_id
 
 
+@metrics.timed
 def update_answer(con, answer_id, answer_text, is_correct):
     """Update an answer"""
     with con:
@@ -179,9 +399,12 @@ def update_answer(con, answer_id, answer_text, is_correct):
             result = cursor.fetchone()
             if not result:
                 raise exceptions.AnswerNotFoundException(f"Answer with id {answer_id} not found")
-            return result["id"]
+    answer_keys.invalidate_answer(answer_id)
+    distributions.invalidate_answer(answer_id)
+    return result["id"]
 
 
+@metrics.timed
 def delete_answer(con, answer_id):
     """Delete an answer"""
     with con:
@@ -190,71 +413,178 @@ def delete_answer(con, answer_id):
             result = cursor.fetchone()
             if not result:
                 raise exceptions.AnswerNotFoundException(f"Answer with id {answer_id} not found")
-            return result["id"]
+    answer_keys.invalidate_answer(answer_id)
+    distributions.invalidate_answer(answer_id)
+    return result["id"]
 
 
 # participant / player functions
 
+PARTICIPANTS_SQL = "SELECT * FROM participants WHERE game_session_id = %s ORDER BY joined_at DESC;"
+
+# with FINAL_SCORE_MODE=deferred (see final_score.py) nothing adds up final_score during a game, so for
+# a live session it's the sum of the participant's answers so far. the index on player_answers
+# (session_id, participant_id) includes points_earned, the sum never reads the table itself
+PARTICIPANT_COLUMNS = """
+    p.id, p.game_session_id, p.user_id, p.username, p.joined_at,
+    CASE WHEN gs.is_active THEN (
+        SELECT COALESCE(SUM(pa.points_earned), 0)::INT FROM player_answers pa
+        WHERE pa.session_id = p.game_session_id AND pa.participant_id = p.id
+    ) ELSE p.final_score END AS final_score,
+    p.rank
+"""
+RUNNING_PARTICIPANTS_SQL = f"""
+SELECT {PARTICIPANT_COLUMNS}
+FROM participants p
+LEFT JOIN game_sessions gs ON gs.id = p.game_session_id
+WHERE p.game_session_id = %s
+ORDER BY p.joined_at DESC;
+"""
+
+
+def participants_sql():
+    return RUNNING_PARTICIPANTS_SQL if final_score.deferred() else PARTICIPANTS_SQL
+
+
+@metrics.timed
 def get_participants(con, game_session_id: int):
     """Get all participants for a game session"""
     with con:
         with con.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute(
-                "SELECT * FROM participants WHERE game_session_id = %s ORDER BY joined_at DESC;",
-                (game_session_id,)
-            )
+            cursor.execute(participants_sql(), (game_session_id,))
             participants = cursor.fetchall()
     return participants
 
 
+@metrics.timed(rows=lambda result: len(result[1]))
+def get_participant_rows(con, game_session_id: int):
+    """get_participants as column names and plain tuples, for fast_json"""
+    with con:
+        with con.cursor() as cursor:
+            cursor.execute(participants_sql(), (game_session_id,))
+            participants = cursor.fetchall()
+            columns = [column.name for column in cursor.description]
+    return columns, participants
+
+
+GET_PARTICIPANT = prepared_statements.register(
+    "get_participant",
+    """SELECT id, game_session_id, user_id, username, joined_at, final_score, rank
+    FROM participants WHERE id = %s;""",
+)
+GET_RUNNING_PARTICIPANT = prepared_statements.register(
+    "get_running_participant",
+    f"""SELECT {PARTICIPANT_COLUMNS}
+    FROM participants p
+    LEFT JOIN game_sessions gs ON gs.id = p.game_session_id
+    WHERE p.id = %s;""",
+)
+
+
+@metrics.timed
 def get_participant(con, participant_id: int):
     """Get a single participant by ID"""
     with con:
         with con.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute("SELECT * FROM participants WHERE id = %s;", (participant_id,))
+            statement = GET_RUNNING_PARTICIPANT if final_score.deferred() else GET_PARTICIPANT
+            prepared_statements.execute(cursor, statement, (participant_id,))
             participant = cursor.fetchone()
             if not participant:
                 raise exceptions.PlayerNotFoundException(participant_id)
             return participant
 
 
+@metrics.timed
 def create_participant(con, participant: schemas.ParticipantCreate):
     """Create a new participant (join a game session) - use custom username or generate random"""
-    with con:
-        with con.cursor(cursor_factory=RealDictCursor) as cursor:
-            if participant.username:
-                # User provided their own username
-                cursor.execute(
-                    """INSERT INTO participants (game_session_id, username) 
-                    VALUES (%s, %s) 
-                    RETURNING id, username;""",
-                    (participant.game_session_id, participant.username),
-                )
-            else:
-                # Generate random username if not provided
+    return create_participants(con, [participant])[0]
+
+
+# many players in one statement, the ids come out in the order of the input
+CREATE_PARTICIPANTS_SQL = """
+INSERT INTO participants (game_session_id, user_id, username)
+SELECT j.game_session_id, j.user_id, COALESCE(j.username, 'Player_' || substr(md5(random()::text), 1, 6))
+FROM unnest(%s::bigint[], %s::bigint[], %s::text[]) WITH ORDINALITY AS j(game_session_id, user_id, username, n)
+ORDER BY j.n
+RETURNING id, game_session_id, username;
+"""
+
+
+@metrics.timed
+def create_participants(con, participants: List[schemas.ParticipantCreate]):
+    """Create many participants with one INSERT and one commit, returns their id and username in order"""
+    session_ids = [participant.game_session_id for participant in participants]
+    try:
+        with con:
+            with con.cursor(cursor_factory=RealDictCursor) as cursor:
                 cursor.execute(
-                    """INSERT INTO participants (game_session_id, username) 
-                    VALUES (%s, 'Player_' || substr(md5(random()::text), 1, 6)) 
-                    RETURNING id, username;""",
-                    (participant.game_session_id,),
+                    CREATE_PARTICIPANTS_SQL,
+                    (
+                        session_ids,
+                        [participant.user_id for participant in participants],
+                        [participant.username for participant in participants],
+                    ),
                 )
-            result = cursor.fetchone()
-    return {"id": result["id"], "username": result["username"]}
+                # ids are handed out in input order, so sorting on them restores it
+                rows = sorted(cursor.fetchall(), key=lambda row: row["id"])
+    except psycopg2.errors.ForeignKeyViolation as e:
+        if e.diag.constraint_name == "participants_game_session_id_fkey" and len(set(session_ids)) == 1:
+            raise exceptions.GameSessionNotFoundException(session_ids[0])
+        raise
+    participants_joined(rows)
+    return [{"id": row["id"], "username": row["username"]} for row in rows]
+
 
+def participants_joined(rows):
+    """Put freshly joined participants on the live boards of their sessions"""
+    for row in rows:
+        board = leaderboards.get(row["game_session_id"])
+        if board is not None:
+            board.add_participant(row["id"], row["username"])
+    for session_id in {row["game_session_id"] for row in rows}:
+        session_events.leaderboard_changed(session_id)
 
+
+@metrics.timed
 def delete_participant(con, participant_id: int):
     """Delete a participant (when they leave the game session)"""
     with con:
         with con.cursor(cursor_factory=RealDictCursor) as cursor:
             cursor.execute(
-                "DELETE FROM participants WHERE id = %s RETURNING id;",
+                "DELETE FROM participants WHERE id = %s RETURNING id, game_session_id;",
                 (participant_id,)
             )
             result = cursor.fetchone()
             if not result:
                 raise exceptions.PlayerNotFoundException(participant_id)
-            return result["id"]
+    board = leaderboards.get(result["game_session_id"])
+    if board is not None:
+        board.remove_participant(participant_id)
+    # their answers are gone as well, count the session's questions again
+    distributions.drop(result["game_session_id"])
+    session_events.leaderboard_changed(result["game_session_id"])
+    return result["id"]
+
+
+@metrics.timed
+def update_participant_username(con, participant_id: int, username: str):
+    """Update a participant's username"""
+    with con:
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(
+                "UPDATE participants SET username = %s WHERE id = %s RETURNING id, game_session_id;",
+                (username, participant_id)
+            )
+            result = cursor.fetchone()
+            if not result:
+                raise exceptions.PlayerNotFoundException(participant_id)
+    board = leaderboards.get(result["game_session_id"])
+    if board is not None:
+        board.rename_participant(participant_id, username)
+    session_events.leaderboard_changed(result["game_session_id"])
+    return result["id"]
 
+@metrics.timed
 def update_participant_score(con, participant_id: int, final_score: int, rank: int = None):
     """Update a participant's final score and rank"""
     with con:
@@ -275,15 +605,36 @@ def update_participant_score(con, participant_id: int, final_score: int, rank: i
             return result["id"]
 # game session functions
 
-def get_game_sessions(con):
-    """Get all game sessions"""
+def game_sessions_query(
+    after=None, limit: int = None, kahoot_id: int = None, is_active: bool = None, started_after=None, started_before=None
+):
+    return keyset_query(
+        "game_sessions",
+        "started_at",
+        [
+            ("kahoot_id = %s", kahoot_id),
+            ("is_active = %s", is_active),
+            ("started_at >= %s", started_after),
+            ("started_at < %s", started_before),
+        ],
+        after,
+        limit,
+    )
+
+
+@metrics.timed
+def get_game_sessions(
+    con, after=None, limit: int = None, kahoot_id: int = None, is_active: bool = None, started_after=None, started_before=None
+):
+    """Get the game sessions, newest first, a page of them when given a limit"""
     with con:
         with con.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute("SELECT * FROM game_sessions ORDER BY created_at DESC;")
+            cursor.execute(*game_sessions_query(after, limit, kahoot_id, is_active, started_after, started_before))
             sessions = cursor.fetchall()
     return sessions
 
 
+@metrics.timed
 def get_game_session(con, session_id):
     """Get a single game session by ID"""
     with con:
@@ -295,115 +646,622 @@ def get_game_session(con, session_id):
             return session
 
 
+GET_GAME_SESSION_BY_PIN = prepared_statements.register(
+    "get_game_session_by_pin",
+    """SELECT id, kahoot_id, session_pin, is_active, started_at
+    FROM game_sessions WHERE session_pin = %s ORDER BY is_active DESC, id DESC LIMIT 1;""",
+)
+GET_GAME_SESSION_OF_PIN = prepared_statements.register(
+    "get_game_session_of_pin",
+    "SELECT id, kahoot_id, session_pin, is_active, started_at FROM game_sessions WHERE id = %s;",
+)
+
+
+def live_session_of_pin(session, pin):
+    """whether a session active_pins knows for `pin` still is the live session behind it"""
+    return session is not None and session["is_active"] and session["session_pin"] == pin
+
+
+@metrics.timed
 def get_game_session_by_pin(con, pin):
-    """Get a game session by PIN"""
+    """Get a game session by PIN, the live one if an ended session used the same PIN before"""
+    session_id = active_pins.get(pin)
     with con:
         with con.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute("SELECT * FROM game_sessions WHERE pin = %s;", (pin,))
+            if session_id is not None:
+                prepared_statements.execute(cursor, GET_GAME_SESSION_OF_PIN, (session_id,))
+                session = cursor.fetchone()
+                if live_session_of_pin(session, pin):
+                    return session
+                # ended through another worker or by hand, see session_pins.py
+                active_pins.remove(pin, session_id)
+            prepared_statements.execute(cursor, GET_GAME_SESSION_BY_PIN, (pin,))
             session = cursor.fetchone()
             if not session:
-                raise exceptions.GameSessionNotFoundException(f"Game session with pin {pin} not found")
-            return session
+                raise exceptions.GameSessionNotFoundException(pin, "pin")
+    if session["is_active"]:
+        active_pins.add(session)
+    return session
 
 
+@metrics.timed
+def load_session_pins(con):
+    """Shuffle the PIN pool once, leaving out the PINs of the live sessions"""
+    with con:
+        with con.cursor() as cursor:
+            cursor.execute("SELECT session_pin FROM game_sessions WHERE is_active;")
+            pin_allocator.load(row[0] for row in cursor.fetchall())
+
+
+@metrics.timed
 def create_game_session(con, session: schemas.GameSessionCreate):
-    """Create a new game session"""
+    """Create a new game session, with a free PIN from the pool unless the host picked one"""
+    if session.session_pin is None and not pin_allocator.loaded:
+        load_session_pins(con)
+    for attempt in range(PIN_ATTEMPTS):
+        session_pin = session.session_pin or pin_allocator.allocate()
+        try:
+            with con:
+                with con.cursor(cursor_factory=RealDictCursor) as cursor:
+                    cursor.execute(
+                        "INSERT INTO game_sessions (kahoot_id, session_pin) VALUES (%s, %s) RETURNING *;",
+                        (session.kahoot_id, session_pin),
+                    )
+                    created = cursor.fetchone()
+            break
+        except psycopg2.errors.UniqueViolation:
+            # a live session holds this PIN already, e.g one handed out by another worker
+            if session.session_pin is not None or attempt == PIN_ATTEMPTS - 1:
+                raise exceptions.SessionPinInUseException(session_pin)
+    if session.session_pin is not None:
+        pin_allocator.claim(session_pin)
+    active_pins.add(created)
     with con:
-        with con.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute(
-                "INSERT INTO game_sessions (kahoot_id, pin) VALUES (%s, %s) RETURNING id;",
-                (session.kahoot_id, session.session_pin),
-            )
-            session_id = cursor.fetchone()["id"]
-    return session_id
+        # warm the answer key now, so the first answers of the game don't have to load it
+        answer_keys.start_session(created["id"], session.kahoot_id)
+        if answer_keys.get(session.kahoot_id) is None:
+            load_answer_key(con, session.kahoot_id)
+    return created
+
+
+def release_session_pin(session_id: int, session_pin: str):
+    """The session is over, its PIN can't be used to join it anymore"""
+    active_pins.remove(session_pin, session_id)
+    pin_allocator.release(session_pin)
+
+
+# sets is_active and returns the session plus whether it was live before, only then is its PIN released.
+# an ended session's PIN may belong to a new session already
+SET_ACTIVE_SQL = """
+UPDATE game_sessions gs SET is_active = %s
+FROM (SELECT id, is_active FROM game_sessions WHERE id = %s FOR UPDATE) previous
+WHERE gs.id = previous.id
+RETURNING gs.*, previous.is_active AS was_active;
+"""
+CLEAR_RESULTS_SQL = "DELETE FROM session_results WHERE session_id = %s;"
+
 
+def close_answers(session_id: int):
+    """
+    with buffered answers, refuse the session's new ones and wait until the queued ones are
+    written, so its final standings count every answer it accepted
+    """
+    if answer_buffer.enabled():
+        answer_buffer.answers.close_session(session_id)
+        if not answer_buffer.answers.drain():
+            answer_buffer.answers.reopen_session(session_id)
+            raise exceptions.AnswersNotWrittenException(session_id)
 
+
+def reopen_answers(session_id: int):
+    if answer_buffer.enabled():
+        answer_buffer.answers.reopen_session(session_id)
+
+
+@metrics.timed
 def end_game_session(con, session_id):
-    """End a game session by setting is_active to false"""
+    """End a game session by setting is_active to false and writing its final standings"""
+    close_answers(session_id)
+    try:
+        with con:
+            with con.cursor(cursor_factory=RealDictCursor) as cursor:
+                cursor.execute(SET_ACTIVE_SQL, (False, session_id))
+                result = cursor.fetchone()
+                if not result:
+                    raise exceptions.GameSessionNotFoundException(f"Game session with id {session_id} not found")
+                if result["was_active"]:
+                    cursor.execute(FINISH_SESSION_SQL, (session_id, session_id, session_id))
+    except Exception:
+        # the session didn't end, it takes answers again
+        reopen_answers(session_id)
+        raise
+    if result["was_active"]:
+        release_session_pin(session_id, result["session_pin"])
+    answer_keys.end_session(session_id)
+    leaderboards.drop(session_id)
+    distributions.drop(session_id)
+    session_events.session_ended(session_id)
+    return result["id"]
+
+
+@metrics.timed
+def set_game_session_active(con, session_id: int, is_active: bool):
+    """Set a game session active or inactive, its final standings are written when it ends"""
+    if not is_active:
+        close_answers(session_id)
+    try:
+        with con:
+            with con.cursor(cursor_factory=RealDictCursor) as cursor:
+                cursor.execute(SET_ACTIVE_SQL, (is_active, session_id))
+                result = cursor.fetchone()
+                if not result:
+                    raise exceptions.GameSessionNotFoundException(session_id)
+                if is_active:
+                    # the game goes on, its standings aren't final anymore
+                    cursor.execute(CLEAR_RESULTS_SQL, (session_id,))
+                elif result["was_active"]:
+                    cursor.execute(FINISH_SESSION_SQL, (session_id, session_id, session_id))
+    except psycopg2.errors.UniqueViolation:
+        # another live session got the PIN after this one ended
+        raise exceptions.SessionPinInUseException(get_game_session(con, session_id)["session_pin"])
+    except Exception:
+        if not is_active:
+            # the session didn't end, it takes answers again
+            reopen_answers(session_id)
+        raise
+    was_active = result.pop("was_active")
+    if is_active:
+        reopen_answers(session_id)
+        pin_allocator.claim(result["session_pin"])
+        active_pins.add(result)
+    else:
+        if was_active:
+            release_session_pin(session_id, result["session_pin"])
+        answer_keys.end_session(session_id)
+        leaderboards.drop(session_id)
+        distributions.drop(session_id)
+        session_events.session_ended(session_id)
+    return result["id"]
+
+
+@metrics.timed
+def delete_game_session(con, session_id: int):
+    """Delete a game session"""
     with con:
         with con.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute(
-                "UPDATE game_sessions SET is_active = FALSE WHERE id = %s RETURNING id;",
-                (session_id,),
-            )
+            cursor.execute("DELETE FROM game_sessions WHERE id = %s RETURNING id, session_pin, is_active;", (session_id,))
             result = cursor.fetchone()
             if not result:
-                raise exceptions.GameSessionNotFoundException(f"Game session with id {session_id} not found")
-            return result["id"]
+                raise exceptions.GameSessionNotFoundException(session_id)
+    if result["is_active"]:
+        release_session_pin(session_id, result["session_pin"])
+    answer_keys.end_session(session_id)
+    leaderboards.drop(session_id)
+    distributions.drop(session_id)
+    session_events.session_ended(session_id)
+    return result["id"]
 
 
 #player score/ leaderboard functions
 
-def submit_answer(con, player_answer: schemas.PlayerAnswerCreate):
-    """Submit a player's answer and calculate points"""
+@metrics.timed
+def start_question(con, session_id: int, question_id: int):
+    """Move a live session on to one of its kahoot's questions and tell the players about it"""
     with con:
         with con.cursor(cursor_factory=RealDictCursor) as cursor:
-            # Check if the answer is correct
             cursor.execute(
-                "SELECT is_correct FROM answers WHERE id = %s;",
-                (player_answer.answer_id,),
+                """SELECT q.* FROM questions q
+                JOIN game_sessions gs ON gs.kahoot_id = q.kahoot_id
+                WHERE gs.id = %s AND gs.is_active AND q.id = %s;""",
+                (session_id, question_id),
             )
+            question = cursor.fetchone()
+            if not question:
+                raise exceptions.QuestionNotFoundException(question_id)
+            cursor.execute("SELECT id, answer_text FROM answers WHERE question_id = %s ORDER BY id;", (question_id,))
+            answers = cursor.fetchall()
+    if LIVE_DISTRIBUTION and distributions.get(session_id, question_id) is None:
+        # counted from now on, so the first answers to it don't all run the GROUP BY
+        load_distribution(con, session_id, question_id)
+    session_events.question_started(session_id, dict(question), answers)
+    return question["id"]
+
+
+def calculate_points(is_correct: bool, time_taken: float):
+    """500 base points for a correct answer plus a speed bonus of up to 500, same as submit_player_answer"""
+    if not is_correct:
+        return 0
+    return 500 + max(0, 500 - int(time_taken * 10))
+
+
+@metrics.timed
+def load_answer_key(con, kahoot_id: int):
+    """Load the answer key of a kahoot into the answer cache, inside the caller's transaction"""
+    generation = answer_keys.generation
+    with con.cursor() as cursor:
+        cursor.execute(
+            """SELECT q.id, q.points, q.time_limit, a.id, a.is_correct
+            FROM questions q
+            LEFT JOIN answers a ON a.question_id = q.id
+            WHERE q.kahoot_id = %s;""",
+            (kahoot_id,),
+        )
+        key = AnswerKey.from_rows(kahoot_id, cursor.fetchall())
+    answer_keys.put(key, generation)
+    return key
+
+
+GET_SESSION_KAHOOT = prepared_statements.register(
+    "get_session_kahoot", "SELECT kahoot_id, is_active FROM game_sessions WHERE id = %s;"
+)
+
+
+@metrics.timed
+def get_session_answer_key(con, session_id: int):
+    """Get the cached answer key of the kahoot a session plays, loading it on first use"""
+    kahoot_id = answer_keys.kahoot_for_session(session_id)
+    if kahoot_id is None:
+        with con.cursor() as cursor:
+            prepared_statements.execute(cursor, GET_SESSION_KAHOOT, (session_id,))
+            session = cursor.fetchone()
+        if not session:
+            return None
+        kahoot_id, is_active = session
+        if is_active:
+            answer_keys.start_session(session_id, kahoot_id)
+    return answer_keys.get(kahoot_id) or load_answer_key(con, kahoot_id)
+
+
+GET_ANSWER_CORRECT = prepared_statements.register("get_answer_correct", "SELECT is_correct FROM answers WHERE id = %s;")
+
+
+@metrics.timed
+def score_answer(con, player_answer: schemas.PlayerAnswerCreate):
+    """Score an answer without storing it, for the buffered write path"""
+    with con:
+        answer_key = get_session_answer_key(con, player_answer.session_id)
+        if answer_keys.kahoot_for_session(player_answer.session_id) is None:
+            # only live sessions are in there, the buffer would write this after the final standings
+            raise exceptions.GameSessionNotLiveException(player_answer.session_id)
+        cached = answer_key.answers.get(player_answer.answer_id) if answer_key else None
+        if cached is not None:
+            return calculate_points(cached[1], player_answer.time_taken)
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            prepared_statements.execute(cursor, GET_ANSWER_CORRECT, (player_answer.answer_id,))
             answer = cursor.fetchone()
             if not answer:
                 raise exceptions.AnswerNotFoundException(player_answer.answer_id)
+    return calculate_points(answer["is_correct"], player_answer.time_taken)
 
-            # Calculate points (1000 base points if correct, bonus for speed)
-            points_earned = 0
-            if answer["is_correct"]:
-                # Faster responses get more points (max 1000, min 500)
-                time_bonus = max(0, 500 - int(player_answer.time_taken * 10))
-                points_earned = 500 + time_bonus
 
-            # Insert the score into player_answers table
-            cursor.execute(
-                """INSERT INTO player_answers
-                (session_id, participant_id, question_id, answer_id, time_taken, points_earned)
-                VALUES (%s, %s, %s, %s, %s, %s) RETURNING id;""",
-                (
-                    player_answer.session_id,
-                    player_answer.participant_id,
-                    player_answer.question_id,
-                    player_answer.answer_id,
-                    player_answer.time_taken,
-                    points_earned,
-                ),
-            )
-            score_id = cursor.fetchone()["id"]
-            
-            # Update participant's final_score
-            cursor.execute(
-                """UPDATE participants 
-                SET final_score = final_score + %s 
-                WHERE id = %s;""",
-                (points_earned, player_answer.participant_id)
-            )
+RECORD_PLAYER_ANSWER = prepared_statements.register(
+    "record_player_answer", "SELECT record_player_answer(%s, %s, %s, %s, %s, %s, %s) AS score_id;"
+)
+SUBMIT_PLAYER_ANSWER = prepared_statements.register(
+    "submit_player_answer", "SELECT score_id, score_points FROM submit_player_answer(%s, %s, %s, %s, %s, %s);"
+)
+
+
+@metrics.timed
+def submit_answer(con, player_answer: schemas.PlayerAnswerCreate):
+    """Submit a player's answer and calculate points"""
+    with con:
+        # score with the cached answer key when we can, then the database only has to write
+        answer_key = get_session_answer_key(con, player_answer.session_id)
+        cached = answer_key.answers.get(player_answer.answer_id) if answer_key else None
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            if cached is not None:
+                _, is_correct = cached
+                points_earned = calculate_points(is_correct, player_answer.time_taken)
+                # record_player_answer (see migrations/0010) stores the answer and, unless final
+                # scores are deferred, adds the points to the participant's final_score in one round trip
+                prepared_statements.execute(
+                    cursor,
+                    RECORD_PLAYER_ANSWER,
+                    (
+                        player_answer.session_id,
+                        player_answer.participant_id,
+                        player_answer.question_id,
+                        player_answer.answer_id,
+                        player_answer.time_taken,
+                        points_earned,
+                        not final_score.deferred(),
+                    ),
+                )
+                score_id = cursor.fetchone()["score_id"]
+            else:
+                # the answer isn't in the key (unknown id, or from another kahoot),
+                # so let submit_player_answer look it up and score it in the database
+                prepared_statements.execute(
+                    cursor,
+                    SUBMIT_PLAYER_ANSWER,
+                    (
+                        player_answer.session_id,
+                        player_answer.participant_id,
+                        player_answer.question_id,
+                        player_answer.answer_id,
+                        player_answer.time_taken,
+                        not final_score.deferred(),
+                    ),
+                )
+                result = cursor.fetchone()
+                if not result:
+                    raise exceptions.AnswerNotFoundException(player_answer.answer_id)
+                score_id, points_earned = result["score_id"], result["score_points"]
+    record_live_score(con, player_answer.session_id, player_answer.participant_id, points_earned, score_id)
+    record_answer_distribution(con, player_answer, score_id)
     return score_id
 
-def get_leaderboard(con, game_session_id: int):
-    """Get the leaderboard for a game session"""
+LEADERBOARD_SQL = """
+SELECT
+    p.id as participant_id,
+    COALESCE(p.username, u.username) as username,
+    COALESCE(SUM(pa.points_earned), 0) as total_score,
+    COUNT(CASE WHEN a.is_correct THEN 1 END) as correct_answers
+FROM participants p
+LEFT JOIN users u ON p.user_id = u.id
+LEFT JOIN player_answers pa ON p.id = pa.participant_id AND pa.session_id = %s
+LEFT JOIN answers a ON pa.answer_id = a.id
+WHERE p.game_session_id = %s
+GROUP BY p.id, p.username, u.username
+ORDER BY total_score DESC, participant_id
+"""
+
+# the leaderboard rows within `neighbours` places of one participant, ranked with a window function
+PARTICIPANT_RANK_SQL = f"""
+WITH ranked AS (
+    SELECT board.*, ROW_NUMBER() OVER (ORDER BY total_score DESC, participant_id) AS rank,
+        COUNT(*) OVER () AS participants
+    FROM ({LEADERBOARD_SQL}) board
+),
+me AS (
+    SELECT rank FROM ranked WHERE participant_id = %s
+)
+SELECT ranked.* FROM ranked, me
+WHERE ranked.rank BETWEEN me.rank - %s AND me.rank + %s
+ORDER BY ranked.rank;
+"""
+
+# the final standings of a session, written when it ends in the same transaction: every participant's
+# final_score and rank in one UPDATE, and the rows of the leaderboard into session_results
+FINISH_SESSION_SQL = f"""
+WITH ranked AS (
+    SELECT board.*, ROW_NUMBER() OVER (ORDER BY total_score DESC, participant_id) AS rank
+    FROM ({LEADERBOARD_SQL}) board
+),
+scores AS (
+    UPDATE participants p SET final_score = ranked.total_score, rank = ranked.rank
+    FROM ranked
+    WHERE p.id = ranked.participant_id
+)
+INSERT INTO session_results (session_id, rank, participant_id, username, total_score, correct_answers)
+SELECT %s, rank, participant_id, username, total_score, correct_answers FROM ranked;
+"""
+
+# the leaderboard of an ended session is a range of session_results' primary key. the aggregate only runs
+# while there are no final standings, its branch is skipped as a whole (a one-time filter) when there are
+RESULTS_OR_LEADERBOARD_SQL = f"""
+SELECT participant_id, username, total_score, correct_answers FROM (
+    (SELECT participant_id, username, total_score, correct_answers
+    FROM session_results WHERE session_id = %s ORDER BY rank LIMIT %s)
+    UNION ALL
+    (SELECT participant_id, username, total_score, correct_answers
+    FROM ({LEADERBOARD_SQL} LIMIT %s) board
+    WHERE NOT EXISTS (SELECT 1 FROM session_results WHERE session_id = %s))
+) leaderboard
+ORDER BY total_score DESC, participant_id
+"""
+
+# PARTICIPANT_RANK_SQL's rows from the final standings, the neighbours are a range of the primary key
+RESULTS_RANK_SQL = """
+SELECT r.participant_id, r.username, r.total_score, r.correct_answers, r.rank,
+    (SELECT COUNT(*) FROM session_results WHERE session_id = me.session_id) AS participants
+FROM session_results me
+JOIN session_results r ON r.session_id = me.session_id AND r.rank BETWEEN me.rank - %s AND me.rank + %s
+WHERE me.session_id = %s AND me.participant_id = %s
+ORDER BY r.rank;
+"""
+
+
+GET_LEADERBOARD = prepared_statements.register("get_leaderboard", RESULTS_OR_LEADERBOARD_SQL + ";")
+GET_PARTICIPANT_USERNAME = prepared_statements.register(
+    "get_participant_username", "SELECT username FROM participants WHERE id = %s;"
+)
+
+
+@metrics.timed
+def load_leaderboard(con, session_id: int):
+    """Build the live leaderboard of an active session from SQL, None if the session isn't live"""
+    # catches up on the answers the buffer's flusher writes meanwhile, see db.load_distribution
+    position = snapshots.written_answers.start()
+    try:
+        return _load_leaderboard(con, session_id, position)
+    finally:
+        snapshots.written_answers.finish(position)
+
+
+def _load_leaderboard(con, session_id: int, position: int):
     with con:
         with con.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute(
-                """
-                SELECT
-                    p.id as participant_id,
-                    COALESCE(p.username, u.username) as username,
-                    COALESCE(SUM(pa.points_earned), 0) as total_score,
-                    COUNT(CASE WHEN a.is_correct THEN 1 END) as correct_answers
-                FROM participants p
-                LEFT JOIN users u ON p.user_id = u.id
-                LEFT JOIN player_answers pa ON p.id = pa.participant_id AND pa.session_id = %s
-                LEFT JOIN answers a ON pa.answer_id = a.id
-                WHERE p.game_session_id = %s
-                GROUP BY p.id, p.username, u.username
-                ORDER BY total_score DESC;
-                """,
-                (game_session_id, game_session_id),
+            # all of the statements below have to see the same snapshot of player_answers
+            cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY;")
+            cursor.execute("SELECT is_active FROM game_sessions WHERE id = %s;", (session_id,))
+            session = cursor.fetchone()
+            if not session or not session["is_active"]:
+                return None
+            cursor.execute(LEADERBOARD_SQL + ";", (session_id, session_id))
+            rows = cursor.fetchall()
+            snapshot = snapshots.read(cursor, session_id)
+    return leaderboards.install(SessionLeaderboard(session_id, rows, snapshot), position)
+
+
+@metrics.timed
+def get_live_leaderboard(con, session_id: int):
+    """Get the in-memory leaderboard of a live session, building it on first use"""
+    if not LIVE_LEADERBOARD:
+        return None
+    return leaderboards.get(session_id) or load_leaderboard(con, session_id)
+
+
+@metrics.timed
+def record_live_score(con, session_id: int, participant_id: int, points_earned: int, score_id: int = None):
+    """Add a submitted answer to the session's live leaderboard"""
+    board = get_live_leaderboard(con, session_id)
+    if board is not None and not board.record(participant_id, points_earned, score_id):
+        # a participant that joined through another worker, put them on the board and try again
+        with con:
+            with con.cursor(cursor_factory=RealDictCursor) as cursor:
+                prepared_statements.execute(cursor, GET_PARTICIPANT_USERNAME, (participant_id,))
+                participant = cursor.fetchone()
+        if participant:
+            board.add_participant(participant_id, participant["username"])
+            board.record(participant_id, points_earned, score_id)
+    session_events.leaderboard_changed(session_id)
+
+
+@metrics.timed
+def get_leaderboard(con, game_session_id: int, limit: int = None):
+    """Get the leaderboard for a game session, or only its top `limit` entries"""
+    board = get_live_leaderboard(con, game_session_id)
+    if board is not None:
+        return board.entries(limit)
+    with con:
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            prepared_statements.execute(
+                cursor, GET_LEADERBOARD, (game_session_id, limit, game_session_id, game_session_id, limit, game_session_id)
             )
             leaderboard = cursor.fetchall()
     return leaderboard
 
 
+@metrics.timed(rows=lambda result: len(result[1]))
+def get_leaderboard_rows(con, game_session_id: int, limit: int = None):
+    """get_leaderboard for fast_json, the live board's entries with None for columns, or the SQL rows as tuples"""
+    board = get_live_leaderboard(con, game_session_id)
+    if board is not None:
+        return None, board.entries(limit)
+    with con:
+        with con.cursor() as cursor:
+            prepared_statements.execute(
+                cursor, GET_LEADERBOARD, (game_session_id, limit, game_session_id, game_session_id, limit, game_session_id)
+            )
+            leaderboard = cursor.fetchall()
+            columns = [column.name for column in cursor.description]
+    return columns, leaderboard
+
+
+@metrics.timed
+def get_participant_rank(con, game_session_id: int, participant_id: int, neighbours: int = 2):
+    """Get a participant's rank and score in a game session, plus the players just above and below them"""
+    board = get_live_leaderboard(con, game_session_id)
+    if board is not None:
+        result = board.rank(participant_id, neighbours)
+        if result is None:
+            raise exceptions.PlayerNotFoundException(participant_id)
+        return result
+    with con:
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(RESULTS_RANK_SQL, (neighbours, neighbours, game_session_id, participant_id))
+            rows = cursor.fetchall()
+            if not rows:
+                # a live session, or a participant that isn't in this one
+                cursor.execute(
+                    PARTICIPANT_RANK_SQL,
+                    (game_session_id, game_session_id, participant_id, neighbours, neighbours),
+                )
+                rows = cursor.fetchall()
+    return rank_from_rows(rows, participant_id)
+
+
+def rank_from_rows(rows, participant_id: int):
+    """turn the rows of PARTICIPANT_RANK_SQL into the shape of schemas.ParticipantRank"""
+    me = next((row for row in rows if row["participant_id"] == participant_id), None)
+    if me is None:
+        raise exceptions.PlayerNotFoundException(participant_id)
+    neighbours = [
+        {key: row[key] for key in ("participant_id", "username", "total_score", "correct_answers", "rank")}
+        for row in rows
+        if row["participant_id"] != participant_id
+    ]
+    return dict(me, neighbours=neighbours)
+
+
+# whether a question is one of the questions a session plays, and if that session is live
+QUESTION_SESSION_SQL = """
+SELECT gs.is_active FROM game_sessions gs
+JOIN questions q ON q.kahoot_id = gs.kahoot_id
+WHERE gs.id = %s AND q.id = %s;
+"""
+
+# how often each answer of a question was picked in a session, and the time that took in total
+DISTRIBUTION_SQL = """
+SELECT
+    a.id AS answer_id,
+    a.answer_text,
+    a.is_correct,
+    COUNT(pa.id) AS count,
+    COALESCE(SUM(pa.time_taken), 0) AS total_time_taken
+FROM answers a
+LEFT JOIN player_answers pa ON pa.answer_id = a.id AND pa.session_id = %s
+WHERE a.question_id = %s
+GROUP BY a.id
+ORDER BY a.id;
+"""
+
+
+@metrics.timed
+def load_distribution(con, session_id: int, question_id: int):
+    """Count the answers to a question of a session with one GROUP BY, kept in memory while the session is live"""
+    # the buffer's flusher counts an answer once it's written, the batches written while the
+    # GROUP BY runs are counted when the distribution is installed, see snapshots.WrittenAnswers
+    position = snapshots.written_answers.start()
+    try:
+        return _load_distribution(con, session_id, question_id, position)
+    finally:
+        snapshots.written_answers.finish(position)
+
+
+def _load_distribution(con, session_id: int, question_id: int, position: int):
+    with con:
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            # all of the statements below have to see the same snapshot of player_answers
+            cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY;")
+            cursor.execute(QUESTION_SESSION_SQL, (session_id, question_id))
+            session = cursor.fetchone()
+            if not session:
+                raise exceptions.QuestionNotFoundException(question_id)
+            cursor.execute(DISTRIBUTION_SQL, (session_id, question_id))
+            rows = cursor.fetchall()
+            if not (LIVE_DISTRIBUTION and session["is_active"]):
+                # an ended session, nothing will be added to it
+                return QuestionDistribution(session_id, question_id, rows, snapshots.AnswerSnapshot())
+            snapshot = snapshots.read(cursor, session_id)
+    return distributions.install(QuestionDistribution(session_id, question_id, rows, snapshot), position)
+
+
+@metrics.timed
+def record_answer_distribution(con, player_answer: schemas.PlayerAnswerCreate, score_id: int = None):
+    """Add a submitted answer to the live distribution of its question"""
+    if not LIVE_DISTRIBUTION:
+        return
+    live = distributions.get(player_answer.session_id, player_answer.question_id)
+    if live is None:
+        try:
+            live = load_distribution(con, player_answer.session_id, player_answer.question_id)
+        except exceptions.QuestionNotFoundException:
+            # not a question of the session's kahoot, there's nothing to count it in
+            return
+    live.record(player_answer.answer_id, player_answer.time_taken, score_id)
+
+
+@metrics.timed
+def get_answer_distribution(con, session_id: int, question_id: int):
+    """Get how often each answer of a question was picked in a session, and how long that took on average"""
+    live = distributions.get(session_id, question_id) if LIVE_DISTRIBUTION else None
+    return (live or load_distribution(con, session_id, question_id)).entries()
+
+
+@metrics.timed
 def get_participant_answers(con, session_id: int, participant_id: int):
     """Get all answers for a specific participant in a game session"""
     with con:
@@ -421,3 +1279,45 @@ def get_participant_answers(con, session_id: int, participant_id: int):
             )
             answers = cursor.fetchall()
     return answers
+
+
+# every answer given in the chosen sessions, in the order of idx_player_answers_session_participant
+EXPORT_COLUMNS = (
+    "session_id", "session_pin", "started_at", "participant_id", "username", "question_id",
+    "question_text", "answer_id", "answer_text", "is_correct", "time_taken", "points_earned",
+)
+EXPORT_SQL = """
+SELECT gs.id AS session_id, gs.session_pin, gs.started_at, pa.participant_id, p.username, pa.question_id,
+       q.question_text, pa.answer_id, a.answer_text, a.is_correct, pa.time_taken, pa.points_earned
+FROM game_sessions gs
+JOIN player_answers pa ON pa.session_id = gs.id
+JOIN participants p ON p.id = pa.participant_id
+JOIN questions q ON q.id = pa.question_id
+JOIN answers a ON a.id = pa.answer_id
+WHERE {}
+ORDER BY pa.session_id, pa.participant_id, pa.id
+"""
+SESSION_EXPORT_SQL = EXPORT_SQL.format("gs.id = %s")
+KAHOOT_EXPORT_SQL = EXPORT_SQL.format("gs.kahoot_id = %s")
+
+
+def stream_rows(con, sql: str, params, itersize: int):
+    """yield the rows of a query as tuples from a server side cursor, fetching itersize rows per round trip"""
+    with con:
+        # plain tuples, building a dict per row costs more than the query itself on big exports
+        with con.cursor(name="export") as cursor:
+            cursor.itersize = itersize
+            cursor.execute(sql, params)
+            yield from cursor
+
+
+def export_session_answers(con, session_id: int, itersize: int = 2000):
+    """Stream every answer of a game session as tuples of EXPORT_COLUMNS, without holding them all in memory"""
+    get_game_session(con, session_id)
+    yield from stream_rows(con, SESSION_EXPORT_SQL, (session_id,), itersize)
+
+
+def export_kahoot_answers(con, kahoot_id: int, itersize: int = 2000):
+    """Stream every answer of every session played with a kahoot as tuples of EXPORT_COLUMNS"""
+    get_kahoot(con, kahoot_id)
+    yield from stream_rows(con, KAHOOT_EXPORT_SQL, (kahoot_id,), itersize)
@@ -0,0 +1,874 @@
+import asyncio
+import json
+import os
+from contextlib import asynccontextmanager
+from typing import List
+import asyncpg
+import db_setup
+import schemas
+import exceptions
+from answer_cache import AnswerKey, answer_keys
+import answer_buffer
+import final_score
+from answer_distribution import LIVE_DISTRIBUTION, QuestionDistribution, distributions
+import db
+from leaderboard import LIVE_LEADERBOARD, SessionLeaderboard, leaderboards
+import metrics
+import prepared_statements
+import session_events
+import snapshots
+import slow_queries
+from session_pins import PIN_ATTEMPTS, active_pins, pin_allocator
+"""
+Async twin of db.py, used when the api runs with API_MODE=async.
+Every function has the same name, parameters and return values as the one in db.py,
+but takes an asyncpg connection and has to be awaited.
+
+- asyncpg uses $1, $2 ... placeholders instead of %s
+- asyncpg returns Record objects, we turn them into plain dicts so the endpoints
+get exactly what the RealDictCursor versions return
+- single statements run in autocommit mode, functions that need several
+statements wrap them in con.transaction()
+"""
+
+
+
+def _numbered(sql: str, *numbers: int):
+    """turn the %s placeholders of a query shared with db.py into asyncpg's $n, in order"""
+    parts = sql.split("%s")
+    return parts[0] + "".join(f"${number}{part}" for number, part in zip(numbers, parts[1:]))
+
+
+LEADERBOARD_SQL = _numbered(db.LEADERBOARD_SQL, 1, 1)
+PARTICIPANT_RANK_SQL = _numbered(db.PARTICIPANT_RANK_SQL, 1, 1, 2, 3, 3)
+FINISH_SESSION_SQL = _numbered(db.FINISH_SESSION_SQL, 1, 1, 1)
+RESULTS_OR_LEADERBOARD_SQL = _numbered(db.RESULTS_OR_LEADERBOARD_SQL, 1, 2, 1, 1, 2, 1)
+RESULTS_RANK_SQL = _numbered(db.RESULTS_RANK_SQL, 3, 3, 1, 2)
+CLEAR_RESULTS_SQL = _numbered(db.CLEAR_RESULTS_SQL, 1)
+QUESTION_SESSION_SQL = _numbered(db.QUESTION_SESSION_SQL, 1, 2)
+DISTRIBUTION_SQL = _numbered(db.DISTRIBUTION_SQL, 1, 2)
+KAHOOT_FULL_SQL = _numbered(db.KAHOOT_FULL_SQL, 1, 1)
+SET_ACTIVE_SQL = _numbered(db.SET_ACTIVE_SQL, 1, 2)
+CREATE_PARTICIPANTS_SQL = _numbered(db.CREATE_PARTICIPANTS_SQL, 1, 2, 3)
+IMPORT_QUESTIONS_SQL = _numbered(db.IMPORT_QUESTIONS_SQL, 1, 2, 3, 4, 5)
+IMPORT_ANSWERS_SQL = _numbered(db.IMPORT_ANSWERS_SQL, 1, 2, 3)
+
+_pool = None
+_pool_lock = asyncio.Lock()
+
+
+async def init_pool():
+    """
+    create the asyncpg pool, called once when the async api starts. It leaves
+    db_setup.DB_POOL_BACKGROUND_RESERVE connections of DB_POOL_MAX_SIZE to the psycopg2 pool
+    of the background work
+    """
+    global _pool
+    async with _pool_lock:
+        if _pool is None:
+            _pool = await asyncpg.create_pool(
+                min_size=min(db_setup.DB_POOL_MIN_SIZE, db_setup.request_slots()),
+                max_size=db_setup.request_slots(),
+                database=db_setup.DATABASE_NAME,
+                user="postgres",  # change if needed
+                password=db_setup.PASSWORD,
+                host="localhost",  # change if needed
+                port=5432,  # change if needed
+                init=_init_connection,
+                server_settings=_server_settings(),
+                # asyncpg prepares every query and keeps the last 100 per connection, see prepared_statements.py
+                statement_cache_size=100 if prepared_statements.PREPARED_STATEMENTS else 0,
+            )
+    return _pool
+
+
+def _server_settings():
+    # libpq applies the -c options of PGOPTIONS to every psycopg2 connection, asyncpg ignores the variable
+    options = os.getenv("PGOPTIONS", "").split()
+    return dict(
+        option.split("=", 1) for flag, option in zip(options, options[1:]) if flag == "-c" and "=" in option
+    )
+
+
+async def _init_connection(con):
+    # asyncpg hands json columns back as text, psycopg2 parses them
+    for type_name in ("json", "jsonb"):
+        await con.set_type_codec(type_name, encoder=json.dumps, decoder=json.loads, schema="pg_catalog")
+    if slow_queries.enabled():
+        con.add_query_logger(slow_queries.asyncpg_logger(pooled_connection))
+
+
+async def close_pool():
+    """close the asyncpg pool, called when the async api shuts down"""
+    global _pool
+    async with _pool_lock:
+        if _pool is not None:
+            await _pool.close()
+            _pool = None
+
+
+@asynccontextmanager
+async def pooled_connection():
+    """borrow a connection from the asyncpg pool and always give it back"""
+    connection_pool = _pool or await init_pool()
+    try:
+        con = await connection_pool.acquire(timeout=db_setup.DB_POOL_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise exceptions.ConnectionPoolExhaustedException(db_setup.DB_POOL_TIMEOUT)
+    try:
+        yield con
+    finally:
+        await connection_pool.release(con)
+
+
+def _row(record):
+    return dict(record) if record is not None else None
+
+
+def _rows(records):
+    return [dict(record) for record in records]
+
+
+#quiz functions
+
+#fetching all kahoots
+@metrics.timed
+async def get_all_kahoots(con, after=None, limit: int = None, category: str = None, created_after=None, created_before=None):
+    """get the kahoots from the database, newest first, a page of them when given a limit"""
+    sql, params = db.kahoots_query(after, limit, category, created_after, created_before)
+    return _rows(await con.fetch(_numbered(sql, *range(1, len(params) + 1)), *params))
+
+@metrics.timed
+async def get_kahoots_page_version(
+    con, after=None, limit: int = None, category: str = None, created_after=None, created_before=None
+):
+    """the version of a page of kahoots, it changes when a kahoot on it does or the page holds other kahoots"""
+    sql, params = db.kahoots_page_version_query(after, limit, category, created_after, created_before)
+    return await con.fetchval(_numbered(sql, *range(1, len(params) + 1)), *params)
+
+
+@metrics.timed
+async def get_kahoot_version(con, kahoot_id: int):
+    """the version of a kahoot, bumped by triggers on every change to it, None if it doesn't exist"""
+    return await con.fetchval("SELECT version FROM kahoots WHERE id = $1;", kahoot_id)
+
+#creating a kahoot
+@metrics.timed
+async def create_kahoot(con, kahoot: schemas.KahootCreate):
+    """create a new kahoot in the database"""
+    return await con.fetchval(
+        "INSERT INTO kahoots (title, category) VALUES ($1, $2) RETURNING id;",
+        kahoot.title, kahoot.category,
+    )
+
+#get a singular kahoot
+@metrics.timed
+async def get_kahoot(con, kahoot_id: int):
+    """get a single kahoot by id from the database"""
+    kahoot = await con.fetchrow("SELECT * FROM kahoots WHERE id = $1", kahoot_id)
+    if not kahoot:
+        raise exceptions.KahootNotFoundException(kahoot_id)
+    return _row(kahoot)
+
+@metrics.timed
+async def get_kahoot_full(con, kahoot_id: int):
+    """get a kahoot with all of its questions, answers and media in one round trip"""
+    kahoot = await con.fetchrow(KAHOOT_FULL_SQL, kahoot_id)
+    if not kahoot:
+        raise exceptions.KahootNotFoundException(kahoot_id)
+    return _row(kahoot)
+
+#update a kahoot
+@metrics.timed
+async def update_kahoot(con, kahoot_id: int, kahoot: schemas.KahootCreate):
+    """update a kahoot in the database"""
+    updated_id = await con.fetchval(
+        "UPDATE kahoots SET title = $1, category = $2 WHERE id = $3 RETURNING id;",
+        kahoot.title, kahoot.category, kahoot_id,
+    )
+    if updated_id is None:
+        raise exceptions.KahootNotFoundException(kahoot_id)
+    return updated_id
+
+#delete a kahoot
+@metrics.timed
+async def delete_kahoot(con, kahoot_id: int):
+    """delete a kahoot from the database"""
+    deleted_id = await con.fetchval("DELETE FROM kahoots WHERE id = $1 RETURNING id;", kahoot_id)
+    if deleted_id is None:
+        raise exceptions.KahootNotFoundException(kahoot_id)
+    answer_keys.invalidate_kahoot(kahoot_id)
+    return deleted_id
+
+
+#question functions
+
+#get all questions for a specific quiz
+@metrics.timed
+async def get_all_questions_quiz(con, kahoot_id):
+    """get all questions for a specific quiz"""
+    return _rows(await con.fetch("SELECT * FROM questions WHERE kahoot_id = $1 ORDER BY id;", kahoot_id))
+
+#get a singular question
+@metrics.timed
+async def get_question(con, kahoot_id, question_id: int):
+    """get a single question by id"""
+    question = await con.fetchrow(
+        "SELECT * FROM questions WHERE id = $1 AND kahoot_id = $2", question_id, kahoot_id
+    )
+    if not question:
+        raise exceptions.QuestionNotFoundException(question_id)
+    return _row(question)
+
+
+@metrics.timed
+async def create_question(con, question: schemas.QuestionCreate):
+    """Create a new question"""
+    question_id = await con.fetchval(
+        "INSERT INTO questions (kahoot_id, question_text, question_type, time_limit, points) VALUES ($1, $2, $3, $4, $5) RETURNING id;",
+        question.kahoot_id, question.question_text, question.question_type, question.time_limit, question.points,
+    )
+    answer_keys.invalidate_kahoot(question.kahoot_id)
+    return question_id
+
+
+@metrics.timed
+async def import_kahoot(con, kahoot: schemas.KahootImport):
+    """Create a kahoot with all of its questions and answers in one transaction, three INSERTs in total"""
+    async with con.transaction():
+        kahoot_id = await con.fetchval(
+            "INSERT INTO kahoots (title, category) VALUES ($1, $2) RETURNING id;",
+            kahoot.title, kahoot.category,
+        )
+        question_ids, answer_ids = [], []
+        if kahoot.questions:
+            rows = await con.fetch(IMPORT_QUESTIONS_SQL, kahoot_id, *db.import_columns(kahoot))
+            # ids are handed out in input order, so sorting on them restores it
+            question_ids = sorted(row["id"] for row in rows)
+        columns = db.answer_columns(kahoot, question_ids)
+        if columns[0]:
+            rows = await con.fetch(IMPORT_ANSWERS_SQL, *columns)
+            answer_ids = sorted(row["id"] for row in rows)
+    return db.imported(kahoot_id, kahoot, question_ids, answer_ids)
+
+
+@metrics.timed
+async def update_question(con, question_id: int, question: schemas.QuestionCreate):
+    """Update a question"""
+    updated_id = await con.fetchval(
+        "UPDATE questions SET question_text = $1, question_type = $2, time_limit = $3, points = $4 WHERE id = $5 RETURNING id;",
+        question.question_text, question.question_type, question.time_limit, question.points, question_id,
+    )
+    if updated_id is None:
+        raise exceptions.QuestionNotFoundException(question_id)
+    answer_keys.invalidate_question(question_id)
+    return updated_id
+
+
+@metrics.timed
+async def delete_question(con, question_id):
+    """Delete a question"""
+    deleted_id = await con.fetchval("DELETE FROM questions WHERE id = $1 RETURNING id;", question_id)
+    if deleted_id is None:
+        raise exceptions.QuestionNotFoundException(question_id)
+    answer_keys.invalidate_question(question_id)
+    distributions.invalidate_question(question_id)
+    return deleted_id
+
+
+# answer functions
+
+@metrics.timed
+async def get_answers_by_question(con, question_id):
+    """Get all answers for a specific question"""
+    return _rows(await con.fetch("SELECT * FROM answers WHERE question_id = $1;", question_id))
+
+
+@metrics.timed
+async def create_answer(con, answer: schemas.AnswerCreate):
+    """Create a new answer"""
+    answer_id = await con.fetchval(
+        "INSERT INTO answers (question_id, answer_text, is_correct) VALUES ($1, $2, $3) RETURNING id;",
+        answer.question_id, answer.answer_text, answer.is_correct,
+    )
+    answer_keys.invalidate_question(answer.question_id)
+    distributions.invalidate_question(answer.question_id)
+    return answer_id
+
+
+@metrics.timed
+async def update_answer(con, answer_id, answer_text, is_correct):
+    """Update an answer"""
+    updated_id = await con.fetchval(
+        "UPDATE answers SET answer_text = $1, is_correct = $2 WHERE id = $3 RETURNING id;",
+        answer_text, is_correct, answer_id,
+    )
+    if updated_id is None:
+        raise exceptions.AnswerNotFoundException(f"Answer with id {answer_id} not found")
+    answer_keys.invalidate_answer(answer_id)
+    distributions.invalidate_answer(answer_id)
+    return updated_id
+
+
+@metrics.timed
+async def delete_answer(con, answer_id):
+    """Delete an answer"""
+    deleted_id = await con.fetchval("DELETE FROM answers WHERE id = $1 RETURNING id;", answer_id)
+    if deleted_id is None:
+        raise exceptions.AnswerNotFoundException(f"Answer with id {answer_id} not found")
+    answer_keys.invalidate_answer(answer_id)
+    distributions.invalidate_answer(answer_id)
+    return deleted_id
+
+
+# participant / player functions
+
+PARTICIPANTS_SQL = _numbered(db.PARTICIPANTS_SQL, 1)
+RUNNING_PARTICIPANTS_SQL = _numbered(db.RUNNING_PARTICIPANTS_SQL, 1)
+RUNNING_PARTICIPANT_SQL = _numbered(db.GET_RUNNING_PARTICIPANT.sql, 1)
+
+
+def _participants_sql():
+    return RUNNING_PARTICIPANTS_SQL if final_score.deferred() else PARTICIPANTS_SQL
+
+
+@metrics.timed
+async def get_participants(con, game_session_id: int):
+    """Get all participants for a game session"""
+    return _rows(await con.fetch(_participants_sql(), game_session_id))
+
+
+async def _columns_and_records(con, sql: str, *args):
+    # the prepared statement knows its columns even when no row comes back
+    statement = await con.prepare(sql)
+    records = await statement.fetch(*args)
+    return [attribute.name for attribute in statement.get_attributes()], records
+
+
+@metrics.timed(rows=lambda result: len(result[1]))
+async def get_participant_rows(con, game_session_id: int):
+    """get_participants as column names and Records, for fast_json"""
+    return await _columns_and_records(con, _participants_sql(), game_session_id)
+
+
+@metrics.timed
+async def get_participant(con, participant_id: int):
+    """Get a single participant by ID"""
+    if final_score.deferred():
+        participant = await con.fetchrow(RUNNING_PARTICIPANT_SQL, participant_id)
+    else:
+        participant = await con.fetchrow("SELECT * FROM participants WHERE id = $1;", participant_id)
+    if not participant:
+        raise exceptions.PlayerNotFoundException(participant_id)
+    return _row(participant)
+
+
+@metrics.timed
+async def create_participant(con, participant: schemas.ParticipantCreate):
+    """Create a new participant (join a game session) - use custom username or generate random"""
+    return (await create_participants(con, [participant]))[0]
+
+
+@metrics.timed
+async def create_participants(con, participants: List[schemas.ParticipantCreate]):
+    """Create many participants with one INSERT, returns their id and username in order"""
+    session_ids = [participant.game_session_id for participant in participants]
+    try:
+        rows = await con.fetch(
+            CREATE_PARTICIPANTS_SQL,
+            session_ids,
+            [participant.user_id for participant in participants],
+            [participant.username for participant in participants],
+        )
+    except asyncpg.ForeignKeyViolationError as e:
+        if e.constraint_name == "participants_game_session_id_fkey" and len(set(session_ids)) == 1:
+            raise exceptions.GameSessionNotFoundException(session_ids[0])
+        raise
+    # ids are handed out in input order, so sorting on them restores it
+    rows = sorted(rows, key=lambda row: row["id"])
+    db.participants_joined(rows)
+    return [{"id": row["id"], "username": row["username"]} for row in rows]
+
+
+@metrics.timed
+async def delete_participant(con, participant_id: int):
+    """Delete a participant (when they leave the game session)"""
+    result = await con.fetchrow(
+        "DELETE FROM participants WHERE id = $1 RETURNING id, game_session_id;", participant_id
+    )
+    if not result:
+        raise exceptions.PlayerNotFoundException(participant_id)
+    board = leaderboards.get(result["game_session_id"])
+    if board is not None:
+        board.remove_participant(participant_id)
+    # their answers are gone as well, count the session's questions again
+    distributions.drop(result["game_session_id"])
+    session_events.leaderboard_changed(result["game_session_id"])
+    return result["id"]
+
+
+@metrics.timed
+async def update_participant_username(con, participant_id: int, username: str):
+    """Update a participant's username"""
+    result = await con.fetchrow(
+        "UPDATE participants SET username = $1 WHERE id = $2 RETURNING id, game_session_id;",
+        username, participant_id,
+    )
+    if not result:
+        raise exceptions.PlayerNotFoundException(participant_id)
+    board = leaderboards.get(result["game_session_id"])
+    if board is not None:
+        board.rename_participant(participant_id, username)
+    session_events.leaderboard_changed(result["game_session_id"])
+    return result["id"]
+
+
+@metrics.timed
+async def update_participant_score(con, participant_id: int, final_score: int, rank: int = None):
+    """Update a participant's final score and rank"""
+    if rank is not None:
+        updated_id = await con.fetchval(
+            "UPDATE participants SET final_score = $1, rank = $2 WHERE id = $3 RETURNING id;",
+            final_score, rank, participant_id,
+        )
+    else:
+        updated_id = await con.fetchval(
+            "UPDATE participants SET final_score = $1 WHERE id = $2 RETURNING id;",
+            final_score, participant_id,
+        )
+    if updated_id is None:
+        raise exceptions.PlayerNotFoundException(participant_id)
+    return updated_id
+
+# game session functions
+
+@metrics.timed
+async def get_game_sessions(
+    con, after=None, limit: int = None, kahoot_id: int = None, is_active: bool = None, started_after=None, started_before=None
+):
+    """Get the game sessions, newest first, a page of them when given a limit"""
+    sql, params = db.game_sessions_query(after, limit, kahoot_id, is_active, started_after, started_before)
+    return _rows(await con.fetch(_numbered(sql, *range(1, len(params) + 1)), *params))
+
+
+@metrics.timed
+async def get_game_session(con, session_id):
+    """Get a single game session by ID"""
+    session = await con.fetchrow("SELECT * FROM game_sessions WHERE id = $1;", session_id)
+    if not session:
+        raise exceptions.GameSessionNotFoundException(f"Game session with id {session_id} not found")
+    return _row(session)
+
+
+@metrics.timed
+async def get_game_session_by_pin(con, pin):
+    """Get a game session by PIN, the live one if an ended session used the same PIN before"""
+    session_id = active_pins.get(pin)
+    if session_id is not None:
+        session = await con.fetchrow("SELECT * FROM game_sessions WHERE id = $1;", session_id)
+        if db.live_session_of_pin(session, pin):
+            return _row(session)
+        # ended through another worker or by hand, see session_pins.py
+        active_pins.remove(pin, session_id)
+    session = await con.fetchrow(
+        "SELECT * FROM game_sessions WHERE session_pin = $1 ORDER BY is_active DESC, id DESC LIMIT 1;", pin
+    )
+    if not session:
+        raise exceptions.GameSessionNotFoundException(pin, "pin")
+    session = _row(session)
+    if session["is_active"]:
+        active_pins.add(session)
+    return session
+
+
+@metrics.timed
+async def load_session_pins(con):
+    """Shuffle the PIN pool once, leaving out the PINs of the live sessions"""
+    rows = await con.fetch("SELECT session_pin FROM game_sessions WHERE is_active;")
+    # shuffling a million PINs takes most of a second, keep it off the event loop
+    await asyncio.to_thread(pin_allocator.load, [row["session_pin"] for row in rows])
+
+
+@metrics.timed
+async def create_game_session(con, session: schemas.GameSessionCreate):
+    """Create a new game session, with a free PIN from the pool unless the host picked one"""
+    if session.session_pin is None and not pin_allocator.loaded:
+        await load_session_pins(con)
+    for attempt in range(PIN_ATTEMPTS):
+        session_pin = session.session_pin or pin_allocator.allocate()
+        try:
+            created = _row(await con.fetchrow(
+                "INSERT INTO game_sessions (kahoot_id, session_pin) VALUES ($1, $2) RETURNING *;",
+                session.kahoot_id, session_pin,
+            ))
+            break
+        except asyncpg.UniqueViolationError:
+            # a live session holds this PIN already, e.g one handed out by another worker
+            if session.session_pin is not None or attempt == PIN_ATTEMPTS - 1:
+                raise exceptions.SessionPinInUseException(session_pin)
+    if session.session_pin is not None:
+        pin_allocator.claim(session_pin)
+    active_pins.add(created)
+    # warm the answer key now, so the first answers of the game don't have to load it
+    answer_keys.start_session(created["id"], session.kahoot_id)
+    if answer_keys.get(session.kahoot_id) is None:
+        await load_answer_key(con, session.kahoot_id)
+    return created
+
+
+async def close_answers(session_id: int):
+    """db.close_answers, the wait for the queued answers happens in a worker thread"""
+    if answer_buffer.enabled():
+        answer_buffer.answers.close_session(session_id)
+        if not await asyncio.to_thread(answer_buffer.answers.drain):
+            answer_buffer.answers.reopen_session(session_id)
+            raise exceptions.AnswersNotWrittenException(session_id)
+
+
+@metrics.timed
+async def end_game_session(con, session_id):
+    """End a game session by setting is_active to false and writing its final standings"""
+    await close_answers(session_id)
+    try:
+        async with con.transaction():
+            result = await con.fetchrow(SET_ACTIVE_SQL, False, session_id)
+            if not result:
+                raise exceptions.GameSessionNotFoundException(f"Game session with id {session_id} not found")
+            if result["was_active"]:
+                await con.execute(FINISH_SESSION_SQL, session_id)
+    except Exception:
+        # the session didn't end, it takes answers again
+        db.reopen_answers(session_id)
+        raise
+    if result["was_active"]:
+        db.release_session_pin(session_id, result["session_pin"])
+    answer_keys.end_session(session_id)
+    leaderboards.drop(session_id)
+    distributions.drop(session_id)
+    session_events.session_ended(session_id)
+    return result["id"]
+
+
+@metrics.timed
+async def set_game_session_active(con, session_id: int, is_active: bool):
+    """Set a game session active or inactive, its final standings are written when it ends"""
+    if not is_active:
+        await close_answers(session_id)
+    try:
+        async with con.transaction():
+            result = _row(await con.fetchrow(SET_ACTIVE_SQL, is_active, session_id))
+            if result is None:
+                raise exceptions.GameSessionNotFoundException(session_id)
+            if is_active:
+                # the game goes on, its standings aren't final anymore
+                await con.execute(CLEAR_RESULTS_SQL, session_id)
+            elif result["was_active"]:
+                await con.execute(FINISH_SESSION_SQL, session_id)
+    except asyncpg.UniqueViolationError:
+        # another live session got the PIN after this one ended
+        raise exceptions.SessionPinInUseException((await get_game_session(con, session_id))["session_pin"])
+    except Exception:
+        if not is_active:
+            # the session didn't end, it takes answers again
+            db.reopen_answers(session_id)
+        raise
+    was_active = result.pop("was_active")
+    if is_active:
+        db.reopen_answers(session_id)
+        pin_allocator.claim(result["session_pin"])
+        active_pins.add(result)
+    else:
+        if was_active:
+            db.release_session_pin(session_id, result["session_pin"])
+        answer_keys.end_session(session_id)
+        leaderboards.drop(session_id)
+        distributions.drop(session_id)
+        session_events.session_ended(session_id)
+    return result["id"]
+
+
+@metrics.timed
+async def delete_game_session(con, session_id: int):
+    """Delete a game session"""
+    result = await con.fetchrow(
+        "DELETE FROM game_sessions WHERE id = $1 RETURNING id, session_pin, is_active;", session_id
+    )
+    if not result:
+        raise exceptions.GameSessionNotFoundException(session_id)
+    if result["is_active"]:
+        db.release_session_pin(session_id, result["session_pin"])
+    answer_keys.end_session(session_id)
+    leaderboards.drop(session_id)
+    distributions.drop(session_id)
+    session_events.session_ended(session_id)
+    return result["id"]
+
+
+@metrics.timed
+async def start_question(con, session_id: int, question_id: int):
+    """Move a live session on to one of its kahoot's questions and tell the players about it"""
+    question = await con.fetchrow(
+        """SELECT q.* FROM questions q
+        JOIN game_sessions gs ON gs.kahoot_id = q.kahoot_id
+        WHERE gs.id = $1 AND gs.is_active AND q.id = $2;""",
+        session_id, question_id,
+    )
+    if not question:
+        raise exceptions.QuestionNotFoundException(question_id)
+    answers = await con.fetch("SELECT id, answer_text FROM answers WHERE question_id = $1 ORDER BY id;", question_id)
+    if LIVE_DISTRIBUTION and distributions.get(session_id, question_id) is None:
+        # counted from now on, so the first answers to it don't all run the GROUP BY
+        await load_distribution(con, session_id, question_id)
+    session_events.question_started(session_id, _row(question), answers)
+    return question["id"]
+
+
+#player score/ leaderboard functions
+
+@metrics.timed
+async def load_answer_key(con, kahoot_id: int):
+    """Load the answer key of a kahoot into the answer cache"""
+    generation = answer_keys.generation
+    rows = await con.fetch(
+        """SELECT q.id, q.points, q.time_limit, a.id, a.is_correct
+        FROM questions q
+        LEFT JOIN answers a ON a.question_id = q.id
+        WHERE q.kahoot_id = $1;""",
+        kahoot_id,
+    )
+    key = AnswerKey.from_rows(kahoot_id, rows)
+    answer_keys.put(key, generation)
+    return key
+
+
+@metrics.timed
+async def get_session_answer_key(con, session_id: int):
+    """Get the cached answer key of the kahoot a session plays, loading it on first use"""
+    kahoot_id = answer_keys.kahoot_for_session(session_id)
+    if kahoot_id is None:
+        session = await con.fetchrow("SELECT kahoot_id, is_active FROM game_sessions WHERE id = $1;", session_id)
+        if not session:
+            return None
+        kahoot_id = session["kahoot_id"]
+        if session["is_active"]:
+            answer_keys.start_session(session_id, kahoot_id)
+    return answer_keys.get(kahoot_id) or await load_answer_key(con, kahoot_id)
+
+
+@metrics.timed
+async def score_answer(con, player_answer: schemas.PlayerAnswerCreate):
+    """Score an answer without storing it, for the buffered write path"""
+    answer_key = await get_session_answer_key(con, player_answer.session_id)
+    if answer_keys.kahoot_for_session(player_answer.session_id) is None:
+        # only live sessions are in there, the buffer would write this after the final standings
+        raise exceptions.GameSessionNotLiveException(player_answer.session_id)
+    cached = answer_key.answers.get(player_answer.answer_id) if answer_key else None
+    if cached is not None:
+        return db.calculate_points(cached[1], player_answer.time_taken)
+    is_correct = await con.fetchval("SELECT is_correct FROM answers WHERE id = $1;", player_answer.answer_id)
+    if is_correct is None:
+        raise exceptions.AnswerNotFoundException(player_answer.answer_id)
+    return db.calculate_points(is_correct, player_answer.time_taken)
+
+
+@metrics.timed
+async def submit_answer(con, player_answer: schemas.PlayerAnswerCreate):
+    """Submit a player's answer and calculate points"""
+    # score with the cached answer key when we can, then the database only has to write
+    answer_key = await get_session_answer_key(con, player_answer.session_id)
+    cached = answer_key.answers.get(player_answer.answer_id) if answer_key else None
+    if cached is not None:
+        _, is_correct = cached
+        points_earned = db.calculate_points(is_correct, player_answer.time_taken)
+        score_id = await con.fetchval(
+            "SELECT record_player_answer($1, $2, $3, $4, $5, $6, $7);",
+            player_answer.session_id,
+            player_answer.participant_id,
+            player_answer.question_id,
+            player_answer.answer_id,
+            player_answer.time_taken,
+            points_earned,
+            not final_score.deferred(),
+        )
+    else:
+        # the answer isn't in the key, same stored function as db.submit_answer checks and scores it
+        result = await con.fetchrow(
+            "SELECT score_id, score_points FROM submit_player_answer($1, $2, $3, $4, $5, $6);",
+            player_answer.session_id,
+            player_answer.participant_id,
+            player_answer.question_id,
+            player_answer.answer_id,
+            player_answer.time_taken,
+            not final_score.deferred(),
+        )
+        if not result:
+            raise exceptions.AnswerNotFoundException(player_answer.answer_id)
+        score_id, points_earned = result["score_id"], result["score_points"]
+    await record_live_score(con, player_answer.session_id, player_answer.participant_id, points_earned, score_id)
+    await record_answer_distribution(con, player_answer, score_id)
+    return score_id
+
+
+@metrics.timed
+async def load_leaderboard(con, session_id: int):
+    """Build the live leaderboard of an active session from SQL, None if the session isn't live"""
+    # catches up on the answers the buffer's flusher writes meanwhile, see db.load_distribution
+    position = snapshots.written_answers.start()
+    try:
+        return await _load_leaderboard(con, session_id, position)
+    finally:
+        snapshots.written_answers.finish(position)
+
+
+async def _load_leaderboard(con, session_id: int, position: int):
+    # all of the statements below have to see the same snapshot of player_answers
+    async with con.transaction(isolation="repeatable_read", readonly=True):
+        is_active = await con.fetchval("SELECT is_active FROM game_sessions WHERE id = $1;", session_id)
+        if not is_active:
+            return None
+        rows = _rows(await con.fetch(LEADERBOARD_SQL + ";", session_id))
+        snapshot = await snapshots.read_async(con, session_id)
+    return leaderboards.install(SessionLeaderboard(session_id, rows, snapshot), position)
+
+
+@metrics.timed
+async def get_live_leaderboard(con, session_id: int):
+    """Get the in-memory leaderboard of a live session, building it on first use"""
+    if not LIVE_LEADERBOARD:
+        return None
+    return leaderboards.get(session_id) or await load_leaderboard(con, session_id)
+
+
+@metrics.timed
+async def record_live_score(con, session_id: int, participant_id: int, points_earned: int, score_id: int = None):
+    """Add a submitted answer to the session's live leaderboard"""
+    board = await get_live_leaderboard(con, session_id)
+    if board is not None and not board.record(participant_id, points_earned, score_id):
+        # a participant that joined through another worker, put them on the board and try again
+        username = await con.fetchval("SELECT username FROM participants WHERE id = $1;", participant_id)
+        if username is not None:
+            board.add_participant(participant_id, username)
+            board.record(participant_id, points_earned, score_id)
+    session_events.leaderboard_changed(session_id)
+
+
+@metrics.timed
+async def get_leaderboard(con, game_session_id: int, limit: int = None):
+    """Get the leaderboard for a game session, or only its top `limit` entries"""
+    board = await get_live_leaderboard(con, game_session_id)
+    if board is not None:
+        return board.entries(limit)
+    return _rows(await con.fetch(RESULTS_OR_LEADERBOARD_SQL + ";", game_session_id, limit))
+
+
+@metrics.timed(rows=lambda result: len(result[1]))
+async def get_leaderboard_rows(con, game_session_id: int, limit: int = None):
+    """get_leaderboard for fast_json, the live board's entries with None for columns, or the SQL rows as Records"""
+    board = await get_live_leaderboard(con, game_session_id)
+    if board is not None:
+        return None, board.entries(limit)
+    return await _columns_and_records(con, RESULTS_OR_LEADERBOARD_SQL + ";", game_session_id, limit)
+
+
+@metrics.timed
+async def get_participant_rank(con, game_session_id: int, participant_id: int, neighbours: int = 2):
+    """Get a participant's rank and score in a game session, plus the players just above and below them"""
+    board = await get_live_leaderboard(con, game_session_id)
+    if board is not None:
+        result = board.rank(participant_id, neighbours)
+        if result is None:
+            raise exceptions.PlayerNotFoundException(participant_id)
+        return result
+    rows = _rows(await con.fetch(RESULTS_RANK_SQL, game_session_id, participant_id, neighbours))
+    if not rows:
+        # a live session, or a participant that isn't in this one
+        rows = _rows(await con.fetch(PARTICIPANT_RANK_SQL, game_session_id, participant_id, neighbours))
+    return db.rank_from_rows(rows, participant_id)
+
+
+@metrics.timed
+async def load_distribution(con, session_id: int, question_id: int):
+    """Count the answers to a question of a session with one GROUP BY, kept in memory while the session is live"""
+    # catches up on the batches the buffer's flusher writes meanwhile, see db.load_distribution
+    position = snapshots.written_answers.start()
+    try:
+        return await _load_distribution(con, session_id, question_id, position)
+    finally:
+        snapshots.written_answers.finish(position)
+
+
+async def _load_distribution(con, session_id: int, question_id: int, position: int):
+    # all of the statements below have to see the same snapshot of player_answers
+    async with con.transaction(isolation="repeatable_read", readonly=True):
+        session = await con.fetchrow(QUESTION_SESSION_SQL, session_id, question_id)
+        if not session:
+            raise exceptions.QuestionNotFoundException(question_id)
+        rows = _rows(await con.fetch(DISTRIBUTION_SQL, session_id, question_id))
+        if not (LIVE_DISTRIBUTION and session["is_active"]):
+            # an ended session, nothing will be added to it
+            return QuestionDistribution(session_id, question_id, rows, snapshots.AnswerSnapshot())
+        snapshot = await snapshots.read_async(con, session_id)
+    return distributions.install(QuestionDistribution(session_id, question_id, rows, snapshot), position)
+
+
+@metrics.timed
+async def record_answer_distribution(con, player_answer: schemas.PlayerAnswerCreate, score_id: int = None):
+    """Add a submitted answer to the live distribution of its question"""
+    if not LIVE_DISTRIBUTION:
+        return
+    live = distributions.get(player_answer.session_id, player_answer.question_id)
+    if live is None:
+        try:
+            live = await load_distribution(con, player_answer.session_id, player_answer.question_id)
+        except exceptions.QuestionNotFoundException:
+            # not a question of the session's kahoot, there's nothing to count it in
+            return
+    live.record(player_answer.answer_id, player_answer.time_taken, score_id)
+
+
+@metrics.timed
+async def get_answer_distribution(con, session_id: int, question_id: int):
+    """Get how often each answer of a question was picked in a session, and how long that took on average"""
+    live = distributions.get(session_id, question_id) if LIVE_DISTRIBUTION else None
+    return (live or await load_distribution(con, session_id, question_id)).entries()
+
+
+@metrics.timed
+async def get_participant_answers(con, session_id: int, participant_id: int):
+    """Get all answers for a specific participant in a game session"""
+    return _rows(await con.fetch(
+        """
+        SELECT pa.*, q.question_text, a.answer_text, a.is_correct
+        FROM player_answers pa
+        JOIN questions q ON pa.question_id = q.id
+        JOIN answers a ON pa.answer_id = a.id
+        WHERE pa.session_id = $1 AND pa.participant_id = $2
+        ORDER BY pa.id;
+        """,
+        session_id, participant_id,
+    ))
+
+
+SESSION_EXPORT_SQL = _numbered(db.SESSION_EXPORT_SQL, 1)
+KAHOOT_EXPORT_SQL = _numbered(db.KAHOOT_EXPORT_SQL, 1)
+
+
+async def stream_rows(con, sql: str, args, itersize: int):
+    """yield the rows of a query as tuples from a server side cursor, fetching itersize rows per round trip"""
+    async with con.transaction():
+        async for record in con.cursor(sql, *args, prefetch=itersize):
+            yield tuple(record)
+
+
+async def export_session_answers(con, session_id: int, itersize: int = 2000):
+    """Stream every answer of a game session as tuples of EXPORT_COLUMNS, without holding them all in memory"""
+    await get_game_session(con, session_id)
+    async for row in stream_rows(con, SESSION_EXPORT_SQL, (session_id,), itersize):
+        yield row
+
+
+async def export_kahoot_answers(con, kahoot_id: int, itersize: int = 2000):
+    """Stream every answer of every session played with a kahoot as tuples of EXPORT_COLUMNS"""
+    await get_kahoot(con, kahoot_id)
+    async for row in stream_rows(con, KAHOOT_EXPORT_SQL, (kahoot_id,), itersize):
+        yield row
@@ -1,21 +1,32 @@
 import os
+import threading
+import time
+from contextlib import contextmanager
 import psycopg2
+from psycopg2 import pool
 from dotenv import load_dotenv
+import exceptions
+import slow_queries
 
 load_dotenv(override=True)
 
 DATABASE_NAME = os.getenv("DATABASE_NAME")
 PASSWORD = os.getenv("PASSWORD")
 
+# connection pool settings, override them in the .env-file if needed
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "20"))
+# seconds a request waits for a free connection before giving up
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5"))
+# connections idle for longer than this many seconds get pinged before being handed out
+DB_POOL_CHECK_AFTER = float(os.getenv("DB_POOL_CHECK_AFTER", "30"))
+# connections the request routes leave free for work outside a request: the answer flusher, the
+# join coalescer, websocket leaderboard reads and streaming exports
+DB_POOL_BACKGROUND_RESERVE = int(os.getenv("DB_POOL_BACKGROUND_RESERVE", "4"))
 
-def get_connection():
-    """
-    Function that returns a single connection
-    In reality, we might use a connection pool, since
-    this way we'll start a new connection each time
-    someone hits one of our endpoints, which isn't great for performance
-    """
-    return psycopg2.connect(
+
+def _connection_kwargs():
+    return dict(
         dbname=DATABASE_NAME,
         user="postgres",  # change if needed
         password=PASSWORD,
@@ -24,110 +35,136 @@ def get_connection():
     )
 
 
-def create_tables():
+def get_connection():
+    """
+    Function that returns a single, unpooled connection.
+    The api uses the pool below instead, this one is meant for scripts
+    like create_tables that only need one connection for a short while
+    """
+    return psycopg2.connect(**_connection_kwargs())
+
+
+class ConnectionPool:
     """
-    A function to create the necessary tables for the project.
+    Thread safe pool of psycopg2 connections.
+    psycopg2's ThreadedConnectionPool raises right away when every connection is
+    in use, so a semaphore in front of it makes callers wait up to `timeout`
+    seconds for a connection to be handed back instead.
     """
-    connection = get_connection()
-    # Implement
-    with connection:
-        with connection.cursor() as cur:\
-            #making a usertype table to differentiate between admin, teacher and student
-            cur.execute("""
-                Create table if not exists usertype (
-                    id SERIAL PRIMARY KEY,
-                    is_admin BOOLEAN NOT NULL,
-                    is_teacher BOOLEAN NOT NULL,
-                    is_student BOOLEAN NOT NULL);
-                    """)
-            #making a users table
-            cur.execute("""
-                Create table if not exists users (
-                    id SERIAL PRIMARY KEY,
-                    usertype_id BIGINT REFERENCES usertype(id) ON DELETE SET NULL,
-                    username VARCHAR(50) UNIQUE NOT NULL,
-                    password_hash VARCHAR(255) NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
-                    """)
-            #making a kahoots table
-            cur.execute(""" Create table if not exists kahoots (
-                        id SERIAL PRIMARY KEY,
-                        title VARCHAR(100) NOT NULL,
-                        category VARCHAR(50),
-                        creation_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
-                        """)
-            #making a enum for the different ypes of managment
-            cur.execute(""" CREATE TYPE kahoot_managment AS ENUM (
-                        'owner', 'editor', 'viewer'); """)
-            
-            #making a kahoot_user_managment table to manage permissions
-            cur.execute(""" Create table if not exists kahoot_user_managment (
-                        kahoot_id BIGINT REFERENCES kahoots(id) ON DELETE CASCADE,
-                        user_id BIGINT REFERENCES users(id) ON DELETE CASCADE,
-                        PRIMARY KEY (kahoot_id, user_id),
-                        managment_type kahoot_managment NOT NULL);
-                        """)
-            
-            #making a media table
-            cur.execute(""" Create table if not exists media (
-                        id SERIAL PRIMARY KEY,
-                        media_type VARCHAR(50) NOT NULL,
-                        file_path TEXT NOT NULL);
-                        """)
-            #making a questions table
-            cur.execute(""" Create table if not exists questions (
-                        id SERIAL PRIMARY KEY,
-                        kahoot_id BIGINT REFERENCES kahoots(id) ON DELETE CASCADE,
-                        media_id BIGINT REFERENCES media(id) ON DELETE SET NULL,
-                        question_text TEXT NOT NULL,
-                        question_type VARCHAR(50) NOT NULL,
-                        time_limit INT NOT NULL,
-                        points INT NOT NULL);
-                        """)
-
-            cur.execute("""CREATE TABLE IF NOT EXISTS question_media (
-                        question_id BIGINT REFERENCES questions(id) ON DELETE CASCADE,
-                        media_id BIGINT REFERENCES media(id) ON DELETE CASCADE,
-                        PRIMARY KEY (question_id, media_id),
-                        display_order INT NOT NULL);
-                        """)
-            #making an answers table
-            cur.execute(""" Create table if not exists answers (
-                        id SERIAL PRIMARY KEY,
-                        question_id BIGINT REFERENCES questions(id) ON DELETE CASCADE,
-                        answer_text TEXT NOT NULL,
-                        is_correct BOOLEAN NOT NULL);
-                        """)
-            #making a game_sessions table
-            cur.execute(""" Create table if not exists game_sessions (
-                        id SERIAL PRIMARY KEY,
-                        kahoot_id BIGINT REFERENCES kahoots(id) ON DELETE CASCADE,
-                        session_pin VARCHAR(10) UNIQUE NOT NULL,
-                        is_active BOOLEAN DEFAULT TRUE,
-                        started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
-                        """)
-            #making a particpents/players table
-            cur.execute(""" Create table if not exists participants (
-                        id SERIAL PRIMARY KEY,
-                        game_session_id BIGINT REFERENCES game_sessions(id) ON DELETE CASCADE,
-                        user_id BIGINT REFERENCES users(id) ON DELETE SET NULL,
-                        username VARCHAR(100),
-                        joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        final_score INT DEFAULT 0,
-                        rank INT);
-                        """)
-            #making a player_answers table
-            cur.execute(""" Create table if not exists player_answers (
-                        id SERIAL PRIMARY KEY,
-                        session_id BIGINT REFERENCES game_sessions(id) ON DELETE CASCADE,
-                        participant_id BIGINT REFERENCES participants(id) ON DELETE CASCADE,
-                        question_id BIGINT REFERENCES questions(id) ON DELETE CASCADE,
-                        answer_id BIGINT REFERENCES answers(id) ON DELETE CASCADE,
-                        time_taken FLOAT NOT NULL,
-                        points_earned INT NOT NULL);
-                        """)
+
+    def __init__(self, minconn: int, maxconn: int, timeout: float, check_after: float, **kwargs):
+        self.timeout = timeout
+        self.check_after = check_after
+        self._pool = pool.ThreadedConnectionPool(minconn, maxconn, **kwargs)
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._last_used = {}
+
+    def getconn(self):
+        """check out a live connection, waiting at most `timeout` seconds for one"""
+        if not self._slots.acquire(timeout=self.timeout):
+            raise exceptions.ConnectionPoolExhaustedException(self.timeout)
+        try:
+            con = self._pool.getconn()
+            if not self._is_alive(con):
+                # throw the dead connection away, the pool opens a fresh one in its place
+                self._last_used.pop(id(con), None)
+                self._pool.putconn(con, close=True)
+                con = self._pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+        return con
+
+    def putconn(self, con):
+        """hand a connection back, the pool rolls back anything left uncommitted"""
+        self._last_used[id(con)] = time.monotonic()
+        try:
+            self._pool.putconn(con, close=bool(con.closed))
+        finally:
+            self._slots.release()
+
+    def closeall(self):
+        self._pool.closeall()
+        self._last_used.clear()
+
+    def _is_alive(self, con):
+        if con.closed:
+            return False
+        last_used = self._last_used.get(id(con))
+        if last_used is not None and time.monotonic() - last_used < self.check_after:
+            # recently used connections are trusted, pinging them on every checkout costs a round trip
+            return True
+        try:
+            with con.cursor() as cursor:
+                cursor.execute("SELECT 1;")
+            con.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+
+def _pool_connection_kwargs():
+    kwargs = _connection_kwargs()
+    if slow_queries.enabled():
+        # the api's connections report their slow statements, see slow_queries.py
+        kwargs["connection_factory"] = slow_queries.SlowQueryConnection
+    return kwargs
+
+
+def request_slots():
+    """how many pooled connections the request routes may hold at once"""
+    return max(1, DB_POOL_MAX_SIZE - DB_POOL_BACKGROUND_RESERVE)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+# the reserve, pooled_connection() waits for one of these so background work never takes a
+# connection a request is about to get and a request never takes the flusher's
+_background_slots = threading.BoundedSemaphore(max(1, DB_POOL_MAX_SIZE - request_slots()))
+
+
+def init_pool(max_size: int = DB_POOL_MAX_SIZE):
+    """create the shared connection pool, called once when the api starts"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(
+                min(DB_POOL_MIN_SIZE, max_size),
+                max_size,
+                DB_POOL_TIMEOUT,
+                DB_POOL_CHECK_AFTER,
+                **_pool_connection_kwargs(),
+            )
+    return _pool
+
+
+def close_pool():
+    """close every pooled connection, called when the api shuts down"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+
+@contextmanager
+def pooled_connection():
+    """borrow a connection of the background reserve and always give it back"""
+    if not _background_slots.acquire(timeout=DB_POOL_TIMEOUT):
+        raise exceptions.ConnectionPoolExhaustedException(DB_POOL_TIMEOUT)
+    try:
+        connection_pool = _pool or init_pool()
+        con = connection_pool.getconn()
+        try:
+            yield con
+        finally:
+            connection_pool.putconn(con)
+    finally:
+        _background_slots.release()
+
 
 if __name__ == "__main__":
-    # Only reason to execute this file would be to create new tables, meaning it serves a migration file
-    create_tables()
-    print("Tables created successfully.")
+    # the schema is created and kept up to date by the migrations in migrations/ now
+    import migrate
+
+    migrate.migrate()
@@ -70,3 +70,74 @@ class DatabaseException(KahootAppException):
             message += f": {details}"
         super().__init__(message)
 
+
+
+class ConnectionPoolExhaustedException(DatabaseException):
+    """Raised when no pooled connection is handed back within the checkout timeout"""
+
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        super().__init__("connection checkout", f"no connection available after {timeout}s")
+
+
+class AnswerBufferFullException(KahootAppException):
+    """Raised when the answer write buffer stays full, the database isn't keeping up"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        super().__init__(f"Answer buffer is full ({max_size} answers waiting), try again shortly")
+
+
+class AnswerBufferStoppedException(KahootAppException):
+    """Raised when an answer is submitted while the answer write buffer isn't writing"""
+
+    def __init__(self):
+        super().__init__("Answer buffer isn't taking answers right now, try again shortly")
+
+
+class AnswersNotWrittenException(KahootAppException):
+    """Raised when a game session can't end yet because its buffered answers aren't written"""
+
+    def __init__(self, session_id: int):
+        self.session_id = session_id
+        super().__init__(f"The buffered answers of game session {session_id} aren't written yet, try again shortly")
+
+
+class GameSessionNotLiveException(KahootAppException):
+    """Raised when an answer is submitted to a game session that has ended"""
+
+    def __init__(self, session_id: int):
+        self.session_id = session_id
+        super().__init__(f"Game session with id {session_id} isn't live, it doesn't take answers")
+
+
+class MigrationException(DatabaseException):
+    """Raised when the schema migrations can't be applied, e.g one was edited after it ran"""
+
+    def __init__(self, version: int, details: str):
+        self.version = version
+        super().__init__(f"migration {version:04d}", details)
+
+
+class SessionPinInUseException(KahootAppException):
+    """Raised when a live game session already uses the requested PIN"""
+
+    def __init__(self, pin: str):
+        self.pin = pin
+        super().__init__(f"Session pin '{pin}' is already used by a live game session")
+
+
+class NoFreeSessionPinException(KahootAppException):
+    """Raised when every session PIN is taken by a live game session"""
+
+    def __init__(self, live_sessions: int):
+        self.live_sessions = live_sessions
+        super().__init__(f"No free session pin, {live_sessions} live sessions hold all of them")
+
+
+class InvalidCursorException(KahootAppException):
+    """Raised when a pagination cursor wasn't handed out by the api"""
+
+    def __init__(self, cursor: str):
+        self.cursor = cursor
+        super().__init__(f"Invalid cursor '{cursor}'")
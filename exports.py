@@ -0,0 +1,87 @@
+import csv
+import io
+import json
+import os
+from datetime import datetime
+import db
+import db_async
+import db_setup
+"""
+Streaming exports of session results, as NDJSON (one JSON object per line) or CSV.
+
+The rows come from a server side cursor (db.stream_rows, db_async.stream_rows), EXPORT_ITERSIZE
+at a time, and are encoded and sent in chunks of the same size, so exporting a million answers
+takes as much memory as exporting a thousand. An export borrows a pooled connection of its own
+for as long as the response streams, and gives it back when the client has everything or goes away.
+
+The routes pull the first chunk before they answer, so a session or kahoot that doesn't exist is a
+404 instead of an empty 200.
+"""
+
+EXPORT_ITERSIZE = int(os.getenv("EXPORT_ITERSIZE", "2000"))
+
+MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+class Encoder:
+    """turns batches of row tuples into text, the CSV header goes in front of the first batch"""
+
+    def __init__(self, format: str, columns):
+        self.format = format
+        self.columns = columns
+        self._header_written = False
+
+    def encode(self, rows):
+        if self.format == "ndjson":
+            columns = self.columns
+            return "".join([json.dumps(dict(zip(columns, row)), default=_json_value) + "\n" for row in rows])
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if not self._header_written:
+            writer.writerow(self.columns)
+            self._header_written = True
+        writer.writerows(rows)
+        return buffer.getvalue()
+
+
+def _json_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def stream(export, resource_id: int, format: str):
+    """chunks of an export from db.py, on a connection held until the last chunk"""
+    encoder = Encoder(format, db.EXPORT_COLUMNS)
+    with db_setup.pooled_connection() as con:
+        batch = []
+        for row in export(con, resource_id, EXPORT_ITERSIZE):
+            batch.append(row)
+            if len(batch) >= EXPORT_ITERSIZE:
+                yield encoder.encode(batch)
+                batch = []
+        yield encoder.encode(batch)
+
+
+async def astream(export, resource_id: int, format: str):
+    """chunks of an export from db_async.py, on a connection held until the last chunk"""
+    encoder = Encoder(format, db.EXPORT_COLUMNS)
+    async with db_async.pooled_connection() as con:
+        batch = []
+        async for row in export(con, resource_id, EXPORT_ITERSIZE):
+            batch.append(row)
+            if len(batch) >= EXPORT_ITERSIZE:
+                yield encoder.encode(batch)
+                batch = []
+        yield encoder.encode(batch)
+
+
+def filename(kind: str, resource_id: int, format: str):
+    return {"Content-Disposition": f'attachment; filename="{kind}-{resource_id}.{format}"'}
+
+
+async def achain(first: str, chunks):
+    """the chunk a route already pulled, followed by the rest of the stream"""
+    yield first
+    async for chunk in chunks:
+        yield chunk
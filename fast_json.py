@@ -0,0 +1,90 @@
+import json
+import os
+from datetime import date, datetime
+from operator import itemgetter
+from fastapi.responses import JSONResponse
+try:
+    import orjson
+except ImportError:  # optional, pip install orjson, the standard json module does the same more slowly
+    orjson = None
+"""
+Fast path for the big list responses, used when FAST_RESPONSES=1.
+
+Normally a list endpoint gets RealDictRows from db.py, FastAPI validates every row into its
+response_model, turns the models back into dicts with jsonable_encoder and encodes those with the
+json module, which on a leaderboard of a few thousand players costs more than the query. The fast
+path trusts what the database returns: rows (tuples from a plain cursor where db.py offers them)
+are shaped into dicts with exactly the fields of the response model, in its order, with the
+model's defaults for fields the query doesn't have, and encoded once with orjson when it's
+installed. The result is the same JSON the normal path sends.
+
+The routes keep their response_model, so the OpenAPI schema doesn't change, only the response
+they return skips it.
+"""
+
+FAST_RESPONSES = os.getenv("FAST_RESPONSES", "0") == "1"
+
+
+def _default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def dumps(content):
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, default=_default, separators=(",", ":"), ensure_ascii=False).encode()
+
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content):
+        return dumps(content)
+
+
+class RowShape:
+    """turns rows with some columns into dicts with exactly the fields of a response model"""
+
+    def __init__(self, model, columns):
+        fields = model.model_fields
+        self.names = tuple(fields)
+        missing = [name for name in self.names if name not in columns]
+        # fields the query doesn't select are appended to every row with the model's default
+        self.defaults = tuple(fields[name].get_default(call_default_factory=True) for name in missing)
+        positions = [(list(columns) + missing).index(name) for name in self.names]
+        pick = itemgetter(*positions)
+        self.pick = pick if len(positions) > 1 else lambda row: (pick(row),)
+
+    def dicts(self, rows):
+        names, pick, defaults = self.names, self.pick, self.defaults
+        if defaults:
+            return [dict(zip(names, pick(tuple(row) + defaults))) for row in rows]
+        return [dict(zip(names, pick(row))) for row in rows]
+
+
+_shapes = {}
+
+
+def model_rows(model, rows, columns=None):
+    """
+    rows as plain dicts shaped like `model`, without validating them. The rows are tuples (or
+    asyncpg Records) of `columns`, or mappings such as RealDictRows when columns is None
+    """
+    if not rows:
+        return []
+    if columns is None:
+        columns = tuple(rows[0].keys())
+        rows = [tuple(row.values()) for row in rows]
+    key = (model, tuple(columns))
+    shape = _shapes.get(key)
+    if shape is None:
+        shape = _shapes[key] = RowShape(model, columns)
+    return shape.dicts(rows)
+
+
+def response(model, rows, columns=None, headers: dict = None):
+    return FastJSONResponse(model_rows(model, rows, columns), headers=headers)
+
+
+def enabled():
+    return FAST_RESPONSES
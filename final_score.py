@@ -0,0 +1,15 @@
+import os
+"""
+FINAL_SCORE_MODE=deferred, in either ANSWER_WRITE_MODE, leaves participants.final_score alone while
+the game is played: answers are only inserted, without the UPDATE of the participant's row that adds
+up its score, which costs a row lock and a dead row version per answer on a table every player shares.
+Until the session ends db.py reads a live participant's final_score as the sum of their answers so
+far, end_game_session writes it once for everybody. With the default, running, it is kept up to date
+on every answer like before.
+"""
+
+FINAL_SCORE_MODE = os.getenv("FINAL_SCORE_MODE", "running")  # "running" or "deferred"
+
+
+def deferred():
+    return FINAL_SCORE_MODE == "deferred"
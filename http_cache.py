@@ -0,0 +1,39 @@
+import os
+from fastapi import Request, Response, status
+"""
+ETags for quiz content.
+
+Every kahoot has a version column that triggers bump whenever the kahoot, its questions, their
+answers or their media change (migrations/0004_kahoot_versions.sql). The ETag of a kahoot, of its
+questions and of GET /kahoots/{id}/full is derived from that version, so those endpoints look up
+the version first and answer a matching If-None-Match with a 304, without running the query for
+the content itself.
+
+A page of GET /kahoots/ is tagged with a hash of the ids and versions of the kahoots on it, which
+postgres computes over the page's range of the index (db.get_kahoots_page_version). A 304 never
+fetches the rows of the page, the page query only runs when the tag doesn't match.
+"""
+
+# seconds a client may reuse quiz content without asking again, 0 means revalidate every time
+QUIZ_CACHE_MAX_AGE = int(os.getenv("QUIZ_CACHE_MAX_AGE", "0"))
+
+
+def etag(*parts):
+    """weak ETag, the same content may be serialized a little differently by the sync and async app"""
+    return 'W/"' + "-".join(str(part) for part in parts) + '"'
+
+
+def headers(tag: str):
+    return {"ETag": tag, "Cache-Control": f"public, max-age={QUIZ_CACHE_MAX_AGE}, must-revalidate"}
+
+
+def not_modified(request: Request, tag: str):
+    """a 304 response when the client already has this version, otherwise None"""
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return None
+    # If-None-Match uses the weak comparison, W/ prefixes don't matter
+    wanted = {candidate.strip().removeprefix("W/") for candidate in if_none_match.split(",")}
+    if "*" in wanted or tag.removeprefix("W/") in wanted:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers(tag))
+    return None
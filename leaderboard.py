@@ -0,0 +1,165 @@
+import os
+import threading
+from sortedcontainers import SortedList
+from snapshots import AnswerSnapshot, written_answers
+"""
+Live leaderboards of the game sessions that are being played, kept in memory.
+
+Every board keeps its participants sorted on (-total_score, participant_id) in a SortedList,
+so recording an answer is O(log n) and GET /game-sessions/{id}/leaderboard never has to run
+the GROUP BY over player_answers. db.py builds a board from SQL the first time a live session
+needs one (e.g after a restart) and drops it when the session ends.
+
+Answers committed while a board is being built could otherwise be counted twice or not at all,
+so a board keeps the snapshot it was built from and skips the answers it already saw, see snapshots.py.
+With ANSWER_WRITE_MODE=buffered the buffer's flusher counts an answer once it's written, a board
+built meanwhile catches up on it when it's installed.
+
+Like the answer cache, boards live in the api process. With several uvicorn workers each
+worker only sees the answers it handled itself, so run a single worker when this is on.
+"""
+
+LIVE_LEADERBOARD = os.getenv("LIVE_LEADERBOARD", "1") == "1"
+
+
+class SessionLeaderboard:
+    """scores and correct answer counts of every participant in one session"""
+
+    def __init__(self, session_id: int, rows, snapshot: AnswerSnapshot):
+        self.session_id = session_id
+        self._lock = threading.Lock()
+        self._entries = {}  # participant_id -> [total_score, correct_answers, username]
+        self._order = SortedList()  # (-total_score, participant_id)
+        self._snapshot = snapshot
+        for row in rows:
+            self._entries[row["participant_id"]] = [row["total_score"], row["correct_answers"], row["username"]]
+            self._order.add((-row["total_score"], row["participant_id"]))
+
+    def add_participant(self, participant_id: int, username: str):
+        with self._lock:
+            if participant_id not in self._entries:
+                self._entries[participant_id] = [0, 0, username]
+                self._order.add((0, participant_id))
+
+    def remove_participant(self, participant_id: int):
+        with self._lock:
+            entry = self._entries.pop(participant_id, None)
+            if entry is not None:
+                self._order.remove((-entry[0], participant_id))
+
+    def rename_participant(self, participant_id: int, username: str):
+        with self._lock:
+            entry = self._entries.get(participant_id)
+            if entry is not None:
+                entry[2] = username
+
+    def record(self, participant_id: int, points_earned: int, score_id: int = None):
+        """add an answer's points, returns False when the participant isn't on this board"""
+        if score_id is not None and score_id in self._snapshot:
+            return True
+        with self._lock:
+            entry = self._entries.get(participant_id)
+            if entry is None:
+                return False
+            self._order.remove((-entry[0], participant_id))
+            entry[0] += points_earned
+            if points_earned > 0:
+                # only correct answers score points
+                entry[1] += 1
+            self._order.add((-entry[0], participant_id))
+        return True
+
+    def entries(self, limit: int = None):
+        """the board best first, or just its top `limit`, shaped like schemas.LeaderboardEntry"""
+        with self._lock:
+            order = self._order if limit is None else self._order.islice(0, limit)
+            return [self._entry(participant_id) for _, participant_id in order]
+
+    def rank(self, participant_id: int, neighbours: int):
+        """
+        a participant's rank plus the `neighbours` entries right above and below them,
+        shaped like schemas.ParticipantRank, None if they aren't on the board
+        """
+        with self._lock:
+            entry = self._entries.get(participant_id)
+            if entry is None:
+                return None
+            position = self._order.index((-entry[0], participant_id))
+            start = max(0, position - neighbours)
+            nearby = [
+                dict(self._entry(other_id), rank=start + offset + 1)
+                for offset, (_, other_id) in enumerate(self._order.islice(start, position + neighbours + 1))
+            ]
+            return dict(
+                self._entry(participant_id),
+                rank=position + 1,
+                participants=len(self._order),
+                neighbours=[other for other in nearby if other["participant_id"] != participant_id],
+            )
+
+    def _entry(self, participant_id: int):
+        total_score, correct_answers, username = self._entries[participant_id]
+        return {
+            "participant_id": participant_id,
+            "username": username,
+            "total_score": total_score,
+            "correct_answers": correct_answers,
+        }
+
+
+class LeaderboardRegistry:
+    """the boards of every live session in this process"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._boards = {}
+
+    def get(self, session_id: int):
+        return self._boards.get(session_id)
+
+    def install(self, board: SessionLeaderboard, position: int):
+        """
+        keep a freshly built board, unless another request built one first, and count the buffered
+        answers written since its build started at `position`
+        """
+        with written_answers.lock:
+            with self._lock:
+                installed = self._boards.setdefault(board.session_id, board)
+            if installed is board:
+                for score_id, (session_id, participant_id, _, _, _, points_earned) in written_answers.since(position):
+                    if session_id == board.session_id:
+                        board.record(participant_id, points_earned, score_id)
+        return installed
+
+    def record_written(self, answers):
+        """
+        count (score_id, row) pairs the answer buffer just wrote on the live boards, only with
+        written_answers.lock held. Returns the (board, score_id, participant_id, points_earned)
+        of the participants their board doesn't know yet
+        """
+        unknown = []
+        for score_id, (session_id, participant_id, _, _, _, points_earned) in answers:
+            board = self.get(session_id)
+            if board is not None and not board.record(participant_id, points_earned, score_id):
+                unknown.append((board, score_id, participant_id, points_earned))
+        return unknown
+
+    def record_unknown(self, unknown, usernames):
+        """put the participants record_written() didn't know on their boards and count their answers"""
+        with written_answers.lock:
+            for board, score_id, participant_id, points_earned in unknown:
+                # a board built since then has them, and counted the answer or caught up on it
+                if self.get(board.session_id) is board and participant_id in usernames:
+                    board.add_participant(participant_id, usernames[participant_id])
+                    board.record(participant_id, points_earned, score_id)
+
+    def drop(self, session_id: int):
+        with self._lock:
+            self._boards.pop(session_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._boards.clear()
+
+
+leaderboards = LeaderboardRegistry()
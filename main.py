@@ -0,0 +1,15 @@
+import os
+from dotenv import load_dotenv
+
+"""
+Entrypoint that picks which version of the api to serve, start it with uvicorn main:app --reload
+API_MODE=sync (default) serves app.py, where every route runs in uvicorn's thread pool on psycopg2
+API_MODE=async serves app_async.py, where every route is a coroutine on asyncpg
+"""
+
+load_dotenv(override=True)
+
+if os.getenv("API_MODE", "sync") == "async":
+    from app_async import app
+else:
+    from app import app
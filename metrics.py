@@ -0,0 +1,255 @@
+import functools
+import inspect
+import os
+import threading
+import time
+from bisect import bisect_left
+import answer_buffer
+"""
+Request and query metrics of the api, served in Prometheus' text format by GET /metrics.
+
+MetricsMiddleware counts the requests, the errors (responses with a 5xx status, which is what the
+routes turn every unexpected exception into) and a histogram of the latency of every route, labelled
+with the route's template (/game-sessions/{session_id}/leaderboard) rather than the path, so the
+number of series stays fixed. db.py and db_async.py put @timed on every function that talks to the
+database, which records the time spent in it, the rows it returned and the exceptions it raised.
+
+Recording has to be cheap, it happens several times per request. Every thread writes only into its
+own series, without a lock, and GET /metrics adds the series of all threads up when it's scraped.
+The series of a thread that has exited are folded into one retired set the next time that happens.
+METRICS=0 leaves the middleware out and the functions undecorated.
+"""
+
+METRICS = os.getenv("METRICS", "1") == "1"
+
+# upper bounds of the latency histograms, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Series:
+    """count, errors, rows and a latency histogram of one route or function, written by one thread"""
+
+    __slots__ = ("count", "errors", "rows", "seconds", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.rows = 0
+        self.seconds = 0.0
+        # per bucket, not cumulative, the last one is +Inf
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def observe(self, seconds: float, rows: int = 0, error: bool = False):
+        self.count += 1
+        self.seconds += seconds
+        self.rows += rows
+        self.errors += error
+        self.buckets[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    def add(self, other):
+        self.count += other.count
+        self.errors += other.errors
+        self.rows += other.rows
+        self.seconds += other.seconds
+        for i, value in enumerate(other.buckets):
+            self.buckets[i] += value
+
+
+class Registry:
+    """the series of every thread, keyed on (kind, labels)"""
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()  # only taken once per thread, and when scraping
+        self._threads = []  # (thread, its series)
+        self._retired = {}
+
+    def series(self, key):
+        try:
+            own = self._local.series
+        except AttributeError:
+            own = self._local.series = {}
+            with self._lock:
+                self._threads.append((threading.current_thread(), own))
+        series = own.get(key)
+        if series is None:
+            series = own[key] = Series()
+        return series
+
+    def collect(self):
+        """every series summed over all threads"""
+        with self._lock:
+            alive = []
+            for thread, own in self._threads:
+                if thread.is_alive():
+                    alive.append((thread, own))
+                else:
+                    _merge(self._retired, own)
+            self._threads = alive
+            totals = {}
+            _merge(totals, self._retired)
+            for _, own in alive:
+                _merge(totals, own)
+        return totals
+
+    def clear(self):
+        """forget everything recorded so far, for tests and benchmarks"""
+        with self._lock:
+            for _, own in self._threads:
+                own.clear()
+            self._retired.clear()
+
+
+def _merge(into: dict, series: dict):
+    # list() copies the items in one go, the owning thread may add a series meanwhile
+    for key, one in list(series.items()):
+        total = into.get(key)
+        if total is None:
+            total = into[key] = Series()
+        total.add(one)
+
+
+registry = Registry()
+
+
+class MetricsMiddleware:
+    """ASGI middleware that records every http request under its route template"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status_code = 500
+        started = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # a mounted app records the request itself, with the template of its own route
+            if "metrics.recorded" not in scope:
+                scope["metrics.recorded"] = True
+                elapsed = time.perf_counter() - started
+                route = scope.get("route")
+                template = getattr(route, "path", None) if hasattr(route, "methods") else None
+                key = ("http", scope["method"], template or "unmatched")
+                registry.series(key).observe(elapsed, 0, status_code >= 500)
+
+
+def _count_rows(result):
+    if result is None:
+        return 0
+    if isinstance(result, list):
+        return len(result)
+    return 1
+
+
+def timed(function=None, *, rows=_count_rows):
+    """
+    decorator for the functions of db.py and db_async.py, records the time spent in every call,
+    the rows it returned (counted with `rows`) and whether it raised
+    """
+    if function is None:
+        return functools.partial(timed, rows=rows)
+    if not METRICS:
+        return function
+    key = ("db", function.__name__)
+
+    if inspect.iscoroutinefunction(function):
+        @functools.wraps(function)
+        async def timed_coroutine(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                result = await function(*args, **kwargs)
+            except BaseException:
+                registry.series(key).observe(time.perf_counter() - started, 0, True)
+                raise
+            registry.series(key).observe(time.perf_counter() - started, rows(result))
+            return result
+
+        return timed_coroutine
+
+    @functools.wraps(function)
+    def timed_function(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            result = function(*args, **kwargs)
+        except BaseException:
+            registry.series(key).observe(time.perf_counter() - started, 0, True)
+            raise
+        registry.series(key).observe(time.perf_counter() - started, rows(result))
+        return result
+
+    return timed_function
+
+
+def _labels(**labels):
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels.items()
+    )
+    return ",".join(f'{name}="{value}"' for name, value in escaped)
+
+
+def _histogram(lines, name: str, labels: str, series: Series):
+    cumulative = 0
+    for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), series.buckets):
+        cumulative += count
+        lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+    lines.append(f"{name}_sum{{{labels}}} {series.seconds:.6f}")
+    lines.append(f"{name}_count{{{labels}}} {series.count}")
+
+
+def render():
+    """everything recorded so far, in Prometheus' text exposition format"""
+    totals = registry.collect()
+    http = sorted((key[1:], series) for key, series in totals.items() if key[0] == "http")
+    queries = sorted((key[1:], series) for key, series in totals.items() if key[0] == "db")
+    lines = []
+
+    lines.append("# HELP kahoot_http_requests_total Requests handled, per route template.")
+    lines.append("# TYPE kahoot_http_requests_total counter")
+    for (method, route), series in http:
+        lines.append(f"kahoot_http_requests_total{{{_labels(method=method, route=route)}}} {series.count}")
+    lines.append("# HELP kahoot_http_request_errors_total Requests answered with a 5xx status, per route template.")
+    lines.append("# TYPE kahoot_http_request_errors_total counter")
+    for (method, route), series in http:
+        lines.append(f"kahoot_http_request_errors_total{{{_labels(method=method, route=route)}}} {series.errors}")
+    lines.append("# HELP kahoot_http_request_duration_seconds Time until the response was sent, per route template.")
+    lines.append("# TYPE kahoot_http_request_duration_seconds histogram")
+    for (method, route), series in http:
+        _histogram(lines, "kahoot_http_request_duration_seconds", _labels(method=method, route=route), series)
+
+    lines.append("# HELP kahoot_db_query_duration_seconds Time spent in a db.py function.")
+    lines.append("# TYPE kahoot_db_query_duration_seconds histogram")
+    for (function,), series in queries:
+        _histogram(lines, "kahoot_db_query_duration_seconds", _labels(function=function), series)
+    lines.append("# HELP kahoot_db_query_rows_total Rows returned by a db.py function.")
+    lines.append("# TYPE kahoot_db_query_rows_total counter")
+    for (function,), series in queries:
+        lines.append(f"kahoot_db_query_rows_total{{{_labels(function=function)}}} {series.rows}")
+    lines.append("# HELP kahoot_db_query_errors_total Calls of a db.py function that raised.")
+    lines.append("# TYPE kahoot_db_query_errors_total counter")
+    for (function,), series in queries:
+        lines.append(f"kahoot_db_query_errors_total{{{_labels(function=function)}}} {series.errors}")
+
+    if answer_buffer.enabled():
+        lines.append("# HELP kahoot_answer_buffer_pending Buffered answers that aren't written yet.")
+        lines.append("# TYPE kahoot_answer_buffer_pending gauge")
+        lines.append(f"kahoot_answer_buffer_pending {answer_buffer.answers.pending()}")
+        lines.append("# HELP kahoot_answer_buffer_dropped_total Buffered answers that were accepted but never written.")
+        lines.append("# TYPE kahoot_answer_buffer_dropped_total counter")
+        lines.append(f"kahoot_answer_buffer_dropped_total {answer_buffer.answers.dropped}")
+    return "\n".join(lines) + "\n"
+
+
+def enabled():
+    return METRICS
@@ -0,0 +1,203 @@
+import argparse
+import hashlib
+import os
+import re
+import db_setup
+import exceptions
+"""
+Versioned schema migrations, replacing db_setup.create_tables.
+
+Every file in migrations/ named NNNN_description.sql is one migration, applied in version order.
+The versions that have been applied are recorded in the schema_version table together with a
+checksum of the file, so a migration that was edited after it ran is refused instead of silently
+skipped. Two runners never migrate at the same time, the second one waits on an advisory lock.
+
+A migration normally runs in a single transaction, it either applies completely or not at all.
+Operations that postgres refuses to run in a transaction, like CREATE INDEX CONCURRENTLY, go in
+a file whose first line is "-- migrate: no-transaction". Its statements are split on the ";" outside
+of dollar quotes and run one by one in autocommit, so a DO block in it may COMMIT, e.g between the
+batches of a backfill. Write them with IF NOT EXISTS, so a migration that failed halfway can simply
+be run again. An index that a failed CONCURRENTLY build
+left behind INVALID is dropped and built again.
+
+Every statement waits at most MIGRATION_LOCK_TIMEOUT for its locks. A migration stuck behind a
+long transaction then fails, instead of queueing every request of the api up behind it.
+
+    python migrate.py              apply every pending migration
+    python migrate.py --dry-run    only print what would be applied
+    python migrate.py --target 2   apply up to and including migration 0002
+"""
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+MIGRATION_LOCK_TIMEOUT = os.getenv("MIGRATION_LOCK_TIMEOUT", "5s")
+
+# key of the advisory lock that keeps two runners apart
+MIGRATION_LOCK_ID = 7212001
+
+NO_TRANSACTION_MARKER = "-- migrate: no-transaction"
+# a ";" ends a statement, unless it is inside a $$ or $tag$ quoted body
+STATEMENT_TOKEN = re.compile(r"\$\w*\$|;")
+CONCURRENT_INDEX = re.compile(r"CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+IF\s+NOT\s+EXISTS\s+(\w+)", re.IGNORECASE)
+
+
+class Migration:
+    """one numbered .sql file of migrations/"""
+
+    def __init__(self, version: int, name: str, sql: str):
+        self.version = version
+        self.name = name
+        self.sql = sql
+        self.checksum = hashlib.sha256(sql.encode()).hexdigest()
+        self.transactional = not sql.lstrip().startswith(NO_TRANSACTION_MARKER)
+
+    def statements(self):
+        """the statements of a no-transaction migration, comments stripped"""
+        sql = "\n".join(line for line in self.sql.splitlines() if not line.lstrip().startswith("--"))
+        statements, start, quote = [], 0, None
+        for token in STATEMENT_TOKEN.finditer(sql):
+            if quote is not None:
+                if token.group() == quote:
+                    quote = None
+            elif token.group() == ";":
+                statements.append(sql[start:token.start()])
+                start = token.end()
+            else:
+                quote = token.group()
+        statements.append(sql[start:])
+        return [statement.strip() for statement in statements if statement.strip()]
+
+    def __str__(self):
+        return f"{self.version:04d}_{self.name}"
+
+
+def load_migrations(directory: str = MIGRATIONS_DIR):
+    migrations = {}
+    for filename in sorted(os.listdir(directory)):
+        match = re.fullmatch(r"(\d+)_(\w+)\.sql", filename)
+        if not match:
+            continue
+        version = int(match.group(1))
+        if version in migrations:
+            raise exceptions.MigrationException(version, f"two migrations share version {version}")
+        with open(os.path.join(directory, filename)) as file:
+            migrations[version] = Migration(version, match.group(2), file.read())
+    return [migrations[version] for version in sorted(migrations)]
+
+
+def applied_migrations(cursor):
+    """version -> checksum of every migration recorded in schema_version"""
+    cursor.execute("SELECT to_regclass('schema_version') IS NOT NULL;")
+    if not cursor.fetchone()[0]:
+        return {}
+    cursor.execute("SELECT version, checksum FROM schema_version;")
+    return dict(cursor.fetchall())
+
+
+def pending_migrations(migrations, applied: dict, target: int = None):
+    for migration in migrations:
+        if migration.version in applied and applied[migration.version] != migration.checksum:
+            raise exceptions.MigrationException(
+                migration.version, f"{migration} was changed after it was applied, add a new migration instead"
+            )
+    return [
+        migration for migration in migrations
+        if migration.version not in applied and (target is None or migration.version <= target)
+    ]
+
+
+def migrate(dry_run: bool = False, target: int = None, directory: str = MIGRATIONS_DIR):
+    """apply the pending migrations up to `target` and return them, or only print them when dry_run is set"""
+    connection = db_setup.get_connection()
+    connection.autocommit = True
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_lock(%s);", (MIGRATION_LOCK_ID,))
+            cursor.execute("SET lock_timeout = %s;", (MIGRATION_LOCK_TIMEOUT,))
+            pending = pending_migrations(load_migrations(directory), applied_migrations(cursor), target)
+            if dry_run:
+                print_plan(cursor, pending)
+                return pending
+            if pending:
+                cursor.execute(
+                    """CREATE TABLE IF NOT EXISTS schema_version (
+                        version INT PRIMARY KEY,
+                        name TEXT NOT NULL,
+                        checksum TEXT NOT NULL,
+                        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);"""
+                )
+            for migration in pending:
+                print(f"applying {migration}")
+                if migration.transactional:
+                    apply_in_transaction(connection, migration)
+                else:
+                    apply_statements(cursor, migration)
+            return pending
+    finally:
+        connection.close()
+
+
+def apply_in_transaction(connection, migration: Migration):
+    connection.autocommit = False
+    try:
+        with connection:
+            with connection.cursor() as cursor:
+                cursor.execute(migration.sql)
+                record(cursor, migration)
+    finally:
+        connection.autocommit = True
+
+
+def apply_statements(cursor, migration: Migration):
+    for statement in migration.statements():
+        index = CONCURRENT_INDEX.match(statement)
+        if index and index_is_invalid(cursor, index.group(1)):
+            cursor.execute(f"DROP INDEX CONCURRENTLY {index.group(1)};")
+        cursor.execute(statement)
+    record(cursor, migration)
+
+
+def record(cursor, migration: Migration):
+    cursor.execute(
+        "INSERT INTO schema_version (version, name, checksum) VALUES (%s, %s, %s);",
+        (migration.version, migration.name, migration.checksum),
+    )
+
+
+def index_is_invalid(cursor, name: str):
+    """True for an index a failed CREATE INDEX CONCURRENTLY left behind, IF NOT EXISTS would skip it"""
+    cursor.execute(
+        """SELECT NOT i.indisvalid FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = %s AND pg_table_is_visible(c.oid);""",
+        (name,),
+    )
+    row = cursor.fetchone()
+    return bool(row and row[0])
+
+
+def print_plan(cursor, pending):
+    if not pending:
+        print("the database is up to date")
+        return
+    for migration in pending:
+        mode = "in one transaction" if migration.transactional else "statement by statement, outside a transaction"
+        print(f"-- would apply {migration} {mode}")
+        if migration.transactional:
+            print(migration.sql.strip())
+        else:
+            for statement in migration.statements():
+                index = CONCURRENT_INDEX.match(statement)
+                if index and index_is_invalid(cursor, index.group(1)):
+                    print(f"DROP INDEX CONCURRENTLY {index.group(1)};  -- left INVALID by a failed build")
+                print(statement + ";")
+        print()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="apply the schema migrations in migrations/")
+    parser.add_argument("--dry-run", action="store_true", help="print the pending migrations without applying them")
+    parser.add_argument("--target", type=int, help="stop after this migration version")
+    args = parser.parse_args()
+    applied = migrate(dry_run=args.dry_run, target=args.target)
+    if not args.dry_run:
+        print(f"{len(applied)} migration(s) applied")
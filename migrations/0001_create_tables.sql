@@ -0,0 +1,89 @@
+-- the tables db_setup.create_tables used to create, safe to run against a database that already has them
+
+-- a usertype table to differentiate between admin, teacher and student
+CREATE TABLE IF NOT EXISTS usertype (
+    id SERIAL PRIMARY KEY,
+    is_admin BOOLEAN NOT NULL,
+    is_teacher BOOLEAN NOT NULL,
+    is_student BOOLEAN NOT NULL);
+
+CREATE TABLE IF NOT EXISTS users (
+    id SERIAL PRIMARY KEY,
+    usertype_id BIGINT REFERENCES usertype(id) ON DELETE SET NULL,
+    username VARCHAR(50) UNIQUE NOT NULL,
+    password_hash VARCHAR(255) NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+
+CREATE TABLE IF NOT EXISTS kahoots (
+    id SERIAL PRIMARY KEY,
+    title VARCHAR(100) NOT NULL,
+    category VARCHAR(50),
+    creation_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+
+-- an enum for the different types of managment, postgres has no CREATE TYPE IF NOT EXISTS
+DO $$
+BEGIN
+    CREATE TYPE kahoot_managment AS ENUM ('owner', 'editor', 'viewer');
+EXCEPTION
+    WHEN duplicate_object THEN NULL;
+END
+$$;
+
+-- a kahoot_user_managment table to manage permissions
+CREATE TABLE IF NOT EXISTS kahoot_user_managment (
+    kahoot_id BIGINT REFERENCES kahoots(id) ON DELETE CASCADE,
+    user_id BIGINT REFERENCES users(id) ON DELETE CASCADE,
+    PRIMARY KEY (kahoot_id, user_id),
+    managment_type kahoot_managment NOT NULL);
+
+CREATE TABLE IF NOT EXISTS media (
+    id SERIAL PRIMARY KEY,
+    media_type VARCHAR(50) NOT NULL,
+    file_path TEXT NOT NULL);
+
+CREATE TABLE IF NOT EXISTS questions (
+    id SERIAL PRIMARY KEY,
+    kahoot_id BIGINT REFERENCES kahoots(id) ON DELETE CASCADE,
+    media_id BIGINT REFERENCES media(id) ON DELETE SET NULL,
+    question_text TEXT NOT NULL,
+    question_type VARCHAR(50) NOT NULL,
+    time_limit INT NOT NULL,
+    points INT NOT NULL);
+
+CREATE TABLE IF NOT EXISTS question_media (
+    question_id BIGINT REFERENCES questions(id) ON DELETE CASCADE,
+    media_id BIGINT REFERENCES media(id) ON DELETE CASCADE,
+    PRIMARY KEY (question_id, media_id),
+    display_order INT NOT NULL);
+
+CREATE TABLE IF NOT EXISTS answers (
+    id SERIAL PRIMARY KEY,
+    question_id BIGINT REFERENCES questions(id) ON DELETE CASCADE,
+    answer_text TEXT NOT NULL,
+    is_correct BOOLEAN NOT NULL);
+
+CREATE TABLE IF NOT EXISTS game_sessions (
+    id SERIAL PRIMARY KEY,
+    kahoot_id BIGINT REFERENCES kahoots(id) ON DELETE CASCADE,
+    session_pin VARCHAR(10) UNIQUE NOT NULL,
+    is_active BOOLEAN DEFAULT TRUE,
+    started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+
+-- the participants/players of a session
+CREATE TABLE IF NOT EXISTS participants (
+    id SERIAL PRIMARY KEY,
+    game_session_id BIGINT REFERENCES game_sessions(id) ON DELETE CASCADE,
+    user_id BIGINT REFERENCES users(id) ON DELETE SET NULL,
+    username VARCHAR(100),
+    joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    final_score INT DEFAULT 0,
+    rank INT);
+
+CREATE TABLE IF NOT EXISTS player_answers (
+    id SERIAL PRIMARY KEY,
+    session_id BIGINT REFERENCES game_sessions(id) ON DELETE CASCADE,
+    participant_id BIGINT REFERENCES participants(id) ON DELETE CASCADE,
+    question_id BIGINT REFERENCES questions(id) ON DELETE CASCADE,
+    answer_id BIGINT REFERENCES answers(id) ON DELETE CASCADE,
+    time_taken FLOAT NOT NULL,
+    points_earned INT NOT NULL);
@@ -0,0 +1,55 @@
+-- the stored functions db.submit_answer calls, CREATE OR REPLACE makes them safe to run again
+
+-- submitting an answer in one call: check it, score it, store it and add it to final_score.
+-- plpgsql caches the plans of these statements per connection, so unlike one big
+-- CTE sent from python, repeated calls skip parsing and planning as well
+CREATE OR REPLACE FUNCTION submit_player_answer(
+    p_session_id BIGINT,
+    p_participant_id BIGINT,
+    p_question_id BIGINT,
+    p_answer_id BIGINT,
+    p_time_taken FLOAT8)
+RETURNS TABLE (score_id INT, score_points INT) AS $$
+DECLARE
+    v_is_correct BOOLEAN;
+BEGIN
+    SELECT a.is_correct INTO v_is_correct FROM answers a WHERE a.id = p_answer_id;
+    IF NOT FOUND THEN
+        RETURN;
+    END IF;
+    -- 500 base points if correct plus a speed bonus of up to 500,
+    -- trunc() rounds the same way as int(time_taken * 10) in python
+    score_points := CASE WHEN v_is_correct
+        THEN 500 + GREATEST(0, 500 - trunc(p_time_taken * 10))::INT
+        ELSE 0 END;
+    INSERT INTO player_answers
+        (session_id, participant_id, question_id, answer_id, time_taken, points_earned)
+    VALUES (p_session_id, p_participant_id, p_question_id, p_answer_id, p_time_taken, score_points)
+    RETURNING player_answers.id INTO score_id;
+    UPDATE participants SET final_score = final_score + score_points
+    WHERE participants.id = p_participant_id;
+    RETURN NEXT;
+END;
+$$ LANGUAGE plpgsql;
+
+-- storing an answer that the api already scored with its cached answer key
+CREATE OR REPLACE FUNCTION record_player_answer(
+    p_session_id BIGINT,
+    p_participant_id BIGINT,
+    p_question_id BIGINT,
+    p_answer_id BIGINT,
+    p_time_taken FLOAT8,
+    p_points INT)
+RETURNS INT AS $$
+DECLARE
+    v_score_id INT;
+BEGIN
+    INSERT INTO player_answers
+        (session_id, participant_id, question_id, answer_id, time_taken, points_earned)
+    VALUES (p_session_id, p_participant_id, p_question_id, p_answer_id, p_time_taken, p_points)
+    RETURNING id INTO v_score_id;
+    UPDATE participants SET final_score = final_score + p_points
+    WHERE id = p_participant_id;
+    RETURN v_score_id;
+END;
+$$ LANGUAGE plpgsql;
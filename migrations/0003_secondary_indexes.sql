@@ -0,0 +1,25 @@
+-- migrate: no-transaction
+-- the secondary indexes the queries in db.py rely on, postgres only indexes primary keys and UNIQUE columns by itself.
+-- built CONCURRENTLY so a live database keeps taking answers while they are built
+
+-- questions of a kahoot, for listing them and loading answer keys
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_questions_kahoot_id ON questions (kahoot_id);
+
+-- answers of a question, covering what load_answer_key reads
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_answers_question_id ON answers (question_id) INCLUDE (id, is_correct);
+
+-- deleting a kahoot cascades into its sessions
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_game_sessions_kahoot_id ON game_sessions (kahoot_id);
+
+-- participants of a session, the leaderboard starts from these
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_participants_game_session_id ON participants (game_session_id);
+
+-- every answer of a participant in a session: the leaderboard sums them straight from the index,
+-- get_participant_answers reads them in id order and load_leaderboard filters on session_id and id
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_player_answers_session_participant
+    ON player_answers (session_id, participant_id, id) INCLUDE (points_earned, answer_id);
+
+-- the ON DELETE CASCADE foreign keys of player_answers, without these every cascaded delete scans the table
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_player_answers_participant_id ON player_answers (participant_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_player_answers_question_id ON player_answers (question_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_player_answers_answer_id ON player_answers (answer_id);
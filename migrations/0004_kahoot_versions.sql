@@ -0,0 +1,58 @@
+-- a version counter per kahoot, bumped whenever the kahoot, its questions, their answers or their media change.
+-- the api derives the ETags of quiz content from it, so a client that already has the current version
+-- gets a 304 after a single primary key lookup.
+-- adding a column with a constant default doesn't rewrite the table, so this is safe on a live database
+
+ALTER TABLE kahoots ADD COLUMN IF NOT EXISTS version INT NOT NULL DEFAULT 1;
+
+-- an edit of the kahoot itself, the triggers below bump version explicitly and are left alone
+CREATE OR REPLACE FUNCTION bump_own_kahoot_version() RETURNS trigger AS $$
+BEGIN
+    NEW.version := OLD.version + 1;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS kahoots_version ON kahoots;
+CREATE TRIGGER kahoots_version BEFORE UPDATE ON kahoots
+    FOR EACH ROW WHEN (OLD.version = NEW.version) EXECUTE FUNCTION bump_own_kahoot_version();
+
+-- a question was added, changed or removed
+CREATE OR REPLACE FUNCTION bump_question_kahoot_version() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE kahoots SET version = version + 1 WHERE id = OLD.kahoot_id;
+    END IF;
+    IF TG_OP = 'INSERT' OR (TG_OP = 'UPDATE' AND NEW.kahoot_id IS DISTINCT FROM OLD.kahoot_id) THEN
+        UPDATE kahoots SET version = version + 1 WHERE id = NEW.kahoot_id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS questions_kahoot_version ON questions;
+CREATE TRIGGER questions_kahoot_version AFTER INSERT OR UPDATE OR DELETE ON questions
+    FOR EACH ROW EXECUTE FUNCTION bump_question_kahoot_version();
+
+-- an answer or a media link of a question changed, shared by both tables through their question_id
+CREATE OR REPLACE FUNCTION bump_answer_kahoot_version() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE kahoots SET version = version + 1
+        WHERE id = (SELECT kahoot_id FROM questions WHERE id = OLD.question_id);
+    END IF;
+    IF TG_OP = 'INSERT' OR (TG_OP = 'UPDATE' AND NEW.question_id IS DISTINCT FROM OLD.question_id) THEN
+        UPDATE kahoots SET version = version + 1
+        WHERE id = (SELECT kahoot_id FROM questions WHERE id = NEW.question_id);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS answers_kahoot_version ON answers;
+CREATE TRIGGER answers_kahoot_version AFTER INSERT OR UPDATE OR DELETE ON answers
+    FOR EACH ROW EXECUTE FUNCTION bump_answer_kahoot_version();
+
+DROP TRIGGER IF EXISTS question_media_kahoot_version ON question_media;
+CREATE TRIGGER question_media_kahoot_version AFTER INSERT OR UPDATE OR DELETE ON question_media
+    FOR EACH ROW EXECUTE FUNCTION bump_answer_kahoot_version();
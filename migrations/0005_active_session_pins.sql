@@ -0,0 +1,10 @@
+-- migrate: no-transaction
+-- a PIN only has to be unique among the live sessions, so the PINs of ended sessions can be handed out again.
+-- ended sessions keep their PIN for the history, GET /game-sessions/pin/{pin} prefers the live one
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS idx_game_sessions_active_pin ON game_sessions (session_pin) WHERE is_active;
+
+-- looking up a PIN among all sessions, now that the UNIQUE constraint's index is gone
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_game_sessions_session_pin ON game_sessions (session_pin);
+
+ALTER TABLE game_sessions DROP CONSTRAINT IF EXISTS game_sessions_session_pin_key;
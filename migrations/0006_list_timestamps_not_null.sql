@@ -0,0 +1,39 @@
+-- migrate: no-transaction
+-- the list endpoints page through kahoots by (creation_date, id) and sessions by (started_at, id),
+-- a NULL in either column would fall out of every keyset comparison. the api never writes one,
+-- so the backfill only finds rows inserted by hand, it commits every 10000 of them anyway.
+-- SET NOT NULL scans the whole table under an ACCESS EXCLUSIVE lock, unless a valid CHECK already
+-- proves it (postgres 12+). The CHECK is added NOT VALID, which only takes that lock for a moment,
+-- and validated while reads and writes go on. Every step can be run again after a failure
+
+DO $$
+BEGIN
+    LOOP
+        UPDATE kahoots SET creation_date = 'epoch'
+        WHERE id IN (SELECT id FROM kahoots WHERE creation_date IS NULL LIMIT 10000);
+        EXIT WHEN NOT FOUND;
+        COMMIT;
+    END LOOP;
+END
+$$;
+ALTER TABLE kahoots DROP CONSTRAINT IF EXISTS kahoots_creation_date_not_null;
+ALTER TABLE kahoots ADD CONSTRAINT kahoots_creation_date_not_null CHECK (creation_date IS NOT NULL) NOT VALID;
+ALTER TABLE kahoots VALIDATE CONSTRAINT kahoots_creation_date_not_null;
+ALTER TABLE kahoots ALTER COLUMN creation_date SET NOT NULL;
+ALTER TABLE kahoots DROP CONSTRAINT kahoots_creation_date_not_null;
+
+DO $$
+BEGIN
+    LOOP
+        UPDATE game_sessions SET started_at = 'epoch'
+        WHERE id IN (SELECT id FROM game_sessions WHERE started_at IS NULL LIMIT 10000);
+        EXIT WHEN NOT FOUND;
+        COMMIT;
+    END LOOP;
+END
+$$;
+ALTER TABLE game_sessions DROP CONSTRAINT IF EXISTS game_sessions_started_at_not_null;
+ALTER TABLE game_sessions ADD CONSTRAINT game_sessions_started_at_not_null CHECK (started_at IS NOT NULL) NOT VALID;
+ALTER TABLE game_sessions VALIDATE CONSTRAINT game_sessions_started_at_not_null;
+ALTER TABLE game_sessions ALTER COLUMN started_at SET NOT NULL;
+ALTER TABLE game_sessions DROP CONSTRAINT game_sessions_started_at_not_null;
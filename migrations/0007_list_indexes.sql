@@ -0,0 +1,18 @@
+-- migrate: no-transaction
+-- indexes for the keyset pagination of GET /kahoots/ and GET /game-sessions/. every filter combination
+-- has an index that starts with its equality filters and ends in the sort order, so a page is one
+-- index range scan from the cursor on, however many rows come before it or don't match
+
+-- kahoots, newest first, optionally within a creation date range
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_kahoots_creation_date ON kahoots (creation_date, id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_kahoots_category_creation_date ON kahoots (category, creation_date, id);
+
+-- sessions, newest first, optionally within a start date range
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_game_sessions_started_at ON game_sessions (started_at, id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_game_sessions_is_active_started_at ON game_sessions (is_active, started_at, id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_game_sessions_kahoot_started_at ON game_sessions (kahoot_id, started_at, id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_game_sessions_kahoot_is_active_started_at
+    ON game_sessions (kahoot_id, is_active, started_at, id);
+
+-- the cascade from kahoots uses idx_game_sessions_kahoot_started_at now
+DROP INDEX CONCURRENTLY IF EXISTS idx_game_sessions_kahoot_id;
@@ -0,0 +1,76 @@
+-- the version triggers of 0004 ran once per row, so importing a quiz with 50 questions and 200 answers
+-- updated its kahoot 250 times in one transaction. these run once per statement and bump every kahoot
+-- the statement touched once, through the transition tables of the rows it inserted, updated or deleted.
+-- a version still changes with every edit, it just no longer counts the rows
+
+-- questions that were added, changed or removed
+CREATE OR REPLACE FUNCTION bump_question_kahoot_versions() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE kahoots SET version = version + 1 WHERE id IN (SELECT kahoot_id FROM new_rows);
+    ELSIF TG_OP = 'UPDATE' THEN
+        UPDATE kahoots SET version = version + 1
+        WHERE id IN (SELECT kahoot_id FROM old_rows UNION SELECT kahoot_id FROM new_rows);
+    ELSE
+        UPDATE kahoots SET version = version + 1 WHERE id IN (SELECT kahoot_id FROM old_rows);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS questions_kahoot_version ON questions;
+DROP TRIGGER IF EXISTS questions_kahoot_version_insert ON questions;
+DROP TRIGGER IF EXISTS questions_kahoot_version_update ON questions;
+DROP TRIGGER IF EXISTS questions_kahoot_version_delete ON questions;
+-- postgres allows transition tables only on triggers for a single event
+CREATE TRIGGER questions_kahoot_version_insert AFTER INSERT ON questions
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION bump_question_kahoot_versions();
+CREATE TRIGGER questions_kahoot_version_update AFTER UPDATE ON questions
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION bump_question_kahoot_versions();
+CREATE TRIGGER questions_kahoot_version_delete AFTER DELETE ON questions
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION bump_question_kahoot_versions();
+
+-- answers or media links that were added, changed or removed, shared by both tables through their question_id
+CREATE OR REPLACE FUNCTION bump_answer_kahoot_versions() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE kahoots SET version = version + 1
+        WHERE id IN (SELECT q.kahoot_id FROM questions q WHERE q.id IN (SELECT question_id FROM new_rows));
+    ELSIF TG_OP = 'UPDATE' THEN
+        UPDATE kahoots SET version = version + 1
+        WHERE id IN (
+            SELECT q.kahoot_id FROM questions q
+            WHERE q.id IN (SELECT question_id FROM old_rows UNION SELECT question_id FROM new_rows)
+        );
+    ELSE
+        UPDATE kahoots SET version = version + 1
+        WHERE id IN (SELECT q.kahoot_id FROM questions q WHERE q.id IN (SELECT question_id FROM old_rows));
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS answers_kahoot_version ON answers;
+DROP TRIGGER IF EXISTS answers_kahoot_version_insert ON answers;
+DROP TRIGGER IF EXISTS answers_kahoot_version_update ON answers;
+DROP TRIGGER IF EXISTS answers_kahoot_version_delete ON answers;
+CREATE TRIGGER answers_kahoot_version_insert AFTER INSERT ON answers
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION bump_answer_kahoot_versions();
+CREATE TRIGGER answers_kahoot_version_update AFTER UPDATE ON answers
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION bump_answer_kahoot_versions();
+CREATE TRIGGER answers_kahoot_version_delete AFTER DELETE ON answers
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION bump_answer_kahoot_versions();
+
+DROP TRIGGER IF EXISTS question_media_kahoot_version ON question_media;
+DROP TRIGGER IF EXISTS question_media_kahoot_version_insert ON question_media;
+DROP TRIGGER IF EXISTS question_media_kahoot_version_update ON question_media;
+DROP TRIGGER IF EXISTS question_media_kahoot_version_delete ON question_media;
+CREATE TRIGGER question_media_kahoot_version_insert AFTER INSERT ON question_media
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION bump_answer_kahoot_versions();
+CREATE TRIGGER question_media_kahoot_version_update AFTER UPDATE ON question_media
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION bump_answer_kahoot_versions();
+CREATE TRIGGER question_media_kahoot_version_delete AFTER DELETE ON question_media
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION bump_answer_kahoot_versions();
+
+DROP FUNCTION IF EXISTS bump_question_kahoot_version();
+DROP FUNCTION IF EXISTS bump_answer_kahoot_version();
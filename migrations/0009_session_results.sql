@@ -0,0 +1,45 @@
+-- the final standings of every ended game session, written once by db.end_game_session. reading the
+-- leaderboard of a finished game is then an index range scan of this table instead of the aggregate
+-- over participants, player_answers and answers. rank is the place on the board, ties are broken on
+-- participant_id like in the leaderboard query
+CREATE TABLE IF NOT EXISTS session_results (
+    session_id BIGINT NOT NULL REFERENCES game_sessions(id) ON DELETE CASCADE,
+    rank INT NOT NULL,
+    participant_id BIGINT NOT NULL REFERENCES participants(id) ON DELETE CASCADE,
+    username VARCHAR(100),
+    total_score INT NOT NULL,
+    correct_answers INT NOT NULL,
+    PRIMARY KEY (session_id, rank)
+);
+
+-- a participant's own place, and the cascade when a participant is deleted
+CREATE UNIQUE INDEX IF NOT EXISTS idx_session_results_participant ON session_results (participant_id);
+
+-- the sessions that ended before this migration get their standings now
+INSERT INTO session_results (session_id, rank, participant_id, username, total_score, correct_answers)
+SELECT
+    board.game_session_id,
+    ROW_NUMBER() OVER (PARTITION BY board.game_session_id ORDER BY board.total_score DESC, board.participant_id),
+    board.participant_id,
+    board.username,
+    board.total_score,
+    board.correct_answers
+FROM (
+    SELECT
+        p.game_session_id,
+        p.id AS participant_id,
+        COALESCE(p.username, u.username) AS username,
+        COALESCE(SUM(pa.points_earned), 0) AS total_score,
+        COUNT(CASE WHEN a.is_correct THEN 1 END) AS correct_answers
+    FROM participants p
+    JOIN game_sessions gs ON gs.id = p.game_session_id AND NOT gs.is_active
+    LEFT JOIN users u ON p.user_id = u.id
+    LEFT JOIN player_answers pa ON p.id = pa.participant_id AND pa.session_id = p.game_session_id
+    LEFT JOIN answers a ON pa.answer_id = a.id
+    GROUP BY p.id, p.username, u.username
+) board
+ON CONFLICT DO NOTHING;
+
+UPDATE participants p SET final_score = r.total_score, rank = r.rank
+FROM session_results r
+WHERE r.participant_id = p.id AND (p.final_score IS DISTINCT FROM r.total_score OR p.rank IS DISTINCT FROM r.rank);
@@ -0,0 +1,64 @@
+-- submit_player_answer and record_player_answer get a last parameter p_add_score. with
+-- FINAL_SCORE_MODE=deferred the api passes false: the answer is only inserted, participants.final_score
+-- isn't updated (a new row version and a row lock per answer) and is written once when the session ends.
+-- it defaults to true, so calls with the old arguments still add the points
+
+DROP FUNCTION IF EXISTS submit_player_answer(BIGINT, BIGINT, BIGINT, BIGINT, FLOAT8);
+
+CREATE OR REPLACE FUNCTION submit_player_answer(
+    p_session_id BIGINT,
+    p_participant_id BIGINT,
+    p_question_id BIGINT,
+    p_answer_id BIGINT,
+    p_time_taken FLOAT8,
+    p_add_score BOOLEAN DEFAULT TRUE)
+RETURNS TABLE (score_id INT, score_points INT) AS $$
+DECLARE
+    v_is_correct BOOLEAN;
+BEGIN
+    SELECT a.is_correct INTO v_is_correct FROM answers a WHERE a.id = p_answer_id;
+    IF NOT FOUND THEN
+        RETURN;
+    END IF;
+    -- 500 base points if correct plus a speed bonus of up to 500,
+    -- trunc() rounds the same way as int(time_taken * 10) in python
+    score_points := CASE WHEN v_is_correct
+        THEN 500 + GREATEST(0, 500 - trunc(p_time_taken * 10))::INT
+        ELSE 0 END;
+    INSERT INTO player_answers
+        (session_id, participant_id, question_id, answer_id, time_taken, points_earned)
+    VALUES (p_session_id, p_participant_id, p_question_id, p_answer_id, p_time_taken, score_points)
+    RETURNING player_answers.id INTO score_id;
+    IF p_add_score THEN
+        UPDATE participants SET final_score = final_score + score_points
+        WHERE participants.id = p_participant_id;
+    END IF;
+    RETURN NEXT;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP FUNCTION IF EXISTS record_player_answer(BIGINT, BIGINT, BIGINT, BIGINT, FLOAT8, INT);
+
+CREATE OR REPLACE FUNCTION record_player_answer(
+    p_session_id BIGINT,
+    p_participant_id BIGINT,
+    p_question_id BIGINT,
+    p_answer_id BIGINT,
+    p_time_taken FLOAT8,
+    p_points INT,
+    p_add_score BOOLEAN DEFAULT TRUE)
+RETURNS INT AS $$
+DECLARE
+    v_score_id INT;
+BEGIN
+    INSERT INTO player_answers
+        (session_id, participant_id, question_id, answer_id, time_taken, points_earned)
+    VALUES (p_session_id, p_participant_id, p_question_id, p_answer_id, p_time_taken, p_points)
+    RETURNING id INTO v_score_id;
+    IF p_add_score THEN
+        UPDATE participants SET final_score = final_score + p_points
+        WHERE id = p_participant_id;
+    END IF;
+    RETURN v_score_id;
+END;
+$$ LANGUAGE plpgsql;
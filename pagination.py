@@ -0,0 +1,53 @@
+import base64
+import binascii
+import json
+import os
+from datetime import datetime, timezone
+from fastapi import Request
+import exceptions
+"""
+Keyset pagination for the list endpoints.
+
+GET /kahoots/ and GET /game-sessions/ return the newest rows first, ordered by a timestamp and the
+id, and at most `limit` of them. When there are more, the Link header points at the next page:
+its cursor holds the timestamp and id of the last row sent, and the next page starts right below
+them with WHERE (timestamp, id) < (cursor). Unlike OFFSET, that costs the same on page 1000 as on
+page 1, as long as an index ends in (timestamp, id) (migrations/0007_list_indexes.sql).
+"""
+
+DEFAULT_PAGE_SIZE = int(os.getenv("DEFAULT_PAGE_SIZE", "50"))
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", "200"))
+
+
+def encode_cursor(row: dict, column: str):
+    """an opaque cursor pointing just below this row"""
+    position = json.dumps([row[column].isoformat(), row["id"]], separators=(",", ":"))
+    return base64.urlsafe_b64encode(position.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    """(timestamp, id) of the last row of the previous page"""
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return datetime.fromisoformat(position[0]), int(position[1])
+    except (binascii.Error, ValueError, TypeError, IndexError, KeyError):
+        raise exceptions.InvalidCursorException(cursor)
+
+
+def as_utc(moment: datetime):
+    """the timestamp columns have no time zone and hold UTC, filters given with an offset are converted"""
+    if moment is None or moment.tzinfo is None:
+        return moment
+    return moment.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def split_page(rows, limit: int, column: str):
+    """the queries fetch limit + 1 rows, the extra one only tells whether there is a next page"""
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(rows[-1], column)
+
+
+def link_header(request: Request, cursor: str):
+    return f'<{request.url.include_query_params(cursor=cursor)}>; rel="next"'
@@ -0,0 +1,119 @@
+import logging
+import os
+import queue
+import threading
+from concurrent.futures import Future
+import db
+import db_setup
+import schemas
+"""
+Coalesces concurrent joins into multi-row inserts, used unless JOIN_COALESCING=0.
+
+When a game starts, hundreds of players hit POST /participants/ within a second, and each of them
+would otherwise cost an INSERT and a commit of its own. Instead every join goes into a queue with
+a Future, and one background thread takes whatever is queued, up to JOIN_BATCH_SIZE, and writes
+it with db.create_participants: one INSERT ... RETURNING and one commit. Each Future then gets
+the id and username of its own player.
+
+The thread doesn't wait for a batch to fill up. While one insert runs, the joins that arrive in
+the meantime queue up and become the next batch, so a single join is written right away and a
+burst of joins is written in a handful of statements.
+
+The async app waits on the same Futures with asyncio.wrap_future, so both apps share the queue
+and the thread, which writes over the psycopg2 pool.
+"""
+
+JOIN_COALESCING = os.getenv("JOIN_COALESCING", "1") == "1"
+JOIN_BATCH_SIZE = int(os.getenv("JOIN_BATCH_SIZE", "500"))
+JOIN_TIMEOUT = float(os.getenv("JOIN_TIMEOUT", "5"))
+
+logger = logging.getLogger(__name__)
+
+
+class JoinCoalescer:
+    """queue of pending joins plus the thread that inserts them in batches"""
+
+    def __init__(self, batch_size: int):
+        self.batch_size = batch_size
+        self._queue = queue.Queue()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="participant-joiner", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """stop the thread once every queued join has been written"""
+        if not self.running:
+            return
+        self._stopping.set()
+        self._thread.join()
+        self._thread = None
+
+    def submit(self, participant: schemas.ParticipantCreate):
+        """queue a join, the Future resolves to {"id", "username"} or to the error that made it fail"""
+        future = Future()
+        self._queue.put((participant, future))
+        return future
+
+    def join(self, participant: schemas.ParticipantCreate, timeout: float = JOIN_TIMEOUT):
+        return self.submit(participant).result(timeout)
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch:
+                self._write(batch)
+            elif self._stopping.is_set() and self._queue.empty():
+                return
+
+    def _next_batch(self):
+        """wait briefly for a first join, then take whatever else is already queued"""
+        try:
+            batch = [self._queue.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        try:
+            with db_setup.pooled_connection() as con:
+                try:
+                    created = db.create_participants(con, [participant for participant, _ in batch])
+                except Exception:
+                    if len(batch) == 1:
+                        raise
+                    # one bad join (e.g a session that doesn't exist) fails the whole insert,
+                    # so retry them one at a time and only fail the bad ones
+                    for participant, future in batch:
+                        try:
+                            future.set_result(db.create_participants(con, [participant])[0])
+                        except Exception as e:
+                            future.set_exception(e)
+                    return
+            for (_, future), result in zip(batch, created):
+                future.set_result(result)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+
+joins = JoinCoalescer(JOIN_BATCH_SIZE)
+
+
+def enabled():
+    return JOIN_COALESCING and joins.running
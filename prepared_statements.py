@@ -0,0 +1,74 @@
+import os
+import threading
+import weakref
+"""
+Server side prepared statements for the hottest queries of db.py.
+
+A statement is registered once, at import time, with the same %s placeholders as any other query
+in db.py. The first time a pooled connection runs it, it is sent once as PREPARE name AS ..., and
+from then on only EXECUTE name (...) goes over the wire: Postgres skips parsing and analysing the
+query, and after a few executions reuses a generic plan instead of planning it again. Prepared
+statements belong to the database session, so every connection keeps track of the ones it has.
+They survive a rollback, and they go away with the connection when the pool replaces it.
+
+PREPARED_STATEMENTS=0 sends the plain SQL instead, e.g behind a pgbouncer in transaction pooling
+mode, where the next transaction may run on a session that never saw the PREPARE. db_async.py
+needs none of this, asyncpg prepares every query it runs and caches it per connection; the same
+switch turns that cache off there.
+
+The statements name their columns instead of using SELECT *, a prepared SELECT * fails with
+"cached plan must not change result type" once a migration adds a column to its table.
+"""
+
+PREPARED_STATEMENTS = os.getenv("PREPARED_STATEMENTS", "1") == "1"
+
+
+class Statement:
+    """a registered query, its name is what EXECUTE refers to"""
+
+    def __init__(self, name: str, sql: str):
+        self.name = name
+        self.sql = sql
+        parts = sql.rstrip().rstrip(";").split("%s")
+        self.parameters = len(parts) - 1
+        # PREPARE takes $n placeholders, in the order of the %s ones
+        self.prepare_sql = f"PREPARE {name} AS " + parts[0] + "".join(
+            f"${number}{part}" for number, part in enumerate(parts[1:], start=1)
+        )
+        arguments = ", ".join(["%s"] * self.parameters)
+        self.execute_sql = f"EXECUTE {name} ({arguments});" if self.parameters else f"EXECUTE {name};"
+
+
+statements = {}
+
+
+def register(name: str, sql: str):
+    """register a query under a name, called once per query when db.py is imported"""
+    if name in statements:
+        raise ValueError(f"statement {name} is registered twice")
+    statement = statements[name] = Statement(name, sql)
+    return statement
+
+
+# connection -> names of the statements prepared on it
+_prepared = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def execute(cursor, statement: Statement, params=()):
+    """run a registered statement on the cursor's connection, preparing it there first if needed"""
+    if not PREPARED_STATEMENTS:
+        cursor.execute(statement.sql, params)
+        return
+    con = cursor.connection
+    with _lock:
+        prepared = _prepared.setdefault(con, set())
+    if statement.name not in prepared:
+        cursor.execute(statement.prepare_sql)
+        prepared.add(statement.name)
+    cursor.execute(statement.execute_sql, params)
+
+
+def prepared_on(con):
+    """the names of the statements prepared on a connection, for tests and benchmarks"""
+    return set(_prepared.get(con, ()))
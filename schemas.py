@@ -16,6 +16,7 @@ class Kahoot(BaseModel):
     category: str  
     creation_date: datetime  
     description: Optional[str] = None
+    version: int = 1
 
 
 # Question Schemas
@@ -50,6 +51,51 @@ class Answer(BaseModel):
     is_correct: bool
 
 
+# Whole quiz schemas, a kahoot with everything in it
+class QuestionMedia(BaseModel):
+    id: int
+    media_type: str
+    file_path: str
+    display_order: int
+
+
+class QuestionWithAnswers(Question):
+    answers: List[Answer] = []
+    media: List[QuestionMedia] = []
+
+
+class KahootFull(Kahoot):
+    questions: List[QuestionWithAnswers] = []
+
+
+# Importing a whole quiz at once, the ids are handed out by the database
+class AnswerImport(BaseModel):
+    answer_text: str = Field(..., min_length=1, max_length=255)
+    is_correct: bool
+
+
+class QuestionImport(BaseModel):
+    question_text: str = Field(..., min_length=1, max_length=500)
+    question_type: str = Field(default="multiple_choice", max_length=50)
+    time_limit: int = Field(default=30, ge=5, le=300)  # seconds
+    points: int = Field(default=1000, ge=0)
+    answers: List[AnswerImport] = Field(default_factory=list, max_length=20)
+
+
+class KahootImport(KahootCreate):
+    questions: List[QuestionImport] = Field(default_factory=list, max_length=500)
+
+
+class ImportedQuestion(BaseModel):
+    id: int
+    answer_ids: List[int]
+
+
+class ImportedKahoot(BaseModel):
+    id: int
+    questions: List[ImportedQuestion]
+
+
 # Player Schemas
 class ParticipantCreate(BaseModel):
     game_session_id: int
@@ -57,6 +103,15 @@ class ParticipantCreate(BaseModel):
     username: Optional[str] = Field(None, min_length=1, max_length=100)
 
 
+class ParticipantJoin(BaseModel):
+    user_id: Optional[int] = None
+    username: Optional[str] = Field(None, min_length=1, max_length=100)
+
+
+class ParticipantBatchCreate(BaseModel):
+    participants: List[ParticipantJoin] = Field(..., min_length=1, max_length=1000)
+
+
 class Participant(BaseModel):
     id: int
     game_session_id: int
@@ -69,7 +124,8 @@ class Participant(BaseModel):
 # Game Session Schemas
 class GameSessionCreate(BaseModel):
     kahoot_id: int
-    session_pin: str = Field(..., min_length=4, max_length=8)
+    # leave it out to get a free PIN from the server
+    session_pin: Optional[str] = Field(None, min_length=4, max_length=8)
 
 
 class GameSession(BaseModel):
@@ -104,3 +160,28 @@ class LeaderboardEntry(BaseModel):
     username: str
     total_score: int
     correct_answers: int
+
+
+class RankedLeaderboardEntry(LeaderboardEntry):
+    rank: int
+
+
+class ParticipantRank(RankedLeaderboardEntry):
+    participants: int
+    neighbours: List[RankedLeaderboardEntry]
+
+
+# how the players answered one question of a session
+class AnswerCount(BaseModel):
+    answer_id: int
+    answer_text: str
+    is_correct: bool
+    count: int
+    average_time_taken: Optional[float] = None
+
+
+class AnswerDistribution(BaseModel):
+    session_id: int
+    question_id: int
+    total: int
+    answers: List[AnswerCount]
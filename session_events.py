@@ -0,0 +1,278 @@
+import asyncio
+import json
+import logging
+import os
+from collections import deque
+from fastapi import WebSocket, WebSocketDisconnect
+import db
+import db_setup
+from leaderboard import leaderboards
+"""
+Live updates of a game session, pushed to the players over a WebSocket.
+
+Every session that has at least one subscriber gets a SessionChannel with a single producer task.
+db.py and db_async.py only tell the channel that something happened (an answer was scored, a
+player joined, the host moved on to the next question, the session ended). The producer wakes up,
+waits PUSH_INTERVAL seconds so a burst of answers becomes one update, reads the leaderboard once
+and sends every subscriber the entries that changed since the previous push. A message is
+serialized once per push, not once per player.
+
+A subscriber that reads slower than the updates arrive never makes the producer wait. Its
+leaderboard changes are merged per participant until it catches up, so it skips the intermediate
+scores but always ends up with the current ones. Other events are kept in a short queue of
+SUBSCRIBER_BACKLOG messages, the oldest ones are dropped when it overflows. A subscriber that
+can't take a message within SEND_TIMEOUT seconds is disconnected.
+
+The channels live in the api process, like the leaderboards, so every uvicorn worker only pushes
+the answers it handled itself.
+"""
+
+PUSH_INTERVAL = float(os.getenv("PUSH_INTERVAL", "0.25"))
+SUBSCRIBER_BACKLOG = int(os.getenv("SUBSCRIBER_BACKLOG", "32"))
+SEND_TIMEOUT = float(os.getenv("SEND_TIMEOUT", "5"))
+
+logger = logging.getLogger(__name__)
+
+
+class Subscriber:
+    """one connected websocket and the messages it hasn't been sent yet"""
+
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self._changes = {}  # participant_id -> latest entry, None once they left
+        self._changes_text = None  # the producer's serialized message, while nothing was merged into it
+        self._events = deque(maxlen=SUBSCRIBER_BACKLOG)
+        self._ready = asyncio.Event()
+        self.closed = False
+
+    def push_changes(self, changes: dict, text: str):
+        if self._changes:
+            self._changes_text = None
+        else:
+            self._changes_text = text
+        self._changes.update(changes)
+        self._ready.set()
+
+    def push(self, text: str):
+        self._events.append(text)
+        self._ready.set()
+
+    def close(self):
+        self.closed = True
+        self._ready.set()
+
+    async def run(self, session_id: int):
+        """send queued messages until the channel closes or the client goes away"""
+        while True:
+            await self._ready.wait()
+            self._ready.clear()
+            if self._changes:
+                text = self._changes_text or leaderboard_message(session_id, self._changes)
+                self._changes = {}
+                self._changes_text = None
+                await asyncio.wait_for(self.websocket.send_text(text), SEND_TIMEOUT)
+            while self._events:
+                await asyncio.wait_for(self.websocket.send_text(self._events.popleft()), SEND_TIMEOUT)
+            if self.closed:
+                return
+
+
+class SessionChannel:
+    """the subscribers of one session and the task that feeds them"""
+
+    def __init__(self, session_id: int):
+        self.session_id = session_id
+        self.subscribers = set()
+        self._leaderboard = None  # participant_id -> entry, as last sent
+        self._leaderboard_changed = False
+        self._events = deque()
+        self._wakeup = asyncio.Event()
+        self._refresh_lock = asyncio.Lock()
+        self._ended = False
+        self._task = asyncio.create_task(self._produce())
+
+    def leaderboard_changed(self):
+        self._leaderboard_changed = True
+        self._wakeup.set()
+
+    def publish(self, event: dict):
+        self._events.append(event)
+        self._wakeup.set()
+
+    async def subscribe(self, subscriber: Subscriber):
+        """register a subscriber and return the snapshot message it should start from"""
+        if self._leaderboard is None:
+            await self._refresh()
+        self.subscribers.add(subscriber)
+        entries = sorted(self._leaderboard.values(), key=lambda entry: (-entry["total_score"], entry["participant_id"]))
+        return json.dumps({"type": "snapshot", "session_id": self.session_id, "leaderboard": entries})
+
+    def unsubscribe(self, subscriber: Subscriber):
+        self.subscribers.discard(subscriber)
+        if not self.subscribers:
+            self.close()
+
+    def close(self):
+        self._task.cancel()
+        for subscriber in self.subscribers:
+            subscriber.close()
+        if channels.get(self.session_id) is self:
+            del channels[self.session_id]
+
+    async def _produce(self):
+        while not self._ended:
+            await self._wakeup.wait()
+            # let a burst of answers land before reading the board
+            await asyncio.sleep(PUSH_INTERVAL)
+            self._wakeup.clear()
+            try:
+                if self._leaderboard_changed:
+                    self._leaderboard_changed = False
+                    await self._refresh()
+            except Exception:
+                logger.exception("could not refresh the leaderboard of session %d", self.session_id)
+            while self._events:
+                event = self._events.popleft()
+                text = json.dumps(dict(event, session_id=self.session_id))
+                for subscriber in self.subscribers:
+                    subscriber.push(text)
+                if event["type"] == "session_ended":
+                    self._ended = True
+        self.close()
+
+    async def _refresh(self):
+        """read the leaderboard and push what changed since the last read to every subscriber"""
+        async with self._refresh_lock:
+            entries = await read_leaderboard(self.session_id)
+            current = {entry["participant_id"]: entry for entry in entries}
+            if self._leaderboard is None:
+                self._leaderboard = current
+                return
+            changes = {
+                participant_id: entry
+                for participant_id, entry in current.items()
+                if self._leaderboard.get(participant_id) != entry
+            }
+            for participant_id in self._leaderboard.keys() - current.keys():
+                changes[participant_id] = None
+            self._leaderboard = current
+            if changes:
+                text = leaderboard_message(self.session_id, changes)
+                for subscriber in self.subscribers:
+                    subscriber.push_changes(changes, text)
+
+
+def leaderboard_message(session_id: int, changes: dict):
+    return json.dumps({
+        "type": "leaderboard",
+        "session_id": session_id,
+        "changes": [entry for entry in changes.values() if entry is not None],
+        "removed": [participant_id for participant_id, entry in changes.items() if entry is None],
+    })
+
+
+async def read_leaderboard(session_id: int):
+    """the live board when this process has one, otherwise a single query on a pooled connection"""
+    board = leaderboards.get(session_id)
+    if board is not None:
+        return board.entries()
+    return await asyncio.to_thread(_query_leaderboard, session_id)
+
+
+def _query_leaderboard(session_id: int):
+    with db_setup.pooled_connection() as con:
+        return [dict(row) for row in db.get_leaderboard(con, session_id)]
+
+
+# session_id -> SessionChannel, only touched from the event loop
+channels = {}
+_loop = None
+
+
+def start(loop: asyncio.AbstractEventLoop):
+    """remember the api's event loop, notifications from worker threads are handed to it"""
+    global _loop
+    _loop = loop
+
+
+def stop():
+    global _loop
+    for existing in list(channels.values()):
+        existing.close()
+    _loop = None
+
+
+def channel(session_id: int):
+    """the channel of a session, created on first use, must be called on the event loop"""
+    existing = channels.get(session_id)
+    if existing is None:
+        existing = channels[session_id] = SessionChannel(session_id)
+    return existing
+
+
+async def serve(websocket: WebSocket, session_id: int, is_active: bool):
+    """stream a session's updates to one websocket until the session ends or the client leaves"""
+    await websocket.accept()
+    if not is_active:
+        await websocket.send_text(json.dumps({"type": "session_ended", "session_id": session_id}))
+        await websocket.close()
+        return
+    session_channel = channel(session_id)
+    subscriber = Subscriber(websocket)
+    sender = receiver = None
+    try:
+        await websocket.send_text(await session_channel.subscribe(subscriber))
+        sender = asyncio.create_task(subscriber.run(session_id))
+        receiver = asyncio.create_task(_wait_for_disconnect(websocket))
+        done, _ = await asyncio.wait({sender, receiver}, return_when=asyncio.FIRST_COMPLETED)
+        if sender in done and sender.exception() is None:
+            # the session is over, everything has been sent
+            await websocket.close()
+        elif sender in done:
+            logger.info("dropping a slow subscriber of session %d: %r", session_id, sender.exception())
+            await websocket.close(code=1013)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        for task in (sender, receiver):
+            if task is not None:
+                task.cancel()
+        session_channel.unsubscribe(subscriber)
+
+
+async def _wait_for_disconnect(websocket: WebSocket):
+    # clients don't send anything, reading is only how a disconnect is noticed
+    try:
+        while True:
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        return
+
+
+def _call(session_id: int, method: str, *args):
+    # nobody is listening to most sessions, so skip the hop to the event loop for them
+    if _loop is None or session_id not in channels:
+        return
+
+    def deliver():
+        target = channels.get(session_id)
+        if target is not None:
+            getattr(target, method)(*args)
+
+    _loop.call_soon_threadsafe(deliver)
+
+
+def leaderboard_changed(session_id: int):
+    _call(session_id, "leaderboard_changed")
+
+
+def question_started(session_id: int, question: dict, answers):
+    _call(session_id, "publish", {
+        "type": "question",
+        "question": question,
+        "answers": [{"id": answer["id"], "answer_text": answer["answer_text"]} for answer in answers],
+    })
+
+
+def session_ended(session_id: int):
+    _call(session_id, "publish", {"type": "session_ended"})
@@ -0,0 +1,123 @@
+import os
+import random
+import threading
+from array import array
+from collections import deque
+import exceptions
+"""
+Session PINs: handing out unused ones, and finding the live session behind one without a query.
+
+PinAllocator shuffles every PIN of SESSION_PIN_DIGITS digits once, the first time a session is
+created without a PIN, and then hands them out from the front of that array, which is O(1) per
+PIN. PINs of sessions that are live at that moment are skipped. The PIN of a session that ends
+is only handed out again once the whole shuffled array has been used, so a player holding an old
+PIN is very unlikely to land in somebody else's game. The database only has to keep the PINs of
+live sessions unique (migrations/0005_active_session_pins.sql), and it still has the last word:
+db.py retries with the next PIN when an insert collides, e.g with a PIN handed out by another worker.
+
+ActivePins maps the PIN of every live session this process knows about to the session's id, so a
+player joining with GET /game-sessions/pin/{pin} costs a primary key lookup instead of a search on
+the PIN. The lookup also tells whether the session is still live: one ended through another uvicorn
+worker or by hand stays in this worker's map, and its PIN may belong to a new session by now.
+"""
+
+SESSION_PIN_DIGITS = int(os.getenv("SESSION_PIN_DIGITS", "6"))
+
+# attempts at inserting a session before giving up, a collision needs another worker or a manual PIN
+PIN_ATTEMPTS = 5
+
+
+class PinAllocator:
+    """thread safe pool of unused numeric PINs in a random order"""
+
+    def __init__(self, digits: int):
+        self.digits = digits
+        self._lock = threading.Lock()
+        self._pins = None  # every PIN once, shuffled, handed out from _next on
+        self._next = 0
+        self._in_use = set()
+        self._recycled = deque()  # released PINs, oldest first
+
+    @property
+    def loaded(self):
+        return self._pins is not None
+
+    def load(self, pins_in_use):
+        """shuffle the pool, leaving out the PINs of the sessions that are live right now"""
+        pins = array("I", range(10 ** self.digits))
+        random.shuffle(pins)
+        with self._lock:
+            if self._pins is not None:
+                return
+            self._in_use = {pin for pin in map(self._parse, pins_in_use) if pin is not None}
+            self._pins = pins
+
+    def allocate(self):
+        with self._lock:
+            pin = None
+            while pin is None and self._next < len(self._pins):
+                candidate = self._pins[self._next]
+                self._next += 1
+                if candidate not in self._in_use:
+                    pin = candidate
+            if pin is None:
+                if not self._recycled:
+                    raise exceptions.NoFreeSessionPinException(len(self._in_use))
+                pin = self._recycled.popleft()
+            self._in_use.add(pin)
+            return self._format(pin)
+
+    def claim(self, pin: str):
+        """a session got this PIN some other way (given by the host, or reactivated), don't hand it out"""
+        number = self._parse(pin)
+        with self._lock:
+            if number is None or number in self._in_use:
+                return
+            self._in_use.add(number)
+            if self._recycled and number in self._recycled:
+                self._recycled.remove(number)
+
+    def release(self, pin: str):
+        """the session holding this PIN ended, it goes to the back of the line"""
+        number = self._parse(pin)
+        with self._lock:
+            if number is not None and number in self._in_use:
+                self._in_use.remove(number)
+                self._recycled.append(number)
+
+    def _format(self, pin: int):
+        return str(pin).zfill(self.digits)
+
+    def _parse(self, pin: str):
+        # only PINs that look like ours take part, a host may pick anything else
+        if pin is None or len(pin) != self.digits or not pin.isdigit():
+            return None
+        return int(pin)
+
+
+class ActivePins:
+    """PIN -> game session id of every live session this process knows about"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions = {}
+
+    def get(self, pin: str):
+        return self._sessions.get(pin)
+
+    def add(self, session: dict):
+        with self._lock:
+            self._sessions[session["session_pin"]] = session["id"]
+
+    def remove(self, pin: str, session_id: int):
+        with self._lock:
+            if self._sessions.get(pin) == session_id:
+                del self._sessions[pin]
+
+    def clear(self):
+        with self._lock:
+            self._sessions.clear()
+
+
+pin_allocator = PinAllocator(SESSION_PIN_DIGITS)
+active_pins = ActivePins()
@@ -0,0 +1,227 @@
+import asyncio
+import contextvars
+import hmac
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+import psycopg2
+import psycopg2.extensions
+"""
+Slow query capture for db.py and db_async.py.
+
+Every statement the api runs that takes longer than SLOW_QUERY_MS is logged with its parameters and
+kept in a ring buffer of the last SLOW_QUERY_BUFFER ones, which GET /admin/slow-queries returns.
+A sampled fraction of them (SLOW_QUERY_EXPLAIN_RATE) is run once more under EXPLAIN (ANALYZE,
+BUFFERS) and the plan is stored with the entry. A plan whose execution time is close to the time the
+statement took points at the plan or the data, a fast plan for a statement that was slow points at
+contention (locks, a busy pool or a busy server).
+
+EXPLAIN ANALYZE really runs the statement, so whatever it writes has to be undone:
+- db.py's connections come from the pool as SlowQueryConnection, whose cursors time execute(). The
+  plan is taken right after the slow statement, on the same connection inside a savepoint that is
+  rolled back, so it sees exactly the data the statement saw.
+- asyncpg reports every query to a query logger once it's done, while the connection may still be
+  busy, so db_async.py's plans are taken on another pooled connection, in a transaction that is
+  rolled back. That connection can't see what the slow statement's transaction hasn't committed.
+Statements other than a single SELECT, INSERT, UPDATE, DELETE, WITH, VALUES or EXECUTE are logged
+but never explained. SLOW_QUERY_MS=0 turns all of it off.
+
+The entries hold the parameters of real requests (usernames, answers), so the /admin/slow-queries
+routes only exist when SLOW_QUERY_ADMIN_TOKEN is set, and every call has to send it in the
+X-Admin-Token header. Without a token the slow statements are still logged.
+"""
+
+logger = logging.getLogger(__name__)
+
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "200"))
+SLOW_QUERY_EXPLAIN_RATE = float(os.getenv("SLOW_QUERY_EXPLAIN_RATE", "0.1"))
+SLOW_QUERY_BUFFER = int(os.getenv("SLOW_QUERY_BUFFER", "100"))
+SLOW_QUERY_ADMIN_TOKEN = os.getenv("SLOW_QUERY_ADMIN_TOKEN", "")
+
+EXPLAINABLE = ("select", "insert", "update", "delete", "with", "values", "execute")
+
+# parameters are cut off here in the log and the buffer, an import sends arrays of thousands of values
+PARAMETERS_LENGTH = 1000
+
+
+class SlowQueries:
+    """ring buffer of the last slow statements, newest last"""
+
+    def __init__(self, size: int):
+        self._lock = threading.Lock()
+        self._entries = deque(maxlen=size)
+
+    def add(self, entry: dict):
+        with self._lock:
+            self._entries.append(entry)
+
+    def entries(self, limit: int = None):
+        """the newest entries first"""
+        with self._lock:
+            entries = list(reversed(self._entries))
+        return entries[:limit] if limit else entries
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+slow_queries = SlowQueries(SLOW_QUERY_BUFFER)
+
+
+def enabled():
+    return SLOW_QUERY_MS > 0
+
+
+def admin_enabled():
+    """whether the api serves the slow query buffer at all"""
+    return enabled() and bool(SLOW_QUERY_ADMIN_TOKEN)
+
+
+def authorized(token: str):
+    # compare_digest doesn't give the token away through how long the comparison takes
+    return bool(token) and hmac.compare_digest(token.encode(), SLOW_QUERY_ADMIN_TOKEN.encode())
+
+
+def _explainable(statement: str):
+    if ";" in statement.rstrip().rstrip(";"):
+        # several commands, e.g the query asyncpg's pool resets a connection with, can't be explained
+        return False
+    words = statement.lstrip(" \n\t(").split(None, 1)
+    return bool(words) and words[0].lower() in EXPLAINABLE
+
+
+def _should_explain(statement: str):
+    return random.random() < SLOW_QUERY_EXPLAIN_RATE and _explainable(statement)
+
+
+def record(statement: str, parameters, duration_ms: float):
+    """log a slow statement and keep it in the ring buffer, returns the entry so a plan can be added"""
+    shown = repr(parameters)
+    if len(shown) > PARAMETERS_LENGTH:
+        shown = shown[:PARAMETERS_LENGTH] + "..."
+    logger.warning("slow query (%.1f ms): %s parameters: %s", duration_ms, statement.strip(), shown)
+    entry = {
+        "at": datetime.now(timezone.utc).isoformat(),
+        "duration_ms": round(duration_ms, 3),
+        "statement": statement.strip(),
+        "parameters": shown,
+        "plan": None,
+    }
+    slow_queries.add(entry)
+    return entry
+
+
+def _plan(rows):
+    return "\n".join(row[0] for row in rows)
+
+
+# psycopg2, for db.py
+
+
+def _explain(con, statement: str, parameters):
+    """EXPLAIN ANALYZE the statement again in a savepoint that is rolled back, None if that can't be done"""
+    if con.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_INTRANS:
+        # outside a transaction (autocommit) there is nothing to roll back to
+        return None
+    # a plain cursor, one of ours would time the EXPLAIN as well
+    with psycopg2.extensions.cursor(con) as cursor:
+        cursor.execute("SAVEPOINT slow_query_explain;")
+        try:
+            cursor.execute("EXPLAIN (ANALYZE, BUFFERS) " + statement, parameters)
+            return _plan(cursor.fetchall())
+        except psycopg2.Error as e:
+            # e.g a unique key the statement's own first run has taken already
+            logger.warning("could not explain a slow query: %s", e)
+            return None
+        finally:
+            cursor.execute("ROLLBACK TO SAVEPOINT slow_query_explain;")
+            cursor.execute("RELEASE SAVEPOINT slow_query_explain;")
+
+
+class SlowQueryCursor:
+    """mixed into the cursor classes of a SlowQueryConnection, times every execute()"""
+
+    def execute(self, query, vars=None):
+        if self.name is not None:
+            # a named cursor only declares the query here, the work happens when it's fetched
+            return super().execute(query, vars)
+        started = time.perf_counter()
+        result = super().execute(query, vars)
+        duration_ms = (time.perf_counter() - started) * 1000
+        if duration_ms >= SLOW_QUERY_MS:
+            statement = query if isinstance(query, str) else query.as_string(self.connection)
+            entry = record(statement, vars, duration_ms)
+            if _should_explain(statement):
+                entry["plan"] = _explain(self.connection, statement, vars)
+        return result
+
+
+_cursor_classes = {}
+_cursor_classes_lock = threading.Lock()
+
+
+def _slow_query_cursor(cursor_class):
+    with _cursor_classes_lock:
+        slow_class = _cursor_classes.get(cursor_class)
+        if slow_class is None:
+            slow_class = _cursor_classes[cursor_class] = type(
+                "SlowQuery" + cursor_class.__name__, (SlowQueryCursor, cursor_class), {}
+            )
+    return slow_class
+
+
+class SlowQueryConnection(psycopg2.extensions.connection):
+    """connection whose cursors, whatever cursor_factory asks for, report slow statements"""
+
+    def cursor(self, *args, **kwargs):
+        cursor_class = kwargs.pop("cursor_factory", None) or self.cursor_factory or psycopg2.extensions.cursor
+        return super().cursor(*args, cursor_factory=_slow_query_cursor(cursor_class), **kwargs)
+
+
+# asyncpg, for db_async.py
+
+# the running EXPLAIN tasks, the event loop itself only keeps weak references to them
+_explaining = set()
+# set inside those tasks, asyncpg calls the query loggers in the context of the query, so what
+# an EXPLAIN task runs itself (BEGIN, the EXPLAIN, ROLLBACK, the pool's reset) isn't recorded
+_in_explain = contextvars.ContextVar("in_explain", default=False)
+
+
+async def _explain_async(pooled_connection, statement: str, args, entry: dict):
+    _in_explain.set(True)
+    try:
+        async with pooled_connection() as con:
+            transaction = con.transaction()
+            await transaction.start()
+            try:
+                # don't wait long for rows the slow statement's own transaction still has locked
+                await con.execute("SET LOCAL lock_timeout = '1s';")
+                entry["plan"] = _plan(await con.fetch("EXPLAIN (ANALYZE, BUFFERS) " + statement, *args))
+            finally:
+                await transaction.rollback()
+    except Exception as e:
+        logger.warning("could not explain a slow query: %s", e)
+
+
+def asyncpg_logger(pooled_connection):
+    """
+    a query logger for asyncpg connections (Connection.add_query_logger) that records slow queries,
+    the sampled plans are taken with a connection from `pooled_connection`
+    """
+
+    def log_query(query):
+        duration_ms = query.elapsed * 1000
+        if duration_ms < SLOW_QUERY_MS or query.exception is not None or _in_explain.get():
+            return
+        entry = record(query.query, query.args, duration_ms)
+        if _should_explain(query.query):
+            task = asyncio.get_running_loop().create_task(_explain_async(pooled_connection, query.query, query.args, entry))
+            _explaining.add(task)
+            task.add_done_callback(_explaining.discard)
+
+    return log_query
@@ -0,0 +1,94 @@
+import threading
+from collections import Counter
+"""
+Which player_answers a leaderboard or answer distribution built from SQL already counts.
+
+Answers committed while one is being built could otherwise be counted twice or not at all. So it
+remembers the newest player_answers id its snapshot could see, plus the ids of the session's answers
+among the last SNAPSHOT_WINDOW ids. Those are the only ones that might still have been in flight when
+the snapshot was taken. read() and read_async() take both in the REPEATABLE READ transaction the rows
+were read in, so they see the same snapshot.
+
+The answer buffer's flusher (ANSWER_WRITE_MODE=buffered) counts a batch in the live boards and
+distributions right after it committed it, with the ids it was written with. A batch committed
+while one is being built finds nothing to count in yet, so WrittenAnswers keeps the batches written
+since the oldest build still running started, and a build catches up on them once it's installed.
+Counting a batch and installing a build take the same lock, neither holds it across a query.
+"""
+
+# how far below the newest id an answer may still have been uncommitted when a snapshot was taken
+SNAPSHOT_WINDOW = 1000
+
+MAX_ANSWER_ID_SQL = "SELECT COALESCE(MAX(id), 0) AS max_id FROM player_answers;"
+RECENT_ANSWER_IDS_SQL = "SELECT id FROM player_answers WHERE session_id = %s AND id > %s;"
+RECENT_ANSWER_IDS_ASYNC_SQL = "SELECT id FROM player_answers WHERE session_id = $1 AND id > $2;"
+
+
+class AnswerSnapshot:
+    """the player_answers ids a snapshot could see, an empty one has seen none"""
+
+    def __init__(self, max_answer_id: int = 0, recent_answer_ids=()):
+        self.max_answer_id = max_answer_id
+        self.recent_answer_ids = set(recent_answer_ids)
+
+    def __contains__(self, score_id: int):
+        if score_id > self.max_answer_id:
+            return False
+        if score_id > self.max_answer_id - SNAPSHOT_WINDOW:
+            return score_id in self.recent_answer_ids
+        return True
+
+
+def read(cursor, session_id: int):
+    """the snapshot of the transaction `cursor` runs in, for the answers of one session"""
+    cursor.execute(MAX_ANSWER_ID_SQL)
+    max_answer_id = cursor.fetchone()["max_id"]
+    cursor.execute(RECENT_ANSWER_IDS_SQL, (session_id, max_answer_id - SNAPSHOT_WINDOW))
+    return AnswerSnapshot(max_answer_id, [row["id"] for row in cursor.fetchall()])
+
+
+async def read_async(con, session_id: int):
+    """read() on an asyncpg connection"""
+    max_answer_id = await con.fetchval(MAX_ANSWER_ID_SQL)
+    rows = await con.fetch(RECENT_ANSWER_IDS_ASYNC_SQL, session_id, max_answer_id - SNAPSHOT_WINDOW)
+    return AnswerSnapshot(max_answer_id, [row["id"] for row in rows])
+
+
+class WrittenAnswers:
+    """the answers the flusher wrote while a leaderboard or distribution was being built"""
+
+    def __init__(self):
+        # held while the flusher counts a batch and while a build is installed and catches up
+        self.lock = threading.Lock()
+        self._answers = []  # (score_id, row) pairs, see answer_buffer.COLUMNS for the row
+        self._first = 0  # the position of the first of them
+        self._builds = Counter()  # position -> builds that catch up from there
+
+    def start(self):
+        """a build is about to read its snapshot, returns the position it catches up from"""
+        with self.lock:
+            position = self._first + len(self._answers)
+            self._builds[position] += 1
+            return position
+
+    def add(self, answers):
+        """keep (score_id, row) pairs the flusher just wrote, only with the lock held"""
+        if self._builds:
+            self._answers.extend(answers)
+
+    def since(self, position: int):
+        """the answers written since a build started at `position`, only with the lock held"""
+        return self._answers[position - self._first:]
+
+    def finish(self, position: int):
+        """a build started at `position` is installed or gave up, forget what nobody catches up on"""
+        with self.lock:
+            self._builds[position] -= 1
+            if not self._builds[position]:
+                del self._builds[position]
+            oldest = min(self._builds, default=self._first + len(self._answers))
+            del self._answers[:oldest - self._first]
+            self._first = oldest
+
+
+written_answers = WrittenAnswers()
@@ -0,0 +1,14 @@
+from contextlib import contextmanager
+import pytest
+import db_setup
+
+
+@pytest.fixture
+def pooled_connection(monkeypatch):
+    """db_setup.pooled_connection() lends no connection, for tests that fake the queries using it"""
+
+    @contextmanager
+    def pooled_connection():
+        yield None
+
+    monkeypatch.setattr(db_setup, "pooled_connection", pooled_connection)
@@ -0,0 +1,233 @@
+import threading
+import time
+import psycopg2
+import pytest
+import answer_buffer
+import final_score
+import exceptions
+import schemas
+from answer_buffer import AnswerWriteBuffer
+from answer_distribution import QuestionDistribution, distributions
+from snapshots import AnswerSnapshot, written_answers
+
+BAD_PARTICIPANT = 404
+
+
+class FakeDatabase:
+    """stands in for answer_buffer.write_answers, can be held up or made to fail"""
+
+    def __init__(self):
+        self.rows = []
+        self.batches = []
+        self.gate = threading.Event()
+        self.gate.set()
+        self.failures = 0  # the next writes that fail as if the database were down
+
+    def write_answers(self, con, rows):
+        self.gate.wait()
+        if self.failures:
+            self.failures -= 1
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+        if any(row[1] == BAD_PARTICIPANT for row in rows):
+            raise psycopg2.IntegrityError("insert or update on table player_answers violates foreign key constraint")
+        self.batches.append(len(rows))
+        ids = list(range(len(self.rows) + 1, len(self.rows) + len(rows) + 1))
+        self.rows.extend(rows)
+        return ids
+
+
+@pytest.fixture
+def database(monkeypatch, pooled_connection):
+    fake = FakeDatabase()
+    monkeypatch.setattr(answer_buffer, "write_answers", fake.write_answers)
+    yield fake
+    fake.gate.set()
+
+
+@pytest.fixture
+def buffer(database):
+    answers = AnswerWriteBuffer(max_size=3, batch_size=10, flush_interval=0.01)
+    answers.start()
+    yield answers
+    answers.stop()
+
+
+def answer(participant_id=1, session_id=1):
+    return schemas.PlayerAnswerCreate(
+        session_id=session_id, participant_id=participant_id, question_id=1, answer_id=1, time_taken=1.5
+    )
+
+
+def test_answers_are_refused_while_the_flusher_isnt_running(database):
+    with pytest.raises(exceptions.AnswerBufferStoppedException):
+        AnswerWriteBuffer(max_size=3, batch_size=10, flush_interval=0.01).submit(answer(), 500)
+
+
+def test_queued_answers_are_written_and_drained(buffer, database):
+    for participant_id in range(1, 4):
+        buffer.submit(answer(participant_id), 100 * participant_id)
+    assert buffer.drain(5)
+    assert database.rows == [(1, participant_id, 1, 1, 1.5, 100 * participant_id) for participant_id in range(1, 4)]
+    assert buffer.pending() == 0
+
+
+def test_a_full_queue_refuses_answers_right_away(buffer, database):
+    database.gate.clear()
+    buffer.submit(answer(), 1)
+    # wait until the flusher holds the first answer, then fill the queue behind it
+    while buffer.pending():
+        time.sleep(0.001)
+    for _ in range(3):
+        buffer.submit(answer(), 1)
+    with pytest.raises(exceptions.AnswerBufferFullException):
+        buffer.submit(answer(), 1)
+    assert not buffer.drain(0.05)
+    database.gate.set()
+    assert buffer.drain(5)
+    assert len(database.rows) == 4
+
+
+def test_a_failed_batch_is_retried_instead_of_lost(buffer, database):
+    database.failures = 2
+    buffer.submit(answer(1), 100)
+    buffer.submit(answer(2), 200)
+    assert buffer.drain(5)
+    assert sorted(row[1] for row in database.rows) == [1, 2]
+    assert buffer.dropped == 0
+
+
+def test_only_the_rows_the_database_refuses_are_dropped(buffer, database):
+    database.gate.clear()
+    for participant_id in (1, BAD_PARTICIPANT, 2):
+        buffer.submit(answer(participant_id), 100)
+    database.gate.set()
+    assert buffer.drain(5)
+    assert sorted(row[1] for row in database.rows) == [1, 2]
+    assert buffer.dropped == 1
+
+
+def test_a_closed_session_takes_no_answers(buffer, database):
+    buffer.submit(answer(session_id=7), 100)
+    buffer.close_session(7)
+    with pytest.raises(exceptions.GameSessionNotLiveException):
+        buffer.submit(answer(session_id=7), 100)
+    buffer.submit(answer(session_id=8), 100)
+    buffer.reopen_session(7)
+    buffer.submit(answer(session_id=7), 100)
+    assert buffer.drain(5)
+    assert [row[0] for row in database.rows] == [7, 8, 7]
+
+
+def test_stop_writes_what_is_still_queued(database):
+    answers = AnswerWriteBuffer(max_size=10, batch_size=2, flush_interval=0.01)
+    answers.start()
+    for participant_id in range(5):
+        answers.submit(answer(participant_id), 100)
+    answers.stop()
+    assert len(database.rows) == 5
+    with pytest.raises(exceptions.AnswerBufferStoppedException):
+        answers.submit(answer(), 100)
+
+
+@pytest.fixture
+def live_distributions():
+    yield distributions
+    distributions.clear()
+
+
+def distribution(count, snapshot):
+    """the distribution of question 1 of session 1, its GROUP BY counted `count` picks of answer 1"""
+    rows = [{"answer_id": 1, "answer_text": "yes", "is_correct": True, "count": count, "total_time_taken": 1.5 * count}]
+    return QuestionDistribution(1, 1, rows, snapshot)
+
+
+def count(live):
+    return live.entries()["answers"][0]["count"]
+
+
+def test_a_distribution_counts_the_answers_written_since_it_was_built(buffer, database, live_distributions):
+    position = written_answers.start()
+    try:
+        buffer.submit(answer(), 100)
+        assert buffer.drain(5)
+        # its GROUP BY ran before the answer was written
+        live = distributions.install(distribution(0, AnswerSnapshot(0)), position)
+    finally:
+        written_answers.finish(position)
+    assert count(live) == 1
+    buffer.submit(answer(), 100)
+    assert buffer.drain(5)
+    assert count(live) == 2
+
+
+def test_a_distribution_doesnt_count_a_written_answer_twice(buffer, database, live_distributions):
+    position = written_answers.start()
+    try:
+        buffer.submit(answer(), 100)
+        assert buffer.drain(5)
+        # its GROUP BY already saw the answer, id 1
+        live = distributions.install(distribution(1, AnswerSnapshot(1, [1])), position)
+    finally:
+        written_answers.finish(position)
+    assert count(live) == 1
+
+
+class FakeCursor:
+    def __init__(self):
+        self.copied = None
+        self.reserved = 0
+
+    def execute(self, sql, params):
+        self.reserved = params[0]
+
+    def fetchall(self):
+        return [(100 + number,) for number in range(self.reserved)]
+
+    def copy_expert(self, sql, data):
+        self.copied = data.read()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class FakeConnection:
+    def __init__(self):
+        self.cursor_ = FakeCursor()
+
+    def cursor(self):
+        return self.cursor_
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+@pytest.fixture
+def score_updates(monkeypatch):
+    updates = []
+    monkeypatch.setattr(answer_buffer, "execute_values", lambda cursor, sql, values: updates.append(values))
+    return updates
+
+
+def test_final_scores_are_added_up_per_participant(monkeypatch, score_updates):
+    monkeypatch.setattr(final_score, "FINAL_SCORE_MODE", "running")
+    con = FakeConnection()
+    rows = [(1, 10, 1, 1, 1.5, 500), (1, 11, 1, 2, 2.0, 0), (1, 10, 2, 3, 0.5, 900)]
+    assert answer_buffer.write_answers(con, rows) == [100, 101, 102]
+    assert con.cursor_.copied.splitlines() == [
+        "100\t1\t10\t1\t1\t1.5\t500", "101\t1\t11\t1\t2\t2.0\t0", "102\t1\t10\t2\t3\t0.5\t900"
+    ]
+    assert score_updates == [[(10, 1400), (11, 0)]]
+
+
+def test_deferred_final_scores_are_not_updated(monkeypatch, score_updates):
+    monkeypatch.setattr(final_score, "FINAL_SCORE_MODE", "deferred")
+    con = FakeConnection()
+    answer_buffer.write_answers(con, [(1, 10, 1, 1, 1.5, 500)])
+    assert con.cursor_.copied == "100\t1\t10\t1\t1\t1.5\t500\n"
+    assert score_updates == []
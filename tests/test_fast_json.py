@@ -0,0 +1,63 @@
+import json
+from datetime import datetime
+import pytest
+from fastapi.encoders import jsonable_encoder
+from pydantic import BaseModel
+import fast_json
+import schemas
+
+JOINED = datetime(2025, 3, 1, 12, 30, 15, 123456)
+
+
+def pydantic_json(model, rows):
+    """what the normal path sends: every row validated into the response model"""
+    return json.loads(json.dumps(jsonable_encoder([model.model_validate(dict(row)) for row in rows])))
+
+
+def fast_path_json(model, rows, columns=None):
+    return json.loads(fast_json.dumps(fast_json.model_rows(model, rows, columns)))
+
+
+@pytest.fixture(params=["orjson", "json"])
+def encoder(request, monkeypatch):
+    if request.param == "json":
+        monkeypatch.setattr(fast_json, "orjson", None)
+    elif fast_json.orjson is None:
+        pytest.skip("orjson isn't installed")
+    return request.param
+
+
+def test_mapping_rows_like_the_response_model(encoder):
+    rows = [
+        {"id": 1, "game_session_id": 7, "user_id": None, "username": "ann", "joined_at": JOINED, "final_score": 900, "rank": 1},
+        {"id": 2, "game_session_id": 7, "user_id": 3, "username": None, "joined_at": JOINED, "final_score": 0, "rank": None},
+    ]
+    assert fast_path_json(schemas.Participant, rows) == pydantic_json(schemas.Participant, rows)
+
+
+def test_tuple_rows_in_another_column_order(encoder):
+    columns = ("username", "total_score", "participant_id", "correct_answers")
+    rows = [("ann", 1500, 4, 2), ("bob", 900, 2, 1)]
+    expected = pydantic_json(schemas.LeaderboardEntry, [dict(zip(columns, row)) for row in rows])
+    assert fast_path_json(schemas.LeaderboardEntry, rows, columns) == expected
+    assert list(fast_json.model_rows(schemas.LeaderboardEntry, rows, columns)[0]) == list(schemas.LeaderboardEntry.model_fields)
+
+
+def test_missing_columns_get_the_model_defaults_and_extra_ones_are_left_out(encoder):
+    columns = ("creation_date", "id", "title", "category", "next_cursor")
+    rows = [(JOINED, 5, "Capitals", "geography", "abc")]
+    expected = pydantic_json(schemas.Kahoot, [dict(zip(columns, row)) for row in rows])
+    assert fast_path_json(schemas.Kahoot, rows, columns) == expected
+    assert expected[0]["version"] == 1 and expected[0]["description"] is None
+
+
+def test_a_model_with_a_single_field():
+    class Pin(BaseModel):
+        session_pin: str
+
+    rows = [(1, "123456"), (2, "654321")]
+    assert fast_json.model_rows(Pin, rows, ("id", "session_pin")) == [{"session_pin": "123456"}, {"session_pin": "654321"}]
+
+
+def test_no_rows():
+    assert fast_json.model_rows(schemas.Participant, []) == []
@@ -0,0 +1,158 @@
+import pytest
+import answer_buffer
+import schemas
+from answer_buffer import AnswerWriteBuffer
+from leaderboard import LeaderboardRegistry, SessionLeaderboard, leaderboards
+from snapshots import SNAPSHOT_WINDOW, AnswerSnapshot, written_answers
+
+
+def row(participant_id, total_score, correct_answers=0, username=None):
+    return {
+        "participant_id": participant_id,
+        "username": username or f"player{participant_id}",
+        "total_score": total_score,
+        "correct_answers": correct_answers,
+    }
+
+
+def board(*rows, snapshot=None):
+    return SessionLeaderboard(1, rows, snapshot or AnswerSnapshot())
+
+
+def order(leaderboard):
+    return [entry["participant_id"] for entry in leaderboard.entries()]
+
+
+def test_entries_are_sorted_best_first():
+    leaderboard = board(row(1, 100), row(2, 300), row(3, 200))
+    assert order(leaderboard) == [2, 3, 1]
+    assert leaderboard.entries(2) == [row(2, 300), row(3, 200)]
+
+
+def test_ties_are_broken_on_participant_id():
+    leaderboard = board(row(3, 500), row(1, 500), row(2, 500))
+    assert order(leaderboard) == [1, 2, 3]
+
+
+def test_record_moves_a_participant_and_counts_correct_answers():
+    leaderboard = board(row(1, 100), row(2, 300))
+    assert leaderboard.record(1, 900)
+    assert leaderboard.record(1, 0)
+    assert order(leaderboard) == [1, 2]
+    assert leaderboard.entries(1) == [row(1, 1000, correct_answers=1)]
+
+
+def test_record_of_a_participant_that_isnt_on_the_board():
+    leaderboard = board(row(1, 100))
+    assert not leaderboard.record(2, 500)
+    leaderboard.add_participant(2, "late")
+    assert leaderboard.record(2, 500)
+    assert order(leaderboard) == [2, 1]
+
+
+def test_remove_and_rename_participant():
+    leaderboard = board(row(1, 100), row(2, 200))
+    leaderboard.rename_participant(1, "renamed")
+    leaderboard.remove_participant(2)
+    assert leaderboard.entries() == [row(1, 100, username="renamed")]
+
+
+def test_rank_with_neighbours():
+    leaderboard = board(*[row(participant_id, 1000 - participant_id) for participant_id in range(1, 7)])
+    rank = leaderboard.rank(4, 1)
+    assert rank["rank"] == 4 and rank["participants"] == 6
+    assert [(other["participant_id"], other["rank"]) for other in rank["neighbours"]] == [(3, 3), (5, 5)]
+    assert leaderboard.rank(99, 1) is None
+
+
+def test_answers_in_the_snapshot_are_not_counted_twice():
+    # the board was built when answer 5000 was the newest, 4990 was already committed for this session
+    snapshot = AnswerSnapshot(5000, [4990])
+    leaderboard = board(row(1, 100), snapshot=snapshot)
+    leaderboard.record(1, 500, score_id=4990)  # counted by the query already
+    leaderboard.record(1, 500, score_id=4995)  # in flight while the board was built
+    leaderboard.record(1, 500, score_id=5001)  # newer than the snapshot
+    leaderboard.record(1, 500, score_id=5000 - SNAPSHOT_WINDOW)  # long committed, in the query's rows
+    assert leaderboard.entries() == [row(1, 1100, correct_answers=2)]
+
+
+def test_snapshot_window():
+    snapshot = AnswerSnapshot(5000, [4500])
+    assert 4500 in snapshot
+    assert 4501 not in snapshot
+    assert 5001 not in snapshot
+    assert 5000 - SNAPSHOT_WINDOW in snapshot
+    assert 1 not in AnswerSnapshot()
+
+
+def test_registry_keeps_the_first_board():
+    registry = LeaderboardRegistry()
+    position = written_answers.start()
+    first = registry.install(board(row(1, 100)), position)
+    assert registry.install(board(row(2, 200)), position) is first
+    written_answers.finish(position)
+    registry.drop(1)
+    assert registry.get(1) is None
+
+
+@pytest.fixture
+def buffer(monkeypatch, pooled_connection):
+    """an answer buffer that writes answer n with id n and counts it on the live boards"""
+    written = []
+
+    def write_answers(con, rows):
+        written.extend(rows)
+        return list(range(len(written) - len(rows) + 1, len(written) + 1))
+
+    monkeypatch.setattr(answer_buffer, "write_answers", write_answers)
+    monkeypatch.setattr(answer_buffer, "participant_usernames", lambda con, ids: {participant_id: f"player{participant_id}" for participant_id in ids})
+    answers = AnswerWriteBuffer(max_size=10, batch_size=10, flush_interval=0.01)
+    answers.start()
+    yield answers
+    answers.stop()
+    leaderboards.clear()
+
+
+def flushed(answers, participant_id, points_earned):
+    """submit an answer of session 1 and wait until the flusher wrote it"""
+    answers.submit(
+        schemas.PlayerAnswerCreate(session_id=1, participant_id=participant_id, question_id=1, answer_id=1, time_taken=1.5),
+        points_earned,
+    )
+    assert answers.drain(5)
+
+
+def scores(leaderboard):
+    return {entry["participant_id"]: entry["total_score"] for entry in leaderboard.entries()}
+
+
+def test_an_answer_flushed_before_the_board_is_built_counts_once(buffer):
+    position = written_answers.start()
+    try:
+        flushed(buffer, 1, 100)
+        # the board's query already saw answer 1
+        live = leaderboards.install(board(row(1, 100), row(2, 0), snapshot=AnswerSnapshot(1, [1])), position)
+    finally:
+        written_answers.finish(position)
+    assert scores(live) == {1: 100, 2: 0}
+
+
+def test_an_answer_flushed_while_the_board_is_built_counts_once(buffer):
+    position = written_answers.start()
+    try:
+        # the board's query ran before answer 1 was written
+        flushed(buffer, 1, 100)
+        live = leaderboards.install(board(row(1, 0), row(2, 0)), position)
+    finally:
+        written_answers.finish(position)
+    assert scores(live) == {1: 100, 2: 0}
+    flushed(buffer, 2, 50)
+    assert scores(live) == {1: 100, 2: 50}
+
+
+def test_a_flushed_answer_puts_an_unknown_participant_on_the_board(buffer):
+    position = written_answers.start()
+    live = leaderboards.install(board(row(1, 0)), position)
+    written_answers.finish(position)
+    flushed(buffer, 2, 300)
+    assert live.entries() == [row(2, 300, correct_answers=1), row(1, 0)]
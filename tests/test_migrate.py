@@ -0,0 +1,96 @@
+import pytest
+import exceptions
+import migrate
+from migrate import Migration
+
+NO_TRANSACTION_SQL = """-- migrate: no-transaction
+-- builds the index without blocking writes
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_a ON a (b);
+
+  -- an indented comment
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS idx_c ON c (d);
+"""
+
+
+def test_statements_are_split_on_semicolons_without_comments():
+    migration = Migration(3, "indexes", NO_TRANSACTION_SQL)
+    assert not migration.transactional
+    assert migration.statements() == [
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_a ON a (b)",
+        "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS idx_c ON c (d)",
+    ]
+    assert [migrate.CONCURRENT_INDEX.match(statement).group(1) for statement in migration.statements()] == ["idx_a", "idx_c"]
+
+
+def test_a_dollar_quoted_body_is_one_statement():
+    migration = Migration(6, "backfill", """-- migrate: no-transaction
+DO $$
+BEGIN
+    UPDATE a SET b = 0 WHERE b IS NULL;
+    COMMIT;
+END
+$$;
+ALTER TABLE a ALTER COLUMN b SET NOT NULL;
+SELECT $fn$ ; $$ $fn$;
+""")
+    assert migration.statements() == [
+        "DO $$\nBEGIN\n    UPDATE a SET b = 0 WHERE b IS NULL;\n    COMMIT;\nEND\n$$",
+        "ALTER TABLE a ALTER COLUMN b SET NOT NULL",
+        "SELECT $fn$ ; $$ $fn$",
+    ]
+
+
+def test_migrations_run_in_a_transaction_unless_marked():
+    assert Migration(1, "tables", "CREATE TABLE a (b INT);").transactional
+    assert Migration(1, "tables", "\n" + NO_TRANSACTION_SQL).transactional is False
+
+
+def test_checksum_follows_the_content():
+    migration = Migration(1, "tables", "CREATE TABLE a (b INT);")
+    assert migration.checksum == Migration(1, "renamed", "CREATE TABLE a (b INT);").checksum
+    assert migration.checksum != Migration(1, "tables", "CREATE TABLE a (b BIGINT);").checksum
+    assert len(migration.checksum) == 64 and str(migration) == "0001_tables"
+
+
+def write(directory, filename, sql):
+    (directory / filename).write_text(sql)
+
+
+def test_load_migrations_in_version_order(tmp_path):
+    write(tmp_path, "0010_later.sql", "SELECT 10;")
+    write(tmp_path, "0002_second.sql", "SELECT 2;")
+    write(tmp_path, "0001_first.sql", "SELECT 1;")
+    write(tmp_path, "README.md", "not a migration")
+    write(tmp_path, "0003_not-a-name.sql", "SELECT 3;")
+    assert [str(migration) for migration in migrate.load_migrations(str(tmp_path))] == [
+        "0001_first", "0002_second", "0010_later",
+    ]
+
+
+def test_two_migrations_with_one_version_are_refused(tmp_path):
+    write(tmp_path, "0001_first.sql", "SELECT 1;")
+    write(tmp_path, "01_again.sql", "SELECT 1;")
+    with pytest.raises(exceptions.MigrationException):
+        migrate.load_migrations(str(tmp_path))
+
+
+def test_pending_migrations():
+    migrations = [Migration(version, f"m{version}", f"SELECT {version};") for version in (1, 2, 3)]
+    applied = {1: migrations[0].checksum}
+    assert [migration.version for migration in migrate.pending_migrations(migrations, applied)] == [2, 3]
+    assert [migration.version for migration in migrate.pending_migrations(migrations, applied, target=2)] == [2]
+
+
+def test_a_migration_changed_after_it_ran_is_refused():
+    migrations = [Migration(1, "tables", "CREATE TABLE a (b BIGINT);")]
+    with pytest.raises(exceptions.MigrationException):
+        migrate.pending_migrations(migrations, {1: Migration(1, "tables", "CREATE TABLE a (b INT);").checksum})
+
+
+def test_the_shipped_migrations_load():
+    migrations = migrate.load_migrations()
+    assert [migration.version for migration in migrations] == list(range(1, len(migrations) + 1))
+    for migration in migrations:
+        if not migration.transactional:
+            # the only dollar quoted bodies in there are DO blocks, nothing else ends on their ";"
+            assert all(statement.startswith("DO $$") for statement in migration.statements() if "$$" in statement)
@@ -0,0 +1,98 @@
+from concurrent.futures import Future
+from contextlib import contextmanager
+import pytest
+import participant_joins
+import schemas
+from participant_joins import JoinCoalescer
+
+MISSING_SESSION = 404
+
+
+class FakeDatabase:
+    """stands in for db.create_participants, a join of MISSING_SESSION fails the whole insert"""
+
+    def __init__(self):
+        self.inserts = []
+        self.next_id = 1
+
+    def create_participants(self, con, participants):
+        self.inserts.append(len(participants))
+        if any(participant.game_session_id == MISSING_SESSION for participant in participants):
+            raise LookupError("game session not found")
+        created = []
+        for participant in participants:
+            created.append({"id": self.next_id, "username": participant.username})
+            self.next_id += 1
+        return created
+
+
+@pytest.fixture
+def database(monkeypatch, pooled_connection):
+    fake = FakeDatabase()
+    monkeypatch.setattr(participant_joins.db, "create_participants", fake.create_participants)
+    return fake
+
+
+def join(username, session_id=1):
+    return schemas.ParticipantCreate(game_session_id=session_id, username=username), Future()
+
+
+def test_a_batch_is_one_insert_and_every_caller_gets_its_own_row(database):
+    batch = [join("ann"), join("bob"), join("cid")]
+    JoinCoalescer(10)._write(batch)
+    assert database.inserts == [3]
+    assert [future.result(0)["username"] for _, future in batch] == ["ann", "bob", "cid"]
+    assert len({future.result(0)["id"] for _, future in batch}) == 3
+
+
+def test_a_failed_batch_falls_back_to_one_insert_per_join(database):
+    batch = [join("ann"), join("lost", MISSING_SESSION), join("bob")]
+    JoinCoalescer(10)._write(batch)
+    assert database.inserts == [3, 1, 1, 1]
+    assert batch[0][1].result(0)["username"] == "ann"
+    assert batch[2][1].result(0)["username"] == "bob"
+    with pytest.raises(LookupError):
+        batch[1][1].result(0)
+
+
+def test_a_single_failing_join_is_not_retried(database):
+    batch = [join("lost", MISSING_SESSION)]
+    JoinCoalescer(10)._write(batch)
+    assert database.inserts == [1]
+    with pytest.raises(LookupError):
+        batch[0][1].result(0)
+
+
+def test_every_join_fails_without_a_connection(monkeypatch):
+    @contextmanager
+    def pooled_connection():
+        raise TimeoutError("no connection")
+        yield
+
+    monkeypatch.setattr(participant_joins.db_setup, "pooled_connection", pooled_connection)
+    batch = [join("ann"), join("bob")]
+    JoinCoalescer(10)._write(batch)
+    for _, future in batch:
+        with pytest.raises(TimeoutError):
+            future.result(0)
+
+
+def test_batches_are_capped_at_the_batch_size():
+    coalescer = JoinCoalescer(2)
+    for username in ("ann", "bob", "cid"):
+        coalescer.submit(schemas.ParticipantCreate(game_session_id=1, username=username))
+    assert [participant.username for participant, _ in coalescer._next_batch()] == ["ann", "bob"]
+    assert [participant.username for participant, _ in coalescer._next_batch()] == ["cid"]
+    assert coalescer._next_batch() == []
+
+
+def test_joins_through_the_thread(database):
+    coalescer = JoinCoalescer(10)
+    coalescer.start()
+    try:
+        futures = [coalescer.submit(schemas.ParticipantCreate(game_session_id=1, username=f"p{n}")) for n in range(20)]
+        assert [future.result(5)["username"] for future in futures] == [f"p{n}" for n in range(20)]
+        assert coalescer.join(schemas.ParticipantCreate(game_session_id=1, username="last"))["username"] == "last"
+    finally:
+        coalescer.stop()
+    assert sum(database.inserts) == 21
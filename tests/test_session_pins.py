@@ -0,0 +1,82 @@
+import pytest
+import exceptions
+from session_pins import ActivePins, PinAllocator
+
+
+def allocator(pins_in_use=()):
+    pins = PinAllocator(1)  # ten PINs, "0" to "9"
+    pins.load(pins_in_use)
+    return pins
+
+
+def test_allocates_every_pin_once():
+    pins = allocator()
+    allocated = [pins.allocate() for _ in range(10)]
+    assert sorted(allocated) == [str(pin) for pin in range(10)]
+
+
+def test_pins_are_zero_padded():
+    pins = PinAllocator(4)
+    pins.load([])
+    pin = pins.allocate()
+    assert len(pin) == 4 and pin.isdigit()
+
+
+def test_pins_in_use_when_loaded_are_skipped():
+    pins = allocator(["3", "7", "not-a-pin"])
+    allocated = {pins.allocate() for _ in range(8)}
+    assert allocated.isdisjoint({"3", "7"})
+
+
+def test_claimed_pins_are_not_handed_out():
+    pins = allocator()
+    pins.claim("5")
+    pins.claim("host-pin")  # a PIN of the host's own choosing doesn't take part
+    assert "5" not in {pins.allocate() for _ in range(9)}
+
+
+def test_exhausted_without_released_pins():
+    pins = allocator()
+    for _ in range(10):
+        pins.allocate()
+    with pytest.raises(exceptions.NoFreeSessionPinException):
+        pins.allocate()
+
+
+def test_released_pins_are_reused_oldest_first_once_the_pool_runs_out():
+    pins = allocator()
+    allocated = [pins.allocate() for _ in range(10)]
+    pins.release(allocated[4])
+    pins.release(allocated[1])
+    assert pins.allocate() == allocated[4]
+    assert pins.allocate() == allocated[1]
+    with pytest.raises(exceptions.NoFreeSessionPinException):
+        pins.allocate()
+
+
+def test_claiming_a_released_pin_takes_it_out_of_the_line():
+    pins = allocator()
+    allocated = [pins.allocate() for _ in range(10)]
+    pins.release(allocated[0])
+    pins.claim(allocated[0])  # reactivated
+    with pytest.raises(exceptions.NoFreeSessionPinException):
+        pins.allocate()
+
+
+def test_releasing_a_pin_twice_recycles_it_once():
+    pins = allocator()
+    allocated = [pins.allocate() for _ in range(10)]
+    pins.release(allocated[0])
+    pins.release(allocated[0])
+    assert pins.allocate() == allocated[0]
+    with pytest.raises(exceptions.NoFreeSessionPinException):
+        pins.allocate()
+
+
+def test_active_pins_only_removes_the_session_holding_the_pin():
+    active = ActivePins()
+    active.add({"id": 1, "session_pin": "123456"})
+    active.remove("123456", 2)
+    assert active.get("123456") == 1
+    active.remove("123456", 1)
+    assert active.get("123456") is None